@@ -0,0 +1,6 @@
+"""
+Load and query benchmarks for the ingest paths and the read endpoints.
+
+Run them with ``python manage.py benchmark`` (see ``--help``), or
+``python -m benchmarks.validation`` for the validator microbenchmark.
+"""
@@ -0,0 +1,103 @@
+"""
+Benchmark database setup and the storage/query benchmarks.
+"""
+import os
+import tempfile
+import time
+from django.db import connections
+from django.test import Client
+from benchmarks.fleet import Fleet
+from benchmarks.stats import summarize
+from evreka_case1.geo import location_fields
+from tracking.latest import update_latest_device_data
+from tracking.models import DeviceData
+
+
+class BenchmarkDatabase:
+    """
+    Create a throwaway database next to the configured one, like the test
+    runner does, so benchmarks never write into real data. SQLite uses a
+    file so the client threads share it, with immediate transactions and a
+    long busy timeout so concurrent writers wait instead of failing.
+    """
+
+    def __init__(self, alias='default', keepdb=False):
+        self.connection = connections[alias]
+        self.keepdb = keepdb
+        self.old_name = None
+
+    def __enter__(self):
+        test_settings = self.connection.settings_dict.setdefault('TEST', {})
+        if not test_settings.get('NAME'):
+            if self.connection.vendor == 'sqlite':
+                test_settings['NAME'] = os.path.join(tempfile.gettempdir(), 'evreka_benchmark.sqlite3')
+            else:
+                test_settings['NAME'] = f"benchmark_{self.connection.settings_dict['NAME']}"
+        if self.connection.vendor == 'sqlite':
+            options = self.connection.settings_dict.setdefault('OPTIONS', {})
+            options.setdefault('transaction_mode', 'IMMEDIATE')
+            options.setdefault('timeout', 60)
+        self.old_name = self.connection.settings_dict['NAME']
+        self.connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=self.keepdb, serialize=False)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.creation.destroy_test_db(self.old_name, verbosity=0, keepdb=self.keepdb)
+
+
+def load_rows(rows, devices, batch_size):
+    """
+    Store ``rows`` records with ``bulk_create`` and update the latest store
+    the way the ingest task does, timing both separately.
+    """
+    fleet = Fleet(devices, seed=1, prefix='stored')
+    bulk_create = 0.0
+    latest = 0.0
+    stored = 0
+    while stored < rows:
+        size = min(batch_size, rows - stored)
+        instances = [DeviceData(**record, **location_fields(record['location'])) for record in fleet.batch(size)]
+        started = time.perf_counter()
+        DeviceData.objects.bulk_create(instances)
+        bulk_create += time.perf_counter() - started
+        started = time.perf_counter()
+        update_latest_device_data(instances)
+        latest += time.perf_counter() - started
+        stored += size
+    return {
+        'rows': rows,
+        'batch_size': batch_size,
+        'bulk_create_seconds': round(bulk_create, 3),
+        'bulk_create_rows_per_sec': round(rows / bulk_create, 1) if bulk_create else None,
+        'latest_upsert_seconds': round(latest, 3),
+    }, fleet.device_ids
+
+
+def time_queries(device_ids, repeat):
+    """
+    Time the list and latest endpoints against the stored rows.
+    """
+    client = Client()
+    device_id = device_ids[len(device_ids) // 2]
+    queries = {
+        'list_first_page': '/tracking/data/list/',
+        'list_cursor_first_page': '/tracking/data/list/?cursor=',
+        'list_device': f'/tracking/data/list/?device_id={device_id}&cursor=',
+        'latest': f'/tracking/data/latest/{device_id}/',
+        'bulk_latest_100': '/tracking/data/latest/?device_id=' + ','.join(device_ids[:100]),
+    }
+    results = {}
+    for name, url in queries.items():
+        latencies = []
+        errors = 0
+        started = time.perf_counter()
+        for _ in range(repeat):
+            sent = time.perf_counter()
+            response = client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            latencies.append(time.perf_counter() - sent)
+            errors += response.status_code != 200
+        results[name] = summarize(latencies, 0, time.perf_counter() - started, errors)
+        del results[name]['records'], results[name]['records_per_sec']
+    return results
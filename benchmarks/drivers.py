@@ -0,0 +1,184 @@
+"""
+Load generators for the HTTP endpoint and the TCP server.
+
+Every client runs in its own thread with its own slice of the fleet and
+sends ``batches`` batches, optionally paced to ``rate`` records per second.
+"""
+import asyncio
+import json
+import socket
+import threading
+import time
+import urllib.request
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+from benchmarks.fleet import Fleet, to_json_records
+from benchmarks.stats import summarize
+from tcp_tracking import binary_protocol
+from tcp_tracking.tcp_server import create_server_socket, handle_stream_connection
+
+
+class HTTPSender:
+    """
+    Post batches to ``data/`` in-process through the full Django stack, or to
+    a running server when ``base_url`` is given.
+    """
+    path = '/tracking/data/'
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url
+        self.client = None if base_url else Client()
+
+    def send(self, records):
+        body = json.dumps(to_json_records(records))
+        if self.client is not None:
+            response = self.client.post(self.path, body, content_type='application/json')
+            return response.status_code == 202
+        request = urllib.request.Request(
+            self.base_url.rstrip('/') + self.path,
+            data=body.encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+        )
+        with urllib.request.urlopen(request) as response:
+            return response.status == 202
+
+    def close(self):
+        pass
+
+
+class TCPSender:
+    """
+    Stream batches over one persistent connection, as length prefixed JSON
+    frames or as binary frames.
+    """
+
+    def __init__(self, host, port, binary=False):
+        self.binary = binary
+        self.socket = socket.create_connection((host, port))
+        self.reader = self.socket.makefile('rb')
+
+    def send(self, records):
+        if self.binary:
+            frame = binary_protocol.encode_batch([
+                {
+                    'device_id': record['device_id'],
+                    'latitude': float(record['location'].split(',')[0]),
+                    'longitude': float(record['location'].split(',')[1]),
+                    'speed': record['speed'],
+                    'timestamp': record['timestamp'],
+                }
+                for record in records
+            ])
+            self.socket.sendall(frame)
+            status, _ = binary_protocol.decode_ack(self.reader.read(binary_protocol.ACK.size))
+            return status == binary_protocol.STATUS_OK
+
+        body = json.dumps(to_json_records(records)).encode('utf-8')
+        self.socket.sendall(len(body).to_bytes(4, 'big') + body)
+        length = int.from_bytes(self.reader.read(4), 'big')
+        return json.loads(self.reader.read(length)).get('message') == 'Data received'
+
+    def close(self):
+        self.reader.close()
+        self.socket.close()
+
+
+def run_client(make_sender, fleet, batches, batch_size, rate, result):
+    sender = make_sender()
+    interval = batch_size / rate if rate else 0
+    started = time.perf_counter()
+    try:
+        for index in range(batches):
+            if interval:
+                # Pace batches to the target rate instead of sending as fast as possible
+                delay = started + index * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            records = fleet.batch(batch_size)
+            sent = time.perf_counter()
+            try:
+                ok = sender.send(records)
+            except Exception:
+                ok = False
+            result['latencies'].append(time.perf_counter() - sent)
+            if ok:
+                result['records'] += batch_size
+            else:
+                result['errors'] += 1
+    finally:
+        sender.close()
+        connections.close_all()
+
+
+def start_load(name, make_sender, clients, devices, batches, batch_size, rate):
+    """
+    Start the client threads of one load and return a function that waits
+    for them and returns the summary.
+    """
+    results = []
+    threads = []
+    for index in range(clients):
+        result = {'latencies': [], 'records': 0, 'errors': 0}
+        fleet = Fleet(max(1, devices // clients), seed=index, prefix=f'{name}-{index}')
+        thread = threading.Thread(
+            target=run_client,
+            args=(make_sender, fleet, batches, batch_size, rate, result),
+            daemon=True,
+        )
+        results.append(result)
+        threads.append(thread)
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    def wait():
+        for thread in threads:
+            thread.join()
+        return summarize(
+            [latency for result in results for latency in result['latencies']],
+            sum(result['records'] for result in results),
+            time.perf_counter() - started,
+            sum(result['errors'] for result in results),
+        )
+    return wait
+
+
+class LocalTCPServer:
+    """
+    Run the asyncio TCP server on a free local port in a background thread.
+    """
+
+    def __init__(self):
+        self.socket = create_server_socket('127.0.0.1', 0)
+        self.port = self.socket.getsockname()[1]
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    async def serve(self):
+        self.server = await asyncio.start_server(
+            handle_stream_connection, sock=self.socket, limit=settings.TCP_MAX_FRAME_SIZE
+        )
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def __enter__(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.serve(), self.loop).result()
+        return self
+
+    async def shutdown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        # The clients have disconnected, let the connection handlers finish
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=5)
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
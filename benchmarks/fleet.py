@@ -0,0 +1,49 @@
+import random
+from datetime import timedelta
+from django.utils import timezone
+
+
+class Fleet:
+    """
+    Synthetic fleet of devices moving around a starting point.
+
+    Every call to ``batch`` advances a random subset of the devices and
+    returns their new positions as ingest records.
+    """
+
+    def __init__(self, devices=1000, seed=0, prefix='bench', center=(41.0082, 28.9784), spread=0.5):
+        self.random = random.Random(seed)
+        self.device_ids = [f'{prefix}-{index:06d}' for index in range(devices)]
+        self.positions = {
+            device_id: [
+                center[0] + self.random.uniform(-spread, spread),
+                center[1] + self.random.uniform(-spread, spread),
+            ]
+            for device_id in self.device_ids
+        }
+        self.clock = timezone.now() - timedelta(days=1)
+
+    def record(self, device_id):
+        position = self.positions[device_id]
+        position[0] = min(max(position[0] + self.random.uniform(-0.001, 0.001), -90), 90)
+        position[1] = min(max(position[1] + self.random.uniform(-0.001, 0.001), -180), 180)
+        self.clock += timedelta(milliseconds=10)
+        return {
+            'device_id': device_id,
+            'location': f'{position[0]:.6f}, {position[1]:.6f}',
+            'speed': round(self.random.uniform(0, 120), 2),
+            'timestamp': self.clock,
+        }
+
+    def batch(self, size):
+        """
+        Return ``size`` records with ``datetime`` timestamps.
+        """
+        return [self.record(self.random.choice(self.device_ids)) for _ in range(size)]
+
+
+def to_json_records(records):
+    """
+    Turn records into what clients put on the wire (ISO 8601 timestamps).
+    """
+    return [{**record, 'timestamp': record['timestamp'].isoformat()} for record in records]
@@ -0,0 +1,86 @@
+import platform
+import time
+import django
+from celery import current_app
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+from benchmarks import database, drivers
+from evreka_case1.pipeline import close_direct_writers
+from tcp_tracking.models import DeviceData as TCPDeviceData
+from tracking.models import DeviceData
+
+
+def stored_records():
+    return DeviceData.objects.count() + TCPDeviceData.objects.count()
+
+
+def run_ingest(options):
+    """
+    Drive the HTTP endpoint and the TCP server at the same time and return
+    the summary of each, with the time it took afterwards to store the
+    records still queued in-process and the number of records stored.
+    """
+    stored_before = stored_records()
+    loads = {}
+    server = None
+    if options['tcp_clients'] and not options['tcp_port']:
+        server = drivers.LocalTCPServer().__enter__()
+    tcp_host = options['tcp_host'] if options['tcp_port'] else '127.0.0.1'
+    tcp_port = options['tcp_port'] or (server.port if server else None)
+
+    try:
+        if options['http_clients']:
+            loads['http'] = drivers.start_load(
+                'http',
+                lambda: drivers.HTTPSender(options['base_url']),
+                options['http_clients'], options['devices'], options['batches'], options['batch_size'], options['rate'],
+            )
+        if options['tcp_clients']:
+            loads['tcp'] = drivers.start_load(
+                'tcp',
+                lambda: drivers.TCPSender(tcp_host, tcp_port, binary=options['binary']),
+                options['tcp_clients'], options['devices'], options['batches'], options['batch_size'], options['rate'],
+            )
+        results = {name: wait() for name, wait in loads.items()}
+    finally:
+        if server is not None:
+            server.__exit__(None, None, None)
+    # The direct pipeline acknowledges records before they are stored
+    started = time.perf_counter()
+    close_direct_writers()
+    results['drain_seconds'] = round(time.perf_counter() - started, 3)
+    results['stored_records'] = stored_records() - stored_before
+    return results
+
+
+def run(options):
+    """
+    Run the selected benchmarks and return the results as a JSON serializable dictionary.
+    """
+    if options['eager']:
+        # The broker is replaced by running the tasks in the sending thread
+        current_app.conf.task_always_eager = True
+
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'eager': options['eager'],
+        },
+        'options': options,
+    }
+    # The in-process clients use the test client host name
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']), \
+            database.BenchmarkDatabase(keepdb=options['keepdb']):
+        if not options['skip_ingest']:
+            results['ingest'] = {}
+            for pipeline in options['pipelines']:
+                with override_settings(INGEST_PIPELINE=pipeline):
+                    results['ingest'][pipeline] = run_ingest(options)
+        if options['rows']:
+            results['storage'], device_ids = database.load_rows(options['rows'], options['devices'], options['insert_batch_size'])
+            results['queries'] = database.time_queries(device_ids, options['query_repeat'])
+    return results
@@ -0,0 +1,69 @@
+"""
+Compare the message size and the encode/decode time of an ingest task with
+the ``json`` and the ``columnar`` serializers.
+
+    python -m benchmarks.serialization --records 5000 --repeat 5
+"""
+import argparse
+import json
+import os
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'evreka_case1.settings')
+django.setup()
+
+from kombu.utils.json import dumps, loads  # noqa: E402
+from benchmarks.fleet import Fleet  # noqa: E402
+from evreka_case1.serialization import ColumnarSerializer  # noqa: E402
+
+
+def task_body(records):
+    # What Celery serializes for process_device_data.apply_async((records,))
+    return [[records], {}, {'callbacks': None, 'errbacks': None, 'chain': None, 'chord': None}]
+
+
+def measure(function, argument, repeat):
+    """
+    Return the best seconds of a call out of ``repeat`` runs.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def compare(name, encode, decode, body, records, repeat):
+    data = encode(body)
+    return name, {
+        'bytes_per_record': round(len(data) / records, 1),
+        'encode_us_per_record': round(measure(encode, body, repeat) / records * 1e6, 2),
+        'decode_us_per_record': round(measure(decode, data, repeat) / records * 1e6, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=5000)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    body = task_body(Fleet(devices=args.devices).batch(args.records))
+    plain = ColumnarSerializer(compress_min_size=None)
+    compressed = ColumnarSerializer(compress_min_size=0)
+    results = dict([
+        compare('json', lambda value: dumps(value).encode('utf-8'), loads, body, args.records, args.repeat),
+        compare('columnar', plain.encode, plain.decode, body, args.records, args.repeat),
+        compare('columnar_zlib', compressed.encode, compressed.decode, body, args.records, args.repeat),
+    ])
+    for name in ('columnar', 'columnar_zlib'):
+        results[name]['size_ratio'] = round(results['json']['bytes_per_record'] / results[name]['bytes_per_record'], 2)
+    print(json.dumps({'records': args.records, 'devices': args.devices, **results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
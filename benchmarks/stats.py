@@ -0,0 +1,34 @@
+def percentile(ordered, fraction):
+    """
+    Nearest rank percentile of an already sorted list.
+    """
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, records, elapsed, errors=0):
+    """
+    Summarize request latencies (seconds) as throughput and latency
+    percentiles in milliseconds.
+    """
+    ordered = sorted(latencies)
+
+    def millis(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'requests': len(ordered),
+        'records': records,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'requests_per_sec': round(len(ordered) / elapsed, 1) if elapsed else None,
+        'records_per_sec': round(records / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            'p50': millis(percentile(ordered, 0.50)),
+            'p95': millis(percentile(ordered, 0.95)),
+            'p99': millis(percentile(ordered, 0.99)),
+            'max': millis(ordered[-1] if ordered else None),
+        },
+    }
@@ -0,0 +1,75 @@
+"""
+Compare validating ingest records with ``DeviceDataInputSerializer`` and with
+the fast path ``DeviceDataValidator``.
+
+    python -m benchmarks.validation --records 10000 --repeat 5
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'evreka_case1.settings')
+django.setup()
+
+from tracking.serializers import DeviceDataInputSerializer, device_data_validator  # noqa: E402
+
+
+def make_records(count, devices=1000, seed=0):
+    rng = random.Random(seed)
+    return [
+        {
+            'device_id': f'device-{rng.randrange(devices)}',
+            'location': f'{rng.uniform(-90, 90):.6f}, {rng.uniform(-180, 180):.6f}',
+            'speed': round(rng.uniform(0, 120), 2),
+            'timestamp': f'2024-01-01T{index // 3600 % 24:02d}:{index // 60 % 60:02d}:{index % 60:02d}Z',
+        }
+        for index in range(count)
+    ]
+
+
+def validate_with_serializer(records):
+    serializer = DeviceDataInputSerializer(data=records, many=True)
+    serializer.is_valid()
+    return [dict(item) for item in serializer.validated_data]
+
+
+def validate_with_validator(records):
+    validated_data, _ = device_data_validator.validate_many(records)
+    return validated_data
+
+
+def measure(function, records, repeat):
+    """
+    Return the best records/sec out of ``repeat`` runs.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(records)
+        best = min(best, time.perf_counter() - started)
+    return len(records) / best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    records = make_records(args.records)
+    serializer = measure(validate_with_serializer, records, args.repeat)
+    validator = measure(validate_with_validator, records, args.repeat)
+    print(json.dumps({
+        'records': args.records,
+        'serializer_records_per_sec': round(serializer),
+        'validator_records_per_sec': round(validator),
+        'speedup': round(validator / serializer, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+Admission control of the ingest endpoints.
+
+Before validated records are handed to the broker an ``AdmissionController``
+checks, when configured:
+
+* the backlog of the ingest queues (``ADMISSION_MAX_QUEUE_DEPTH`` messages).
+  Bulk uploads have a controller of their own, which watches the bulk queue
+  (``INGEST_BULK_QUEUE``) instead when one is configured,
+* the records of this process not yet handed to the broker
+  (``ADMISSION_MAX_IN_FLIGHT``), which grow when publishing slows down,
+  including the ones held by the coalescer or the TCP spool,
+* a token bucket per device (``ADMISSION_DEVICE_RATE`` records per second
+  with bursts of ``ADMISSION_DEVICE_BURST``).
+
+The HTTP view rejects a request that doesn't fit with 503 (or 429 for a
+device over its rate) and a ``Retry-After`` header. The TCP server waits for
+capacity instead, so it stops reading the connection and the client is
+slowed down by TCP flow control rather than buffered without limit.
+"""
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+from evreka_case1.celery import app
+from evreka_case1.routing import ingest_queues
+from evreka_case1.metrics import (
+    ADMISSION_IN_FLIGHT, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS, INGEST_QUEUE_DEPTH,
+)
+
+RATE_LIMITED = 'rate_limited'
+IN_FLIGHT = 'in_flight'
+QUEUE_DEPTH = 'queue_depth'
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when records are not admitted. ``retry_after`` is the number of
+    seconds after which the client should try again.
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(
+            'Rate limit exceeded.' if reason == RATE_LIMITED else 'Ingest is overloaded, try again later.'
+        )
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def status_code(self):
+        return 429 if self.reason == RATE_LIMITED else 503
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class TokenBuckets:
+    """
+    Token bucket per key, refilled with ``rate`` tokens per second up to
+    ``burst``. Only the ``max_keys`` most recently used keys are kept.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, counts, now=None):
+        """
+        Take ``counts[key]`` tokens of every key if all of them have enough,
+        returning 0. Otherwise nothing is taken and the number of seconds
+        until they would have is returned. A count over the burst only needs
+        a full bucket and leaves it in debt.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            levels = {}
+            wait = 0.0
+            for key, count in counts.items():
+                tokens, updated = self.buckets.get(key, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                levels[key] = tokens
+                needed = min(count, self.burst)
+                if tokens < needed:
+                    wait = max(wait, (needed - tokens) / self.rate)
+            if wait:
+                return wait
+            for key, count in counts.items():
+                self.buckets[key] = (levels[key] - count, now)
+                self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return 0.0
+
+
+class InFlight:
+    """
+    Count of the records between admission and the broker, capped at ``limit``.
+    A batch larger than the limit is still admitted when nothing else is in flight.
+
+    ``buffered`` returns the number of admitted records that are still held
+    in-process after their slot was released (coalescer, spool), they count
+    towards the limit until they are handed off.
+    """
+
+    # Seconds between checks of the buffered records, which change without notifying
+    poll_interval = 0.05
+
+    def __init__(self, limit, on_change=None, buffered=None):
+        self.limit = limit
+        self.count = 0
+        self.condition = threading.Condition()
+        self.on_change = on_change
+        self.buffered = buffered
+
+    def total(self):
+        return self.count + (self.buffered() if self.buffered is not None else 0)
+
+    def _fits(self, count):
+        total = self.total()
+        return total == 0 or total + count <= self.limit
+
+    def acquire(self, count, timeout=0):
+        """
+        Reserve ``count`` records, waiting up to ``timeout`` seconds (forever
+        with ``None``) for others to be released. Returns whether it succeeded.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while not self._fits(count):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                if self.buffered is not None:
+                    remaining = self.poll_interval if remaining is None else min(remaining, self.poll_interval)
+                self.condition.wait(remaining)
+            self.count += count
+            self._changed()
+            return True
+
+    def release(self, count):
+        with self.condition:
+            self.count -= count
+            self._changed()
+            self.condition.notify_all()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self.total())
+
+
+class QueueDepth:
+    """
+    Number of messages waiting in a broker queue (or in all of a list of
+    queues), refreshed at most every ``interval`` seconds. ``None`` when the
+    broker can't be asked.
+    """
+
+    def __init__(self, app, queue, interval=1.0):
+        self.app = app
+        self.queues = [queue] if isinstance(queue, str) else list(queue)
+        self.interval = interval
+        self.value = None
+        self.checked = float('-inf')
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        depths = {}
+        with self.app.connection_for_read() as connection:
+            for queue in self.queues:
+                depths[queue] = connection.default_channel.queue_declare(queue, passive=True).message_count
+        for queue, depth in depths.items():
+            INGEST_QUEUE_DEPTH.labels(queue).set(depth)
+        return sum(depths.values())
+
+    def depth(self):
+        if time.monotonic() - self.checked < self.interval:
+            return self.value
+        # One thread refreshes, the others use the previous value meanwhile
+        if not self.lock.acquire(blocking=False):
+            return self.value
+        try:
+            try:
+                self.value = self.fetch()
+            except Exception:
+                self.value = None
+            self.checked = time.monotonic()
+            return self.value
+        finally:
+            self.lock.release()
+
+
+class AdmissionController:
+    """
+    Admit batches of validated records of one ``source``, every check is
+    disabled while its limit is 0.
+    """
+
+    def __init__(self, source, device_rate=0, device_burst=0, max_devices=100000, max_in_flight=0,
+                 queue_depth=None, max_queue_depth=0, retry_after=1.0, buffered=None):
+        self.source = source
+        self.buckets = TokenBuckets(device_rate, device_burst or device_rate, max_devices) if device_rate else None
+        self.in_flight = InFlight(
+            max_in_flight, ADMISSION_IN_FLIGHT.labels(source).set, buffered
+        ) if max_in_flight else None
+        self.queue_depth = queue_depth if max_queue_depth else None
+        self.max_queue_depth = max_queue_depth
+        self.retry_after = retry_after
+
+    def reject(self, reason, retry_after=None):
+        ADMISSION_REJECTED.labels(self.source, reason).inc()
+        raise AdmissionRejected(reason, self.retry_after if retry_after is None else retry_after)
+
+    def queue_full(self):
+        if self.queue_depth is None:
+            return False
+        depth = self.queue_depth.depth()
+        return depth is not None and depth >= self.max_queue_depth
+
+    def wait_for_queue(self, deadline):
+        started = time.monotonic()
+        while self.queue_full():
+            if time.monotonic() >= deadline:
+                self.reject(QUEUE_DEPTH)
+            time.sleep(min(self.queue_depth.interval, max(0.0, deadline - time.monotonic())))
+        return time.monotonic() - started
+
+    @contextmanager
+    def admit(self, records, wait=0, rate_limit=True):
+        """
+        Admit ``records`` for the duration of the block, in which they should
+        be handed to the broker (or to a buffer counted by ``buffered``).
+        Raises ``AdmissionRejected`` when they don't fit, after waiting up to
+        ``wait`` seconds for the queue to drain and the in-flight records to
+        be released. Without ``rate_limit`` the device rates aren't checked.
+        """
+        deadline = time.monotonic() + wait
+        waited = self.wait_for_queue(deadline)
+        if self.in_flight is not None:
+            started = time.monotonic()
+            acquired = self.in_flight.acquire(len(records), timeout=max(0.0, deadline - started))
+            waited += time.monotonic() - started
+            if not acquired:
+                self.reject(IN_FLIGHT)
+        if wait:
+            ADMISSION_WAIT_SECONDS.labels(self.source).observe(waited)
+        try:
+            if self.buckets is not None and rate_limit:
+                delay = self.buckets.take(Counter(str(record['device_id']) for record in records))
+                if delay:
+                    self.reject(RATE_LIMITED, delay)
+            yield
+        finally:
+            if self.in_flight is not None:
+                self.in_flight.release(len(records))
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_admission_controller(source, buffered=None, bulk=False):
+    """
+    Return the process wide admission controller of ``source``, created from
+    the ``ADMISSION_*`` settings on first use. ``buffered`` returns the
+    admitted records the source still holds in-process, see ``InFlight``.
+    With ``bulk`` the depth of ``INGEST_BULK_QUEUE`` is checked when it's set.
+    """
+    with _controllers_lock:
+        if source not in _controllers:
+            queues = [settings.INGEST_BULK_QUEUE] if bulk and settings.INGEST_BULK_QUEUE else ingest_queues()
+            _controllers[source] = AdmissionController(
+                source,
+                device_rate=settings.ADMISSION_DEVICE_RATE,
+                device_burst=settings.ADMISSION_DEVICE_BURST,
+                max_devices=settings.ADMISSION_MAX_DEVICES,
+                max_in_flight=settings.ADMISSION_MAX_IN_FLIGHT,
+                queue_depth=QueueDepth(app, queues, settings.ADMISSION_QUEUE_CHECK_INTERVAL),
+                max_queue_depth=settings.ADMISSION_MAX_QUEUE_DEPTH,
+                retry_after=settings.ADMISSION_RETRY_AFTER,
+                buffered=buffered,
+            )
+        return _controllers[source]
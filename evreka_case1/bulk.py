@@ -0,0 +1,122 @@
+import gzip
+import json
+import zlib
+
+INVALID_JSON_ERROR = {'non_field_errors': ['Invalid JSON.']}
+LINE_TOO_LONG_ERROR = {'non_field_errors': ['Line too long.']}
+
+
+class UploadError(Exception):
+    """
+    Raised when the upload stream itself cannot be read (e.g. corrupt gzip).
+    ``result`` holds the counts of what has been accepted before the error.
+    """
+
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+def open_upload(stream, content_encoding=None):
+    """
+    Wrap a request stream so it is decompressed on the fly when gzipped.
+    """
+    if content_encoding == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    return stream
+
+
+def iter_lines(stream, max_line_length):
+    """
+    Yield ``(line_number, line)`` from a binary stream without ever holding
+    more than one line in memory. Lines over ``max_line_length`` are yielded
+    as ``None`` and skipped.
+    """
+    line_number = 0
+    while True:
+        line = stream.readline(max_line_length + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > max_line_length and not line.endswith(b'\n'):
+            # Drain the rest of the oversized line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_line_length + 1)
+            yield line_number, None
+        else:
+            yield line_number, line
+
+
+class NDJSONIngest:
+    """
+    Incrementally parse an NDJSON upload, validating and dispatching it in
+    chunks of ``chunk_size`` records.
+
+    ``validate`` takes a list of records and returns a list of
+    ``(validated_data, errors)`` pairs, ``dispatch`` receives every chunk of
+    validated records. Only counts and the first ``max_errors`` error
+    positions are kept, so memory use is independent of the upload size.
+    """
+
+    def __init__(self, validate, dispatch, chunk_size=1000, max_errors=100, max_line_length=65536):
+        self.validate = validate
+        self.dispatch = dispatch
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.max_line_length = max_line_length
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+
+    @property
+    def result(self):
+        return {
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'errors_truncated': self.rejected > len(self.errors),
+        }
+
+    def reject(self, line_number, errors):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line_number, 'errors': errors})
+
+    def flush(self, chunk):
+        if not chunk:
+            return
+        line_numbers, records = zip(*chunk)
+        validated = []
+        for line_number, (data, errors) in zip(line_numbers, self.validate(list(records))):
+            if errors:
+                self.reject(line_number, errors)
+            else:
+                validated.append(data)
+        if validated:
+            self.dispatch(validated)
+            self.accepted += len(validated)
+
+    def run(self, stream):
+        """
+        Consume the stream and return the result counts.
+        """
+        chunk = []
+        try:
+            for line_number, line in iter_lines(stream, self.max_line_length):
+                if line is None:
+                    self.reject(line_number, LINE_TOO_LONG_ERROR)
+                    continue
+                if not line.strip():
+                    continue
+                try:
+                    chunk.append((line_number, json.loads(line)))
+                except ValueError:
+                    self.reject(line_number, INVALID_JSON_ERROR)
+                    continue
+                if len(chunk) >= self.chunk_size:
+                    self.flush(chunk)
+                    chunk = []
+        except (OSError, EOFError, zlib.error) as e:
+            raise UploadError(f'Could not read the upload: {e}', self.result)
+        self.flush(chunk)
+        return self.result
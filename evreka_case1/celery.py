@@ -1,9 +1,50 @@
 from __future__ import absolute_import, unicode_literals
 import os
+import time
+from billiard.process import current_process
 from celery import Celery
+from celery.signals import before_task_publish, task_prerun, worker_init, worker_process_init
+from .metrics import TASK_QUEUE_LAG_SECONDS, start_metrics_server
+from .serialization import register_columnar_serializer
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'evreka_case1.settings')
 
 app = Celery('evreka_case1')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
+
+# Registered on import so kombu can decode it before the app is configured
+columnar_serializer = register_columnar_serializer()
+
+
+@app.on_after_configure.connect
+def configure_serializers(sender=None, **kwargs):
+    from django.conf import settings
+    columnar_serializer.compress_min_size = settings.INGEST_SERIALIZER_COMPRESS_MIN_SIZE or None
+    columnar_serializer.compress_level = settings.INGEST_SERIALIZER_COMPRESS_LEVEL
+
+
+@before_task_publish.connect
+def stamp_enqueue_time(headers=None, **kwargs):
+    if headers is not None:
+        headers['enqueued_at'] = time.time()
+
+
+@task_prerun.connect
+def record_queue_lag(task=None, **kwargs):
+    enqueued_at = task.request.get('enqueued_at') if task is not None else None
+    if enqueued_at:
+        TASK_QUEUE_LAG_SECONDS.labels(task.name).observe(max(0.0, time.time() - enqueued_at))
+
+
+@worker_process_init.connect
+def start_worker_metrics(**kwargs):
+    from django.conf import settings
+    if settings.METRICS_CELERY_PORT:
+        start_metrics_server(settings.METRICS_CELERY_PORT + getattr(current_process(), 'index', 0))
+
+
+@worker_init.connect
+def install_profiling(**kwargs):
+    from .profiling import install_task_hooks
+    install_task_hooks()
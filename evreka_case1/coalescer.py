@@ -0,0 +1,184 @@
+import atexit
+import logging
+import threading
+import time
+from django.conf import settings
+from evreka_case1.admission import AdmissionRejected
+from evreka_case1.metrics import ADMISSION_REJECTED
+
+logger = logging.getLogger(__name__)
+
+COALESCER_FULL = 'coalescer_full'
+
+
+class CoalescerFull(AdmissionRejected):
+    """
+    Raised when the records don't fit in the buffer of a coalescer.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(COALESCER_FULL, retry_after)
+
+
+class BatchCoalescer:
+    """
+    Buffers validated records and hands them to ``flush`` as one batch.
+
+    A batch is flushed by the caller that fills the buffer up to
+    ``max_records``, or by a background thread once the oldest buffered record
+    is ``max_age_ms`` old. ``close`` flushes whatever is left.
+
+    Buffered records are already acknowledged, so a batch that fails to
+    flush is put back and retried with the next one. At most ``max_buffered``
+    records are held, including the batch being flushed; ``add`` raises
+    ``CoalescerFull`` (telling the client to retry after ``retry_after``
+    seconds) instead of growing the buffer further.
+    """
+
+    def __init__(self, flush, max_records, max_age_ms, max_buffered=None, retry_after=1.0, name='coalescer'):
+        self.flush_callback = flush
+        self.max_records = max_records
+        self.max_age = max_age_ms / 1000
+        self.max_buffered = max_buffered
+        self.retry_after = retry_after
+        self.name = name
+        self._buffer = []
+        self._flushing = 0
+        self._deadline = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    @property
+    def buffered(self):
+        """
+        Number of records not handed to ``flush`` yet, including the ones being flushed.
+        """
+        return len(self._buffer) + self._flushing
+
+    def add(self, records):
+        """
+        Buffer the records, flushing in the calling thread when the buffer is full.
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError(f'{self.name} is closed')
+            # A batch larger than the buffer is still accepted into an empty one
+            if self.max_buffered and self.buffered and self.buffered + len(records) > self.max_buffered:
+                ADMISSION_REJECTED.labels(self.name, COALESCER_FULL).inc()
+                raise CoalescerFull(self.retry_after)
+            if not self._buffer:
+                self._deadline = time.monotonic() + self.max_age
+                self._condition.notify()
+            self._buffer.extend(records)
+            if len(self._buffer) < self.max_records:
+                return
+            batch = self._take()
+        self._flush(batch)
+
+    def flush(self):
+        """
+        Flush the buffered records right away. Raises when ``flush`` failed,
+        the records are kept for the next attempt.
+        """
+        with self._condition:
+            batch = self._take()
+        if batch:
+            self._flush(batch, reraise=True)
+
+    def _flush(self, batch, reraise=False):
+        try:
+            self.flush_callback(batch)
+        except Exception as e:
+            # The records were acknowledged, keep them so they go out with
+            # the next batch instead of being lost.
+            logger.error(f"Error flushing {len(batch)} records from {self.name}: {e}")
+            with self._condition:
+                if not self._buffer:
+                    self._deadline = time.monotonic() + self.max_age
+                    self._condition.notify()
+                self._buffer[:0] = batch
+                self._flushing -= len(batch)
+            if reraise:
+                raise
+        else:
+            with self._condition:
+                self._flushing -= len(batch)
+
+    def close(self):
+        """
+        Stop the background thread and flush the remaining records.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        with self._condition:
+            batch = self._take()
+        if batch:
+            self._flush(batch)
+
+    def _take(self):
+        batch, self._buffer, self._deadline = self._buffer, [], None
+        self._flushing += len(batch)
+        return batch
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and (self._deadline is None or time.monotonic() < self._deadline):
+                    timeout = None if self._deadline is None else self._deadline - time.monotonic()
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+                batch = self._take()
+            self._flush(batch)
+
+
+_coalescers = {}
+_coalescers_lock = threading.Lock()
+
+
+def get_coalescer(name, flush):
+    """
+    Return the process wide coalescer registered under ``name``, creating it
+    from the ``INGEST_COALESCE_*`` settings on first use.
+    """
+    with _coalescers_lock:
+        if name not in _coalescers:
+            _coalescers[name] = BatchCoalescer(
+                flush,
+                max_records=settings.INGEST_COALESCE_MAX_RECORDS,
+                max_age_ms=settings.INGEST_COALESCE_MAX_AGE_MS,
+                max_buffered=settings.INGEST_COALESCE_MAX_BUFFERED,
+                retry_after=settings.ADMISSION_RETRY_AFTER,
+                name=f'{name}-coalescer',
+            )
+        return _coalescers[name]
+
+
+def buffered_records(name):
+    """
+    Number of records held by the coalescer registered under ``name``, 0 if there is none.
+    """
+    with _coalescers_lock:
+        coalescer = _coalescers.get(name)
+    return coalescer.buffered if coalescer is not None else 0
+
+
+@atexit.register
+def close_coalescers():
+    """
+    Flush every coalescer, called on interpreter shutdown.
+    """
+    with _coalescers_lock:
+        coalescers = list(_coalescers.values())
+        _coalescers.clear()
+    for coalescer in coalescers:
+        coalescer.close()
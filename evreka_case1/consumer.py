@@ -0,0 +1,180 @@
+"""
+Worker-side batching of ingest tasks.
+
+``BatchConsumer`` reads Celery task messages from the ingest queue itself
+instead of running one task per message. Prefetched messages are drained
+together and the records of every ingest task are written with one
+multi-row insert per table in a single transaction. Messages are only
+acknowledged once that transaction has committed, so a crash redelivers
+them instead of losing them. Records failing the combined write are
+dead-lettered by their writer, a message failing to store on its own is
+rejected so it isn't redelivered forever.
+"""
+import logging
+import socket
+import time
+from django.db import transaction
+from evreka_case1.ingest import TRANSIENT_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+def decode_task(body, headers):
+    """
+    Return the ``(task_name, args, kwargs)`` of a decoded Celery task message
+    (protocol 2, or protocol 1 with everything in the body).
+    """
+    task_name = headers.get('task')
+    if task_name is not None:
+        args, kwargs = body[0], body[1]
+    else:
+        task_name, args, kwargs = body['task'], body.get('args', ()), body.get('kwargs', {})
+    return task_name, args, kwargs
+
+
+class BatchConsumer:
+    """
+    Consume ``queue`` (a name or a list of them) and store the records of
+    the ingest tasks in batches.
+
+    ``writers`` maps ingest task names to their ``IngestWriter``, any other
+    task found on the queue is run in-process. A batch is flushed once it
+    holds ``max_records`` records or ``max_wait_ms`` after its first message.
+    """
+
+    def __init__(self, app, queue, writers, prefetch=1000, max_records=10000, max_wait_ms=200):
+        self.app = app
+        self.queues = [queue] if isinstance(queue, str) else list(queue)
+        self.writers = writers
+        self.prefetch = prefetch
+        self.max_records = max_records
+        self.max_wait = max_wait_ms / 1000
+        self.pending = []
+        self.records = 0
+        self.first_received = None
+        self.stopping = False
+        self.stored = 0
+
+    def on_message(self, body, message):
+        if self.first_received is None:
+            self.first_received = time.monotonic()
+        try:
+            task_name, args, kwargs = decode_task(body, message.headers)
+        except (IndexError, KeyError, TypeError) as e:
+            logger.error(f"Discarding malformed task message: {e}")
+            message.ack()
+            return
+        self.pending.append((message, task_name, args, kwargs))
+        if task_name in self.writers:
+            self.records += len(args[0] if args else kwargs.get('data_list', ()))
+
+    def run(self, stop_when_idle=False):
+        """
+        Consume until ``stop`` is called, or until the queue is empty with
+        ``stop_when_idle``.
+        """
+        with self.app.connection_for_read() as connection:
+            consumer = connection.Consumer(
+                [self.app.amqp.queues[name] for name in self.queues],
+                callbacks=[self.on_message],
+                accept=self.app.conf.accept_content,
+                prefetch_count=self.prefetch,
+            )
+            with consumer:
+                while not self.stopping:
+                    if self.first_received is None:
+                        timeout = 1.0
+                    else:
+                        timeout = max(0.0, self.first_received + self.max_wait - time.monotonic())
+                    try:
+                        connection.drain_events(timeout=timeout)
+                    except socket.timeout:
+                        if not self.pending and stop_when_idle:
+                            break
+                        if self.pending:
+                            self.flush()
+                        continue
+                    if self.records >= self.max_records or len(self.pending) >= self.prefetch:
+                        self.flush()
+                if self.pending:
+                    self.flush()
+
+    def stop(self):
+        self.stopping = True
+
+    def flush(self):
+        messages, self.pending = self.pending, []
+        self.records = 0
+        self.first_received = None
+
+        batches = {}
+        others = []
+        for message, task_name, args, kwargs in messages:
+            writer = self.writers.get(task_name)
+            if writer is None:
+                others.append((message, task_name, args, kwargs))
+            else:
+                data_list = args[0] if args else kwargs.get('data_list', [])
+                batch_id = args[1] if len(args) > 1 else kwargs.get('batch_id')
+                batches.setdefault(writer, []).append((message, data_list, batch_id))
+
+        if batches:
+            self.store(batches)
+        for message, task_name, args, kwargs in others:
+            task = self.app.tasks.get(task_name)
+            if task is None:
+                logger.error(f"Discarding message of unknown task {task_name}")
+            else:
+                task.apply(args, kwargs)
+            message.ack()
+
+    def store(self, batches):
+        """
+        Store every batch in one transaction. When the combined write fails
+        each message is stored on its own, its bad records are isolated and
+        dead-lettered by its writer and a message still failing is rejected.
+        A database error (see ``TRANSIENT_ERRORS``) stops the consumer,
+        leaving the messages to be redelivered.
+        """
+        try:
+            with transaction.atomic():
+                # Saved instances per message, in the order of the batches
+                saved = []
+                for writer, items in batches.items():
+                    saved.extend(writer.save_many([data_list for _, data_list, _ in items]))
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            logger.warning(f"Batch write failed, storing the messages one by one: {e}")
+            saved = [
+                self.store_one(writer, message, data_list, batch_id)
+                for writer, items in batches.items() for message, data_list, batch_id in items
+            ]
+
+        messages = [(writer, message, batch_id) for writer, items in batches.items() for message, _, batch_id in items]
+        for (writer, message, batch_id), instances in zip(messages, saved):
+            # Rejected messages were finished by store_one
+            if instances is not None:
+                message.ack()
+                writer.finish_batch(batch_id, len(instances))
+        saved = [chunk or [] for chunk in saved]
+        for writer in batches:
+            instances = [instance for (owner, _, _), chunk in zip(messages, saved) if owner is writer for instance in chunk]
+            writer.after_save(instances)
+            self.stored += len(instances)
+        logger.info(f"Stored {sum(len(chunk) for chunk in saved)} device data from {len(messages)} messages.")
+
+    def store_one(self, writer, message, data_list, batch_id):
+        """
+        Store the records of one message, returning the saved instances or
+        ``None`` when the message was rejected.
+        """
+        try:
+            return writer.write(data_list)
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            logger.error(f"Rejecting a message of {len(data_list)} records that failed to store: {e}")
+            message.reject(requeue=False)
+            writer.finish_batch(batch_id, failed=True)
+            return None
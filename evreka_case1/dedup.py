@@ -0,0 +1,131 @@
+"""
+Duplicate suppression of records resent by devices after a lost ACK.
+
+With ``INGEST_DEDUP`` enabled every record carrying a timestamp gets a key
+hashed from its device ID and timestamp (``key``), or also from its location
+and speed (``payload``). The key is unique in the history tables, so
+duplicates are never stored, and the ingest endpoints keep the most recently
+seen keys in memory to drop most duplicates before they reach the broker.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from evreka_case1.metrics import RECORDS_DUPLICATE
+
+DEDUP_MODES = ('off', 'key', 'payload')
+
+CENTS = Decimal('0.01')
+
+
+def dedup_enabled():
+    return settings.INGEST_DEDUP != 'off'
+
+
+def speed_key(speed):
+    """
+    The speed rounded to the cents stored by the history tables. Speeds too
+    large to be quantized fall back to their repr, speeds that aren't numbers
+    to their string (both fail to store anyway).
+    """
+    try:
+        return str(Decimal(str(speed)).quantize(CENTS))
+    except InvalidOperation:
+        pass
+    try:
+        return repr(float(speed))
+    except (TypeError, ValueError):
+        return str(speed)
+
+
+def dedup_key(record, mode=None):
+    """
+    Return the deduplication key of a validated record, ``None`` when
+    deduplication is off or the record has no timestamp of its own.
+    """
+    mode = mode or settings.INGEST_DEDUP
+    timestamp = record.get('timestamp')
+    if mode == 'off' or timestamp is None:
+        return None
+    if isinstance(timestamp, str):
+        timestamp = parse_datetime(timestamp)
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    parts = [str(record['device_id']), timestamp.astimezone(dt_timezone.utc).isoformat()]
+    if mode == 'payload':
+        parts.append(str(record['location']))
+        parts.append(speed_key(record['speed']))
+    return hashlib.blake2b('\x1f'.join(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class RecentKeys:
+    """
+    Bounded set of the last ``max_size`` keys seen, the oldest are evicted first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def filter(self, records):
+        """
+        Drop the records whose key has been seen recently and remember the
+        keys of the others. Returns the new records and their keys, to
+        ``forget`` if they could not be queued.
+        """
+        fresh = []
+        added = []
+        with self.lock:
+            for record in records:
+                key = dedup_key(record)
+                if key is None:
+                    fresh.append(record)
+                elif key in self.keys:
+                    self.keys.move_to_end(key)
+                else:
+                    self.keys[key] = None
+                    added.append(key)
+                    fresh.append(record)
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+        return fresh, added
+
+    def forget(self, keys):
+        with self.lock:
+            for key in keys:
+                self.keys.pop(key, None)
+
+
+_recent_keys = {}
+_recent_keys_lock = threading.Lock()
+
+
+def get_recent_keys(name):
+    """
+    Return the process wide recent keys filter registered under ``name``.
+    """
+    with _recent_keys_lock:
+        if name not in _recent_keys:
+            _recent_keys[name] = RecentKeys(settings.INGEST_DEDUP_RECENT_KEYS)
+        return _recent_keys[name]
+
+
+def drop_recent_duplicates(name, records):
+    """
+    Filter ``records`` through the recent keys of ``name`` when deduplication
+    is enabled. Returns the records to queue and the keys to forget on failure.
+    """
+    if not dedup_enabled():
+        return records, []
+    fresh, keys = get_recent_keys(name).filter(records)
+    if len(fresh) < len(records):
+        RECORDS_DUPLICATE.labels(name).inc(len(records) - len(fresh))
+    return fresh, keys
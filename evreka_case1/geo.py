@@ -0,0 +1,105 @@
+"""
+Numeric coordinates and a fixed lat/lon grid for area queries.
+
+Every stored record gets its ``latitude``/``longitude`` parsed from the free
+form ``location`` and the integer key of the grid cell it falls in. Cells are
+numbered row by row from the south west corner, so the cells of one grid row
+inside a bounding box form a contiguous range of keys and a bounding box
+query becomes a few indexed range lookups on ``cell``, followed by an exact
+filter on the coordinates.
+"""
+import math
+import re
+from django.db.models import Q
+
+# Changing the cell size invalidates every stored cell key
+CELL_SIZE = 0.1
+COLUMNS = round(360 / CELL_SIZE)
+ROWS = round(180 / CELL_SIZE)
+
+# Bounding boxes spanning more grid rows are merged into this many range lookups
+MAX_CELL_RANGES = 32
+
+LOCATION_PATTERN = re.compile(r'^\s*\(?\s*([-+]?\d+(?:\.\d*)?|[-+]?\.\d+)\s*[,; ]\s*([-+]?\d+(?:\.\d*)?|[-+]?\.\d+)\s*\)?\s*$')
+
+
+def parse_location(location):
+    """
+    Parse a ``"latitude, longitude"`` location string, returning
+    ``(latitude, longitude)`` or ``(None, None)`` when it holds no valid coordinates.
+    """
+    match = LOCATION_PATTERN.match(location or '')
+    if match is None:
+        return None, None
+    latitude, longitude = float(match.group(1)), float(match.group(2))
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None, None
+    return latitude, longitude
+
+
+def grid_position(latitude, longitude):
+    row = min(int(math.floor((latitude + 90) / CELL_SIZE)), ROWS - 1)
+    column = min(int(math.floor((longitude + 180) / CELL_SIZE)), COLUMNS - 1)
+    return row, column
+
+
+def cell_key(latitude, longitude):
+    row, column = grid_position(latitude, longitude)
+    return row * COLUMNS + column
+
+
+def location_fields(location):
+    """
+    Return the ``latitude``, ``longitude`` and ``cell`` model field values of a location.
+    """
+    latitude, longitude = parse_location(location)
+    if latitude is None:
+        return {'latitude': None, 'longitude': None, 'cell': None}
+    return {'latitude': latitude, 'longitude': longitude, 'cell': cell_key(latitude, longitude)}
+
+
+def parse_bbox(value):
+    """
+    Parse a ``min_lon,min_lat,max_lon,max_lat`` bounding box.
+    """
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(','))
+    except ValueError:
+        raise ValueError(f'Invalid bbox: {value}, expected min_lon,min_lat,max_lon,max_lat')
+    if not all(math.isfinite(part) for part in (min_lon, min_lat, max_lon, max_lat)):
+        raise ValueError(f'Invalid bbox: {value}')
+    if not (-180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError(f'Invalid bbox: {value}, coordinates are out of range or not ordered min to max')
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def cell_ranges(min_lon, min_lat, max_lon, max_lat, max_ranges=MAX_CELL_RANGES):
+    """
+    Return the ``(first, last)`` cell key ranges covering the bounding box.
+
+    One range per grid row, consecutive rows are merged into a single range
+    when there would be more than ``max_ranges``. Merged ranges also cover
+    cells outside of the box, which the exact coordinate filter drops.
+    """
+    min_row, min_column = grid_position(min_lat, min_lon)
+    max_row, max_column = grid_position(max_lat, max_lon)
+    rows = max_row - min_row + 1
+    rows_per_range = math.ceil(rows / max_ranges)
+    return [
+        (row * COLUMNS + min_column, min(row + rows_per_range - 1, max_row) * COLUMNS + max_column)
+        for row in range(min_row, max_row + 1, rows_per_range)
+    ]
+
+
+def filter_bbox(queryset, bbox):
+    """
+    Filter a queryset to the records inside a ``(min_lon, min_lat, max_lon, max_lat)`` box.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    cells = Q()
+    for first, last in cell_ranges(*bbox):
+        cells |= Q(cell__range=(first, last))
+    return queryset.filter(cells).filter(
+        latitude__range=(min_lat, max_lat),
+        longitude__range=(min_lon, max_lon),
+    )
@@ -0,0 +1,390 @@
+import logging
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from celery import group
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, DataError, IntegrityError, InterfaceError, OperationalError, router, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from evreka_case1.dedup import dedup_enabled, dedup_key
+from evreka_case1.geo import location_fields
+from evreka_case1.metrics import BULK_CREATE_BATCH_SIZE, BULK_CREATE_SECONDS, RECORDS_DEAD_LETTERED, RECORDS_DUPLICATE
+from evreka_case1.routing import route_records
+
+logger = logging.getLogger(__name__)
+
+# Errors caused by the records themselves, rejected by the database or by
+# ``build``. Anything else (a lost database connection, a bug) fails the whole
+# batch so it can be retried.
+RECORD_ERRORS = (IntegrityError, DataError, ValidationError)
+
+# Errors of the database itself, the records may be stored once it's back
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+REQUIRED_FIELDS = ('device_id', 'location', 'speed')
+
+
+def describe_error(error):
+    if isinstance(error, ValidationError):
+        return f'{type(error).__name__}: {"; ".join(error.messages)}'
+    return f'{type(error).__name__}: {error}'
+
+
+def parse_timestamp(value):
+    """
+    Turn the timestamp of a record into a datetime. Records coming through
+    the broker carry ISO 8601 strings, records without one get the current time.
+    """
+    if value is None:
+        return timezone.now()
+    if isinstance(value, str):
+        try:
+            value = parse_datetime(value)
+        except ValueError:
+            value = None
+    if not isinstance(value, datetime):
+        raise ValidationError({'timestamp': ['Enter a valid date/time.']})
+    return value
+
+
+def parse_speed(value, field):
+    """
+    Turn the speed of a record into a ``Decimal`` rounded to the places of
+    the model ``field``, raising ``ValidationError`` when it doesn't fit the
+    column (the insert would fail for the whole batch otherwise).
+    """
+    speed = field.to_python(value)
+    if speed is None:
+        raise ValidationError({'speed': ['This field cannot be null.']})
+    try:
+        speed = speed.quantize(Decimal(1).scaleb(-field.decimal_places))
+    except InvalidOperation:
+        speed = None
+    if speed is None or len(speed.as_tuple().digits) > field.max_digits:
+        raise ValidationError({'speed': [
+            f'Ensure that there are no more than {field.max_digits - field.decimal_places} '
+            f'digits before the decimal point.'
+        ]})
+    return speed
+
+
+def check_record(data):
+    """
+    Raise ``ValidationError`` for records that can't be built: not an object,
+    missing a field or with a location that isn't a string.
+    """
+    if not isinstance(data, dict):
+        raise ValidationError('Expected an object.')
+    missing = [field for field in REQUIRED_FIELDS if field not in data]
+    if missing:
+        raise ValidationError({field: ['This field is required.'] for field in missing})
+    if not isinstance(data['location'], str):
+        raise ValidationError({'location': ['Not a valid string.']})
+
+
+class IngestWriter:
+    """
+    Stores batches of validated device data records into ``model``.
+
+    Storing is split in three steps so records of several batches can be
+    written in one transaction: ``build`` the instances, ``save`` them with
+    one multi-row insert, then run the ``after_save`` hooks (latest store,
+    rollups) once the rows are committed.
+
+    Records that can't be stored are isolated by bisecting the failing batch
+    and written to ``dead_letter_model`` with their error, so one bad record
+    never fails, nor gets retried with, the rest of its batch.
+    """
+
+    def __init__(self, model, dead_letter_model=None, batch_model=None, after_save=()):
+        self.model = model
+        self.dead_letter_model = dead_letter_model
+        self.batch_model = batch_model
+        self.label = model._meta.label
+        self.after_save_hooks = list(after_save)
+
+    @property
+    def using(self):
+        return router.db_for_write(self.model)
+
+    def build(self, data_list):
+        """
+        Return the model instances of ``data_list``, raising ``ValidationError``
+        for the first record that can't be parsed.
+        """
+        mode = settings.INGEST_DEDUP
+        speed_field = self.model._meta.get_field('speed')
+        instances = []
+        for data in data_list:
+            check_record(data)
+            timestamp = parse_timestamp(data.get('timestamp'))
+            instances.append(self.model(
+                device_id=data['device_id'],
+                location=data['location'],
+                speed=parse_speed(data['speed'], speed_field),
+                timestamp=timestamp,
+                dedup_key=dedup_key(data, mode),
+                **location_fields(data['location'])
+            ))
+        return instances
+
+    def drop_duplicates(self, instances, locking=False):
+        """
+        Drop the instances whose deduplication key is repeated in the batch or
+        already stored, so the after save hooks only see new records. With
+        ``locking`` the stored keys are read with a locking read, which also
+        sees rows committed since the transaction started.
+        """
+        unique = {}
+        for instance in instances:
+            key = instance.dedup_key if instance.dedup_key is not None else id(instance)
+            unique.setdefault(key, instance)
+        keys = [instance.dedup_key for instance in unique.values() if instance.dedup_key is not None]
+        stored = set()
+        queryset = self.model.objects.using(self.using)
+        if locking:
+            queryset = queryset.select_for_update()
+        for start in range(0, len(keys), 1000):
+            stored.update(queryset.filter(
+                dedup_key__in=keys[start:start + 1000]
+            ).values_list('dedup_key', flat=True))
+        new = [instance for instance in unique.values() if instance.dedup_key not in stored]
+        if len(new) < len(instances):
+            RECORDS_DUPLICATE.labels(self.label).inc(len(instances) - len(new))
+        return new
+
+    def bulk_create(self, instances):
+        with BULK_CREATE_SECONDS.labels(self.label).time():
+            self.model.objects.bulk_create(
+                instances, batch_size=settings.INGEST_BULK_CREATE_BATCH_SIZE
+            )
+
+    def save(self, instances):
+        """
+        Insert the instances, returning the ones that were new. Must be
+        called in a transaction.
+
+        With deduplication enabled the unique key is also enforced by the
+        database. When a concurrent insert of the same records wins the race
+        the insert is rolled back to a savepoint and retried without the
+        records stored meanwhile. Conflicts aren't ignored by the database,
+        which would also turn data errors into warnings on MySQL
+        (``INSERT IGNORE``) instead of dead letters.
+        """
+        if not dedup_enabled():
+            self.bulk_create(instances)
+        else:
+            instances = self.drop_duplicates(instances)
+            try:
+                with transaction.atomic(using=self.using):
+                    self.bulk_create(instances)
+            except IntegrityError:
+                instances = self.drop_duplicates(instances, locking=True)
+                self.bulk_create(instances)
+        BULK_CREATE_BATCH_SIZE.labels(self.label).observe(len(instances))
+        return instances
+
+    def after_save(self, instances):
+        for hook in self.after_save_hooks:
+            hook(instances)
+
+    def isolate(self, data_list):
+        """
+        Store ``data_list`` halving every failing slice until the bad records
+        are found. Returns the saved instances and the rejected
+        ``(record, error)`` pairs, bisecting costs about ``2 * log2(n)``
+        extra inserts per bad record.
+        """
+        saved = []
+        rejected = []
+        pending = [data_list]
+        while pending:
+            chunk = pending.pop()
+            try:
+                with transaction.atomic(using=self.using):
+                    instances = self.save(self.build(chunk))
+            except RECORD_ERRORS as e:
+                if len(chunk) == 1:
+                    rejected.append((chunk[0], e))
+                else:
+                    middle = len(chunk) // 2
+                    pending.append(chunk[middle:])
+                    pending.append(chunk[:middle])
+            else:
+                saved.extend(instances)
+        return saved, rejected
+
+    def dead_letter(self, rejected):
+        if not rejected:
+            return
+        RECORDS_DEAD_LETTERED.labels(self.label).inc(len(rejected))
+        if self.dead_letter_model is None:
+            return
+        self.dead_letter_model.objects.bulk_create([
+            self.dead_letter_model(payload=record, error=describe_error(error))
+            for record, error in rejected
+        ])
+
+    def write(self, data_list):
+        """
+        Save one batch in a single transaction, isolating the bad records if
+        it fails. Returns the saved instances.
+        """
+        try:
+            with transaction.atomic(using=self.using):
+                instances = self.save(self.build(data_list))
+        except RECORD_ERRORS:
+            instances, rejected = self.isolate(data_list)
+            self.dead_letter(rejected)
+        return instances
+
+    def save_many(self, data_lists):
+        """
+        Save several batches with one multi-row insert, returning the new
+        instances of every batch.
+        """
+        built = self.build([record for data_list in data_lists for record in data_list])
+        new = {id(instance) for instance in self.save(built)}
+        saved = []
+        start = 0
+        for data_list in data_lists:
+            saved.append([instance for instance in built[start:start + len(data_list)] if id(instance) in new])
+            start += len(data_list)
+        return saved
+
+    def write_many(self, data_lists):
+        """
+        Save several batches in a single transaction, falling back to writing
+        them one by one to isolate the bad records. Returns the saved
+        instances of every batch.
+        """
+        try:
+            with transaction.atomic(using=self.using):
+                return self.save_many(data_lists)
+        except RECORD_ERRORS as e:
+            logger.warning(f"Batch write failed, isolating the bad records: {e}")
+            return [self.write(data_list) for data_list in data_lists]
+
+    def store(self, data_list):
+        """
+        Store one batch, returning the saved instances.
+        """
+        instances = self.write(data_list)
+        self.after_save(instances)
+        return instances
+
+    def finish_batch(self, batch_id, stored=0, failed=False):
+        finish_batch_chunk(self.batch_model, batch_id, stored, failed)
+
+
+def replay_dead_letters(writer, letters, chunk_size=1000):
+    """
+    Store the records of the ``letters`` queryset again. Replayed letters are
+    deleted, the ones failing again keep their row with the new error.
+    Returns the number of replayed and failed letters.
+    """
+    replayed = failed = 0
+    last_pk = 0
+    while True:
+        chunk = list(letters.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not chunk:
+            return replayed, failed
+        last_pk = chunk[-1].pk
+        by_record = {id(letter.payload): letter for letter in chunk}
+        instances, rejected = writer.isolate([letter.payload for letter in chunk])
+        retried = []
+        for record, error in rejected:
+            letter = by_record.pop(id(record))
+            letter.error = describe_error(error)
+            letter.attempts += 1
+            letter.updated_at = timezone.now()
+            retried.append(letter)
+        with transaction.atomic(using=writer.using):
+            letters.model.objects.filter(pk__in=[letter.pk for letter in by_record.values()]).delete()
+            letters.model.objects.bulk_update(retried, ['error', 'attempts', 'updated_at'])
+        writer.after_save(instances)
+        replayed += len(by_record)
+        failed += len(retried)
+
+
+def split_chunks(records, chunk_size):
+    return [records[start:start + chunk_size] for start in range(0, len(records), chunk_size)]
+
+
+def dispatch_chunks(task, records, chunk_size, batch_model=None, bulk=False):
+    """
+    Queue ``records`` for ``task`` in tasks of at most ``chunk_size`` records.
+
+    Larger payloads are sent as a Celery group, so the chunks are stored by
+    all workers in parallel and no message exceeds the broker frame limits.
+    The records are routed to the device shard queues, or the bulk queue
+    with ``bulk`` (see ``route_records``). The tasks keep no result. With a
+    ``batch_model`` the batch is tracked in it and its id, to poll with
+    ``batch_status``, is returned.
+    """
+    chunks = [
+        (queue, chunk)
+        for queue, routed in route_records(records, bulk)
+        for chunk in split_chunks(routed, chunk_size)
+    ]
+    batch_id = None
+    if batch_model is not None:
+        batch_id = str(uuid.uuid4())
+        batch_model.objects.create(batch_id=batch_id, records=len(records), chunks=len(chunks))
+    signatures = [
+        ((chunk,) if batch_id is None else (chunk, batch_id), {} if queue is None else {'queue': queue})
+        for queue, chunk in chunks
+    ]
+    if len(signatures) == 1:
+        args, options = signatures[0]
+        task.apply_async(args, **options)
+    else:
+        group(task.si(*args).set(**options) for args, options in signatures).apply_async()
+    return batch_id
+
+
+def finish_batch_chunk(batch_model, batch_id, stored=0, failed=False):
+    """
+    Count a processed chunk of a tracked batch. The status is informational,
+    so a failure is logged instead of failing the chunk.
+    """
+    if batch_id is None or batch_model is None:
+        return
+    counter = 'failed_chunks' if failed else 'completed_chunks'
+    try:
+        batch_model.objects.filter(batch_id=batch_id).update(**{
+            counter: F(counter) + 1,
+            'stored': F('stored') + stored,
+            'updated_at': timezone.now(),
+        })
+    except DatabaseError as e:
+        logger.error(f"Error updating ingest batch {batch_id}: {e}")
+
+
+def batch_status(batch):
+    if batch.failed_chunks:
+        status = 'failed'
+    elif batch.completed_chunks == batch.chunks:
+        status = 'completed'
+    else:
+        status = 'pending'
+    return {
+        'batch_id': str(batch.batch_id),
+        'status': status,
+        'chunks': batch.chunks,
+        'completed': batch.completed_chunks,
+        'failed': batch.failed_chunks,
+        'records': batch.records,
+        'stored': batch.stored,
+    }
+
+
+def expire_batches(batch_model, ttl):
+    """
+    Delete the tracked batches not updated for ``ttl`` seconds, returning their number.
+    """
+    count, _ = batch_model.objects.filter(updated_at__lt=timezone.now() - timedelta(seconds=ttl)).delete()
+    return count
@@ -0,0 +1,199 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, router
+
+
+class LocalLRUCache:
+    """
+    Small thread safe in-process cache with LRU eviction and a per entry TTL.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class LatestCache:
+    """
+    Read-through cache of the serialized latest record of each device.
+
+    Lookups go to a process local LRU first, then to the Django cache
+    configured by ``LATEST_CACHE_ALIAS`` and finally to the database. Ingest
+    tasks write through to the Django cache, so a shared backend (Redis,
+    Memcached) makes new positions visible to every web process right away.
+    The Django cache is skipped while ``LATEST_CACHE_TIMEOUT`` is 0, the
+    default with a per-process backend the workers can't update.
+    """
+
+    def __init__(self, prefix, serialize):
+        self.prefix = prefix
+        self.serialize = serialize
+        self.local = LocalLRUCache(settings.LATEST_CACHE_LOCAL_SIZE, settings.LATEST_CACHE_LOCAL_TTL)
+
+    @property
+    def cache(self):
+        return caches[settings.LATEST_CACHE_ALIAS]
+
+    def make_key(self, device_id):
+        # Device ids are free form, hash them into a key every backend accepts
+        digest = hashlib.md5(device_id.encode('utf-8')).hexdigest()
+        return f'{self.prefix}:latest:{digest}'
+
+    def get(self, device_id, load):
+        """
+        Return the serialized latest record of the device, calling ``load`` to
+        fetch the instance from the database on a cache miss.
+        """
+        key = self.make_key(device_id)
+        data = self.local.get(key)
+        if data is not None:
+            return data
+
+        timeout = settings.LATEST_CACHE_TIMEOUT
+        data = self.cache.get(key) if timeout else None
+        if data is None:
+            instance = load()
+            if instance is None:
+                return None
+            data = dict(self.serialize(instance))
+            if timeout:
+                self.cache.set(key, data, timeout)
+        self.local.set(key, data)
+        return data
+
+    def update(self, instances):
+        """
+        Write the given latest records through to the cache.
+        """
+        data = {}
+        for instance in instances:
+            key = self.make_key(instance.device_id)
+            data[key] = dict(self.serialize(instance))
+            self.local.set(key, data[key])
+        if data and settings.LATEST_CACHE_TIMEOUT:
+            self.cache.set_many(data, settings.LATEST_CACHE_TIMEOUT)
+
+
+LATEST_FIELDS = ('device_id', 'timestamp', 'location', 'speed')
+
+
+def upsert_sql(connection, latest_model, rows):
+    """
+    Build the upsert of ``rows`` into ``latest_model``. The timestamp guard is
+    part of the statement, so a concurrent older batch can't win the race.
+    """
+    quote = connection.ops.quote_name
+    table = quote(latest_model._meta.db_table)
+    device_id, timestamp, location, speed = [
+        quote(latest_model._meta.get_field(name).column) for name in LATEST_FIELDS
+    ]
+    placeholders = ', '.join(['(%s, %s, %s, %s)'] * len(rows))
+    insert = f'INSERT INTO {table} ({device_id}, {timestamp}, {location}, {speed}) VALUES {placeholders}'
+    if connection.vendor == 'mysql':
+        # The assignments run left to right, the timestamp has to be the last one
+        newer = f'VALUES({timestamp}) >= {timestamp}'
+        return (
+            f'{insert} ON DUPLICATE KEY UPDATE '
+            f'{location} = IF({newer}, VALUES({location}), {location}), '
+            f'{speed} = IF({newer}, VALUES({speed}), {speed}), '
+            f'{timestamp} = IF({newer}, VALUES({timestamp}), {timestamp})'
+        )
+    return (
+        f'{insert} ON CONFLICT ({device_id}) DO UPDATE SET '
+        f'{timestamp} = excluded.{timestamp}, {location} = excluded.{location}, {speed} = excluded.{speed} '
+        f'WHERE excluded.{timestamp} >= {table}.{timestamp}'
+    )
+
+
+def upsert_latest(latest_model, instances, chunk_size=1000):
+    """
+    Upsert the newest of the given records per device into ``latest_model``.
+
+    A stored latest record is only replaced by one at least as recent, in
+    the same statement, so batches processed out of order (or concurrently)
+    never move a device back in time. Returns the latest model instances of
+    the devices as stored afterwards.
+    """
+    newest = {}
+    for instance in instances:
+        current = newest.get(instance.device_id)
+        if current is None or instance.timestamp >= current.timestamp:
+            newest[instance.device_id] = instance
+    if not newest:
+        return []
+
+    connection = connections[router.db_for_write(latest_model)]
+    fields = [latest_model._meta.get_field(name) for name in LATEST_FIELDS]
+    rows = [
+        [field.get_db_prep_save(getattr(instance, field.attname), connection) for field in fields]
+        for instance in newest.values()
+    ]
+    device_ids = list(newest)
+    stored = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            cursor.execute(upsert_sql(connection, latest_model, chunk), [value for row in chunk for value in row])
+    for start in range(0, len(device_ids), chunk_size):
+        stored.extend(latest_model.objects.using(connection.alias).filter(
+            device_id__in=device_ids[start:start + chunk_size]
+        ))
+    return stored
+
+
+def iter_latest(latest_model, device_ids=None, chunk_size=2000):
+    """
+    Yield ``(id, device_id, timestamp, location, speed)`` tuples from the latest store.
+
+    The latest store already holds the newest record per device, so this is
+    one indexed query per ``chunk_size`` devices instead of one ORDER BY query
+    per device. Without ``device_ids`` every device is returned, paging
+    through the unique ``device_id`` index so memory stays flat.
+    """
+    queryset = latest_model.objects.values_list('id', 'device_id', 'timestamp', 'location', 'speed')
+
+    if device_ids is not None:
+        device_ids = list(dict.fromkeys(device_ids))
+        for start in range(0, len(device_ids), chunk_size):
+            yield from queryset.filter(device_id__in=device_ids[start:start + chunk_size])
+        return
+
+    last_device_id = None
+    while True:
+        chunk = queryset.order_by('device_id')
+        if last_device_id is not None:
+            chunk = chunk.filter(device_id__gt=last_device_id)
+        rows = list(chunk[:chunk_size])
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        last_device_id = rows[-1][1]
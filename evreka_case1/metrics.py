@@ -0,0 +1,239 @@
+"""
+Process local counters and histograms exposed in the Prometheus text format.
+
+Web processes serve them on ``metrics/``, the TCP server and the Celery
+worker processes on a side port (``METRICS_TCP_PORT``, ``METRICS_CELERY_PORT``).
+Updating a metric is a dictionary lookup and an addition under a lock, so it
+can be used on the ingest hot path.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, labelvalues):
+        yield f'{name}{format_labels(labelnames, labelvalues)} {format_value(self.value)}'
+
+
+class GaugeValue:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labelnames, labelvalues):
+        yield f'{name}{format_labels(labelnames, labelvalues)} {format_value(self.value)}'
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def samples(self, name, labelnames, labelvalues):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float('inf')), counts):
+            cumulative += count
+            labels = format_labels((*labelnames, 'le'), (*labelvalues, format_value(bound)))
+            yield f'{name}_bucket{labels} {cumulative}'
+        labels = format_labels(labelnames, labelvalues)
+        yield f'{name}_sum{labels} {format_value(total)}'
+        yield f'{name}_count{labels} {cumulative}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *labelvalues):
+        child = self.children.get(labelvalues)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(labelvalues, self.new_value())
+        return child
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        for labelvalues, child in list(self.children.items()):
+            yield from child.samples(self.name, self.labelnames, labelvalues)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def new_value(self):
+        return CounterValue()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def new_value(self):
+        return GaugeValue()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_value(self):
+        return HistogramValue(self.buckets)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = [line for metric in self.metrics for line in metric.render()]
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+RECORDS_RECEIVED = REGISTRY.counter(
+    'ingest_records_received_total', 'Records received by an ingest endpoint.', ['source'])
+RECORDS_VALIDATED = REGISTRY.counter(
+    'ingest_records_validated_total', 'Received records that passed validation.', ['source'])
+RECORDS_REJECTED = REGISTRY.counter(
+    'ingest_records_rejected_total', 'Received records rejected by validation.', ['source'])
+DISPATCH_SECONDS = REGISTRY.histogram(
+    'ingest_dispatch_seconds', 'Time spent publishing a batch to the broker.', ['task'])
+TASK_QUEUE_LAG_SECONDS = REGISTRY.histogram(
+    'celery_task_queue_lag_seconds', 'Time between publishing a task and a worker starting it.', ['task'])
+BULK_CREATE_SECONDS = REGISTRY.histogram(
+    'ingest_bulk_create_seconds', 'Duration of the bulk_create of an ingest batch.', ['model'])
+BULK_CREATE_BATCH_SIZE = REGISTRY.histogram(
+    'ingest_bulk_create_batch_size', 'Records stored by one bulk_create.', ['model'], buckets=SIZE_BUCKETS)
+RECORDS_DUPLICATE = REGISTRY.counter(
+    'ingest_records_duplicate_total',
+    'Duplicate records dropped by the recent keys filter of an app or on insert into a model.', ['source'])
+RECORDS_DEAD_LETTERED = REGISTRY.counter(
+    'ingest_records_dead_lettered_total', 'Records that could not be stored and were dead-lettered.', ['model'])
+ADMISSION_REJECTED = REGISTRY.counter(
+    'ingest_admission_rejected_total', 'Ingest requests rejected by admission control.', ['source', 'reason'])
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    'ingest_admission_wait_seconds', 'Time spent waiting for ingest capacity (TCP backpressure).', ['source'])
+ADMISSION_IN_FLIGHT = REGISTRY.gauge(
+    'ingest_in_flight_records', 'Admitted records not yet handed to the broker.', ['source'])
+INGEST_QUEUE_DEPTH = REGISTRY.gauge(
+    'ingest_queue_depth', 'Messages waiting in the ingest queue, as last seen by admission control.', ['queue'])
+SPOOL_PENDING_BYTES = REGISTRY.gauge(
+    'ingest_spool_pending_bytes', 'Bytes of spooled records not yet forwarded to the broker.', ['spool'])
+SPOOL_FORWARD_FAILURES = REGISTRY.counter(
+    'ingest_spool_forward_failures_total', 'Failed attempts to forward spooled records to the broker.', ['spool'])
+DIRECT_WRITER_PENDING = REGISTRY.gauge(
+    'ingest_direct_writer_pending_records', 'Records queued for the direct pipeline writer of an app.', ['writer'])
+DIRECT_WRITE_FAILURES = REGISTRY.counter(
+    'ingest_direct_write_failures_total', 'Failed batch writes of a direct pipeline writer, retried.', ['writer'])
+REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_seconds', 'Time spent in a view until the response is returned.', ['view'])
+REQUEST_QUERY_SECONDS = REGISTRY.histogram(
+    'http_request_query_seconds', 'Time spent in SQL queries while building the response.', ['view'])
+
+
+def record_validation(source, received, rejected):
+    RECORDS_RECEIVED.labels(source).inc(received)
+    RECORDS_VALIDATED.labels(source).inc(received - rejected)
+    RECORDS_REJECTED.labels(source).inc(rejected)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """
+    Serve the metrics of this process on a side port from a daemon thread.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
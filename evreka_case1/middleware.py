@@ -0,0 +1,34 @@
+import time
+from django.db import connection
+from .metrics import REQUEST_QUERY_SECONDS, REQUEST_SECONDS
+
+
+class MetricsMiddleware:
+    """
+    Record the time spent in every view and in its SQL queries, labelled by URL name.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        query_time = 0.0
+
+        def timed_query(execute, sql, params, many, context):
+            nonlocal query_time
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                query_time += time.perf_counter() - started
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(timed_query):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        REQUEST_SECONDS.labels(view).observe(elapsed)
+        REQUEST_QUERY_SECONDS.labels(view).observe(query_time)
+        return response
@@ -0,0 +1,109 @@
+import base64
+import binascii
+from datetime import datetime
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def encode_cursor(timestamp, pk):
+    """
+    Encode a ``(timestamp, id)`` position as an opaque cursor string.
+    """
+    position = f'{timestamp.isoformat()}|{pk}'.encode('utf-8')
+    return base64.urlsafe_b64encode(position).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created by ``encode_cursor``, raising ``ValueError`` when invalid.
+    """
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, pk = position.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError(f'Invalid cursor: {cursor}')
+
+
+def seek(queryset, timestamp, pk):
+    """
+    Filter a queryset ordered by ``-timestamp, -id`` to the rows after the given position.
+
+    The redundant ``timestamp <= ...`` condition lets the database turn the seek
+    into a range scan on the ``(device_id, timestamp)`` index.
+    """
+    return queryset.filter(timestamp__lte=timestamp).filter(
+        Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk)
+    )
+
+
+def keyset_iterator(queryset, position, chunk_size=2000):
+    """
+    Iterate over a queryset ordered by ``-timestamp, -id`` in seeked chunks.
+
+    ``position`` returns the ``(timestamp, id)`` of a row. Every chunk is a
+    separate bounded query, so memory stays constant even with database
+    drivers that buffer the whole result of a query client side (mysqlclient).
+    """
+    last = None
+    while True:
+        chunk = queryset if last is None else seek(queryset, *position(last))
+        rows = list(chunk[:chunk_size])
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1]
+
+
+class KeysetPagination(PageNumberPagination):
+    """
+    Page number pagination with an opt-in keyset mode.
+
+    Passing ``?cursor=`` (empty for the first page) switches to seeking on
+    ``(timestamp, id)``: every page is a single ``LIMIT`` query without an
+    ``OFFSET`` scan or a ``COUNT(*)``. The queryset must be ordered by
+    ``-timestamp, -id``.
+    """
+    cursor_query_param = 'cursor'
+    keyset = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            try:
+                queryset = seek(queryset, *decode_cursor(cursor))
+            except ValueError as e:
+                raise NotFound(str(e))
+
+        # Fetch one extra row to know whether there is a next page
+        rows = list(queryset[:page_size + 1])
+        page = rows[:page_size]
+        self.next_position = None
+        if len(rows) > page_size:
+            self.next_position = (page[-1].timestamp, page[-1].pk)
+        return page
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if self.next_position is None:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, encode_cursor(*self.next_position))
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
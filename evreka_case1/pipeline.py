@@ -0,0 +1,263 @@
+"""
+Broker-less ``direct`` ingest pipeline.
+
+With ``INGEST_PIPELINE = 'direct'`` the web workers and the TCP server don't
+publish validated records to RabbitMQ for the Celery workers. They hand
+them to a ``DirectWriter``, a background thread of the receiving process
+that stores them with the app's ``IngestWriter`` in multi-row inserts, once
+``max_records`` are queued or ``max_wait_ms`` after the first of them.
+
+The thread keeps its own database connection open for its whole life, it's
+only replaced after an error. Records are queued in memory: they are
+acknowledged before they are stored and the ones still queued when the
+process is killed are lost, a normal shutdown drains the queue first.
+"""
+import atexit
+import logging
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.db import close_old_connections, connections
+from evreka_case1.admission import AdmissionRejected
+from evreka_case1.ingest import TRANSIENT_ERRORS
+from evreka_case1.metrics import ADMISSION_REJECTED, DIRECT_WRITE_FAILURES, DIRECT_WRITER_PENDING
+
+logger = logging.getLogger(__name__)
+
+INGEST_PIPELINES = ('celery', 'direct')
+
+WRITER_FULL = 'writer_full'
+
+
+def direct_pipeline():
+    return settings.INGEST_PIPELINE == 'direct'
+
+
+class WriterFull(AdmissionRejected):
+    """
+    Raised when the records don't fit in the queue of a direct writer.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(WRITER_FULL, retry_after)
+
+
+class DirectWriter:
+    """
+    Store records handed to ``add`` with ``writer`` from a background thread.
+
+    At most ``max_pending`` records are queued, ``add`` waits up to
+    ``add_timeout`` seconds for room before raising ``WriterFull``. A write
+    failing with a database error (see ``TRANSIENT_ERRORS``) is retried every
+    ``retry_interval`` seconds, up to ``max_attempts`` times. After that, or
+    on any other error, the batches of the write are stored one by one so a
+    failing batch doesn't hold up the ones queued behind it. The records of
+    a batch failing on its own are dropped.
+    """
+
+    def __init__(self, writer, max_records, max_wait_ms, max_pending, add_timeout=1.0,
+                 retry_interval=1.0, max_attempts=5, retry_after=1.0, name='direct-writer'):
+        self.writer = writer
+        self.max_records = max_records
+        self.max_wait = max_wait_ms / 1000
+        self.max_pending = max_pending
+        self.add_timeout = add_timeout
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.retry_after = retry_after
+        self.name = name
+        # (records, batch_id, sequence) in arrival order
+        self._items = []
+        self._pending = 0
+        self._added = 0
+        self._written = 0
+        # Whether the batches of the waiting ``add`` calls were stored, by sequence
+        self._waiting = {}
+        self._deadline = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return self._pending
+
+    def add(self, records, batch_model=None, wait=False):
+        """
+        Queue ``records`` to be stored. With a ``batch_model`` the batch is
+        tracked in it and its id is returned. With ``wait`` it only returns
+        once they have been stored, and raises ``RuntimeError`` if they couldn't be.
+        """
+        batch_id = None
+        with self._condition:
+            if self._closed:
+                raise RuntimeError(f'{self.name} is closed')
+            # A batch larger than the queue is still accepted into an empty one
+            if not self._condition.wait_for(
+                lambda: not self._pending or self._pending + len(records) <= self.max_pending,
+                timeout=self.add_timeout,
+            ):
+                ADMISSION_REJECTED.labels(self.name, WRITER_FULL).inc()
+                raise WriterFull(self.retry_after)
+            if batch_model is not None:
+                batch_id = str(uuid.uuid4())
+                batch_model.objects.create(batch_id=batch_id, records=len(records), chunks=1)
+            if not self._items:
+                self._deadline = time.monotonic() + self.max_wait
+            self._added += 1
+            sequence = self._added
+            if wait:
+                self._waiting[sequence] = True
+            self._items.append((records, batch_id, sequence))
+            self._pending += len(records)
+            DIRECT_WRITER_PENDING.labels(self.name).set(self._pending)
+            self._condition.notify_all()
+            if wait:
+                self._condition.wait_for(lambda: self._written >= sequence)
+                if not self._waiting.pop(sequence):
+                    raise RuntimeError(f'{self.name} failed to store the records')
+        return batch_id
+
+    def drain(self, timeout=None):
+        """
+        Wait until every queued record has been stored. Returns whether it was.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._written >= self._added, timeout=timeout)
+
+    def close(self, timeout=None):
+        """
+        Stop accepting records and wait up to ``timeout`` seconds for the
+        queued ones to be stored.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"{self.name} stopped with {self._pending} records not stored")
+
+    def _take(self):
+        """
+        Take whole items from the queue, up to ``max_records`` records unless
+        the first one is larger.
+        """
+        count = 0
+        taken = 0
+        for records, _, _ in self._items:
+            if taken and count + len(records) > self.max_records:
+                break
+            count += len(records)
+            taken += 1
+        items, self._items = self._items[:taken], self._items[taken:]
+        self._deadline = time.monotonic() + self.max_wait if self._items else None
+        return items
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._closed or self._items)
+                    if not self._items:
+                        return
+                    self._condition.wait_for(
+                        lambda: self._closed or self._pending >= self.max_records,
+                        timeout=max(0.0, self._deadline - time.monotonic()),
+                    )
+                    items = self._take()
+                self._write(items)
+                with self._condition:
+                    self._written = items[-1][2]
+                    self._pending -= sum(len(records) for records, _, _ in items)
+                    DIRECT_WRITER_PENDING.labels(self.name).set(self._pending)
+                    self._condition.notify_all()
+        finally:
+            connections.close_all()
+
+    def _write(self, items):
+        count = sum(len(records) for records, _, _ in items)
+        saved = None
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                saved = self.writer.write_many([records for records, _, _ in items])
+                break
+            except TRANSIENT_ERRORS as e:
+                DIRECT_WRITE_FAILURES.labels(self.name).inc()
+                logger.error(f"Error storing {count} records from {self.name} (attempt {attempt}): {e}")
+                # Replace the connection if the error broke it
+                close_old_connections()
+                if attempt < self.max_attempts:
+                    time.sleep(self.retry_interval)
+            except Exception as e:
+                DIRECT_WRITE_FAILURES.labels(self.name).inc()
+                logger.error(f"Error storing {count} records from {self.name}: {e}")
+                close_old_connections()
+                break
+        if saved is None:
+            saved = [self._write_one(records, sequence) for records, _, sequence in items]
+        for (_, batch_id, _), instances in zip(items, saved):
+            if instances is None:
+                self.writer.finish_batch(batch_id, failed=True)
+            else:
+                self.writer.finish_batch(batch_id, len(instances))
+        saved = [instances for instances in saved if instances is not None]
+        try:
+            self.writer.after_save([instance for instances in saved for instance in instances])
+        except Exception as e:
+            # The records are stored, only the latest store or rollups are behind
+            logger.error(f"Error running the after save hooks of {self.name}: {e}")
+
+    def _write_one(self, records, sequence):
+        """
+        Store the records of one batch on their own, returning the saved
+        instances or ``None`` when the batch is dropped.
+        """
+        try:
+            return self.writer.write(records)
+        except Exception as e:
+            DIRECT_WRITE_FAILURES.labels(self.name).inc()
+            logger.error(f"Dropped {len(records)} records from {self.name} that failed to store: {e}")
+            close_old_connections()
+            with self._condition:
+                if sequence in self._waiting:
+                    self._waiting[sequence] = False
+            return None
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_direct_writer(name, writer):
+    """
+    Return the process wide direct writer registered under ``name``,
+    creating it from the ``INGEST_DIRECT_*`` settings on first use.
+    """
+    with _writers_lock:
+        if name not in _writers:
+            _writers[name] = DirectWriter(
+                writer,
+                max_records=settings.INGEST_DIRECT_MAX_RECORDS,
+                max_wait_ms=settings.INGEST_DIRECT_MAX_WAIT_MS,
+                max_pending=settings.INGEST_DIRECT_MAX_PENDING,
+                add_timeout=settings.INGEST_DIRECT_ADD_TIMEOUT,
+                retry_interval=settings.INGEST_DIRECT_RETRY_INTERVAL,
+                max_attempts=settings.INGEST_DIRECT_MAX_ATTEMPTS,
+                retry_after=settings.ADMISSION_RETRY_AFTER,
+                name=f'{name}-direct-writer',
+            )
+        return _writers[name]
+
+
+@atexit.register
+def close_direct_writers(timeout=None):
+    """
+    Store the queued records of every direct writer, called on interpreter
+    shutdown. Each one gets ``INGEST_DIRECT_DRAIN_TIMEOUT`` seconds by default.
+    """
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close(settings.INGEST_DIRECT_DRAIN_TIMEOUT if timeout is None else timeout)
@@ -0,0 +1,242 @@
+"""
+Opt-in SQL and Python profiling of requests and Celery tasks.
+
+With ``PROFILING_ENABLED`` every request and task records its query count
+and time, queries slower than ``PROFILING_SLOW_QUERY_MS`` and statements
+repeated at least ``PROFILING_N_PLUS_ONE_THRESHOLD`` times (N+1 patterns).
+One request in ``PROFILING_SAMPLE_RATE`` additionally runs a stack sampling
+profiler. Reports go to a rotating JSON lines file and, for requests, to the
+``Server-Timing`` header.
+
+When disabled the middleware removes itself and the task hooks are never
+connected, so there is no overhead at all.
+"""
+import itertools
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from logging.handlers import RotatingFileHandler
+from celery.signals import task_postrun, task_prerun
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger('evreka_case1.profiling')
+
+IN_LIST_PATTERN = re.compile(r'\((?:%s, )+%s\)')
+
+
+def normalize_sql(sql):
+    """
+    Collapse placeholder lists so ``IN`` queries of any length count as one statement.
+    """
+    return IN_LIST_PATTERN.sub('(%s, ...)', sql)
+
+
+class QueryRecorder:
+    """
+    ``execute_wrapper`` recording the count and duration of every query.
+    """
+
+    def __init__(self, slow_query_ms, n_plus_one_threshold):
+        self.slow_query_ms = slow_query_ms
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+        self.slow = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            self.statements[normalize_sql(sql)] += 1
+            if elapsed * 1000 >= self.slow_query_ms:
+                self.slow.append({'sql': sql, 'ms': round(elapsed * 1000, 3)})
+
+    def report(self):
+        return {
+            'queries': self.count,
+            'query_ms': round(self.seconds * 1000, 3),
+            'slow_queries': self.slow,
+            'n_plus_one': [
+                {'sql': sql, 'count': count}
+                for sql, count in self.statements.most_common()
+                if count >= self.n_plus_one_threshold
+            ],
+        }
+
+
+class StackSampler:
+    """
+    Sampling profiler of a single thread.
+
+    A background thread looks at the stack of the profiled thread every
+    ``interval`` seconds and counts the collapsed stacks, which is cheap
+    enough to run on a production request.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def report(self, limit=20):
+        """
+        Return the most frequent stacks in the collapsed (flame graph) format.
+        """
+        return {
+            'samples': sum(self.stacks.values()),
+            'interval_ms': self.interval * 1000,
+            'stacks': [f'{stack} {count}' for stack, count in self.stacks.most_common(limit)],
+        }
+
+
+def configure_logger():
+    if settings.PROFILING_LOG_FILE and not logger.handlers:
+        handler = RotatingFileHandler(
+            settings.PROFILING_LOG_FILE,
+            maxBytes=settings.PROFILING_LOG_MAX_BYTES,
+            backupCount=settings.PROFILING_LOG_BACKUPS,
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+
+def write_report(report):
+    if settings.PROFILING_LOG_FILE:
+        logger.info(json.dumps(report))
+
+
+def new_recorder():
+    return QueryRecorder(settings.PROFILING_SLOW_QUERY_MS, settings.PROFILING_N_PLUS_ONE_THRESHOLD)
+
+
+def server_timing(report):
+    metrics = [
+        f'db;dur={report["query_ms"]};desc="{report["queries"]} queries"',
+        f'app;dur={report["python_ms"]}',
+    ]
+    if report['n_plus_one']:
+        metrics.append(f'nplus1;desc="{len(report["n_plus_one"])} repeated statements"')
+    if report['slow_queries']:
+        metrics.append(f'slow;desc="{len(report["slow_queries"])} slow queries"')
+    return ', '.join(metrics)
+
+
+class ProfilingMiddleware:
+    """
+    Record the SQL queries of every request and sample the Python stacks of
+    one request in ``PROFILING_SAMPLE_RATE``.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        configure_logger()
+        self.get_response = get_response
+        self.requests = itertools.count(1)
+
+    def __call__(self, request):
+        recorder = new_recorder()
+        sample_rate = settings.PROFILING_SAMPLE_RATE
+        sampler = None
+        if sample_rate and next(self.requests) % sample_rate == 0:
+            sampler = StackSampler(threading.get_ident())
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            if sampler is None:
+                response = self.get_response(request)
+            else:
+                with sampler:
+                    response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        report = {
+            'type': 'request',
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(elapsed * 1000, 3),
+            **recorder.report(),
+        }
+        report['python_ms'] = round(report['total_ms'] - report['query_ms'], 3)
+        if sampler is not None:
+            report['profile'] = sampler.report()
+        if settings.PROFILING_SERVER_TIMING:
+            response['Server-Timing'] = server_timing(report)
+        write_report(report)
+        return response
+
+
+# Query recorders of the running tasks, by task id
+active_tasks = {}
+
+
+def start_task_profile(task_id=None, **kwargs):
+    recorder = new_recorder()
+    wrapper = connection.execute_wrapper(recorder)
+    wrapper.__enter__()
+    active_tasks[task_id] = (recorder, wrapper, time.perf_counter())
+
+
+def finish_task_profile(task_id=None, task=None, state=None, **kwargs):
+    entry = active_tasks.pop(task_id, None)
+    if entry is None:
+        return
+    recorder, wrapper, started = entry
+    wrapper.__exit__(None, None, None)
+    elapsed = time.perf_counter() - started
+    report = {
+        'type': 'task',
+        'task': task.name if task is not None else None,
+        'task_id': task_id,
+        'state': state,
+        'total_ms': round(elapsed * 1000, 3),
+        **recorder.report(),
+    }
+    report['python_ms'] = round(report['total_ms'] - report['query_ms'], 3)
+    write_report(report)
+
+
+def install_task_hooks():
+    """
+    Connect the Celery task hooks when profiling is enabled.
+    """
+    if not settings.PROFILING_ENABLED:
+        return
+    configure_logger()
+    task_prerun.connect(start_task_profile, weak=False, dispatch_uid='profiling_prerun')
+    task_postrun.connect(finish_task_profile, weak=False, dispatch_uid='profiling_postrun')
@@ -0,0 +1,167 @@
+"""
+Incrementally maintained per device aggregates over fixed time buckets.
+
+Every stored record is folded into one bucket per resolution. A bucket keeps
+the sample count, the speed sum/min/max and the first and last position, so
+merging is order independent and the rollups can be updated batch by batch
+from the ingest tasks or rebuilt from the history table at any time.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from django.db import IntegrityError, router, transaction
+from django.db.models import Q
+from evreka_case1.streaming import format_datetime, format_decimal
+
+RESOLUTIONS = {
+    '5m': 300,
+    '1h': 3600,
+    '1d': 86400,
+}
+
+CENTS = Decimal('0.01')
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def bucket_start(timestamp, seconds):
+    """
+    Return the start of the UTC aligned bucket of ``seconds`` containing ``timestamp``.
+    """
+    offset = int((timestamp - EPOCH).total_seconds() // seconds) * seconds
+    return EPOCH + timedelta(seconds=offset)
+
+
+def bucket_count(start, end, seconds):
+    return int((bucket_start(end, seconds) - bucket_start(start, seconds)).total_seconds()) // seconds + 1
+
+
+def choose_resolution(start, end, max_buckets):
+    """
+    Pick the finest resolution that covers ``start`` to ``end`` in at most
+    ``max_buckets`` buckets, falling back to the coarsest one.
+    """
+    for name, seconds in sorted(RESOLUTIONS.items(), key=lambda item: item[1]):
+        if bucket_count(start, end, seconds) <= max_buckets:
+            return name
+    return max(RESOLUTIONS, key=RESOLUTIONS.get)
+
+
+class Aggregate:
+    __slots__ = ('count', 'speed_sum', 'speed_min', 'speed_max',
+                 'first_timestamp', 'first_location', 'last_timestamp', 'last_location')
+
+    def __init__(self, timestamp, location, speed):
+        self.count = 1
+        self.speed_sum = self.speed_min = self.speed_max = speed
+        self.first_timestamp = self.last_timestamp = timestamp
+        self.first_location = self.last_location = location
+
+    @classmethod
+    def from_row(cls, row):
+        aggregate = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(aggregate, name, getattr(row, name))
+        return aggregate
+
+    def merge(self, other):
+        self.count += other.count
+        self.speed_sum += other.speed_sum
+        self.speed_min = min(self.speed_min, other.speed_min)
+        self.speed_max = max(self.speed_max, other.speed_max)
+        if other.first_timestamp < self.first_timestamp:
+            self.first_timestamp, self.first_location = other.first_timestamp, other.first_location
+        if other.last_timestamp >= self.last_timestamp:
+            self.last_timestamp, self.last_location = other.last_timestamp, other.last_location
+
+    def apply(self, row):
+        for name in self.__slots__:
+            setattr(row, name, getattr(self, name))
+
+
+def aggregate_records(records):
+    """
+    Fold ``(device_id, timestamp, location, speed)`` tuples into a
+    ``{(device_id, resolution, bucket): Aggregate}`` dictionary.
+    """
+    aggregates = {}
+    for device_id, timestamp, location, speed in records:
+        speed = Decimal(str(speed)).quantize(CENTS)
+        for seconds in RESOLUTIONS.values():
+            key = (device_id, seconds, bucket_start(timestamp, seconds))
+            aggregate = Aggregate(timestamp, location, speed)
+            if key in aggregates:
+                aggregates[key].merge(aggregate)
+            else:
+                aggregates[key] = aggregate
+    return aggregates
+
+
+def merge_rollups(rollup_model, aggregates, attempts=3):
+    """
+    Merge aggregates into ``rollup_model`` rows.
+
+    Existing buckets are locked while they are merged, so concurrent ingest
+    tasks never lose an update. Two tasks creating the same new bucket at the
+    same time make one of them hit the unique constraint, which simply retries.
+    """
+    if not aggregates:
+        return
+    using = router.db_for_write(rollup_model)
+    keys = sorted(aggregates)
+    # One condition per resolution instead of one per bucket, may lock a few extra rows
+    lookup = Q()
+    for seconds in RESOLUTIONS.values():
+        device_ids = {key[0] for key in keys if key[1] == seconds}
+        buckets = {key[2] for key in keys if key[1] == seconds}
+        if device_ids:
+            lookup |= Q(resolution=seconds, device_id__in=device_ids, bucket__in=buckets)
+
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic(using=using):
+                rows = rollup_model.objects.using(using).select_for_update().filter(lookup).order_by(
+                    'device_id', 'resolution', 'bucket'
+                )
+                existing = {(row.device_id, row.resolution, row.bucket): row for row in rows}
+                updated = []
+                created = []
+                for key in keys:
+                    row = existing.get(key)
+                    if row is None:
+                        row = rollup_model(device_id=key[0], resolution=key[1], bucket=key[2])
+                        aggregates[key].apply(row)
+                        created.append(row)
+                    else:
+                        aggregate = Aggregate.from_row(row)
+                        aggregate.merge(aggregates[key])
+                        aggregate.apply(row)
+                        updated.append(row)
+                rollup_model.objects.using(using).bulk_update(updated, Aggregate.__slots__)
+                rollup_model.objects.using(using).bulk_create(created)
+            return
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+
+
+def update_rollups(rollup_model, instances):
+    """
+    Fold newly stored device data instances into the rollups.
+    """
+    merge_rollups(rollup_model, aggregate_records(
+        (instance.device_id, instance.timestamp, instance.location, instance.speed)
+        for instance in instances
+    ))
+
+
+def serialize_rollup(row):
+    return {
+        'bucket': format_datetime(row.bucket),
+        'count': row.count,
+        'avg_speed': format_decimal((row.speed_sum / row.count).quantize(CENTS)),
+        'min_speed': format_decimal(row.speed_min),
+        'max_speed': format_decimal(row.speed_max),
+        'first_timestamp': format_datetime(row.first_timestamp),
+        'first_location': row.first_location,
+        'last_timestamp': format_datetime(row.last_timestamp),
+        'last_location': row.last_location,
+    }
@@ -0,0 +1,72 @@
+"""
+Queue routing of the ingest tasks.
+
+With ``INGEST_SHARDS`` set the records are split over the queues
+``<INGEST_QUEUE>.0`` to ``<INGEST_QUEUE>.<INGEST_SHARDS - 1>`` by a CRC32 of
+their device ID. All records of a device go through the same queue, so with
+a single consumer per queue they are stored in the order they were
+received, and a worker serving a subset of the shards keeps the state of
+the same devices warm (latest position cache). With ``INGEST_BULK_QUEUE``
+set bulk uploads get a queue of their own, so backfills are served by their
+own workers and never hold up live traffic.
+"""
+import zlib
+from django.conf import settings
+
+
+def shard_of(device_id, shards):
+    return zlib.crc32(str(device_id).encode('utf-8')) % shards
+
+
+def shard_queue(index):
+    return f'{settings.INGEST_QUEUE}.{index}'
+
+
+def parse_shards(spec, shards):
+    """
+    Parse a shard list like ``0-3,6`` into sorted shard indexes, ``None``
+    selects all of them. Raises ``ValueError`` for shards out of range.
+    """
+    if spec is None:
+        return list(range(shards))
+    indexes = set()
+    for part in spec.split(','):
+        start, _, end = part.strip().partition('-')
+        first = int(start)
+        last = int(end) if end else first
+        if not 0 <= first <= last < shards:
+            raise ValueError(f'Shard range {part.strip()} is outside of 0-{shards - 1}.')
+        indexes.update(range(first, last + 1))
+    return sorted(indexes)
+
+
+def ingest_queues(spec=None, bulk=False):
+    """
+    Return the names of the ingest queues a worker should consume: the
+    shards selected by ``spec`` (all by default), or ``INGEST_QUEUE`` when
+    not sharded, and with ``bulk`` also ``INGEST_BULK_QUEUE``.
+    """
+    if settings.INGEST_SHARDS:
+        queues = [shard_queue(index) for index in parse_shards(spec, settings.INGEST_SHARDS)]
+    else:
+        queues = [settings.INGEST_QUEUE]
+    if bulk and settings.INGEST_BULK_QUEUE:
+        queues.append(settings.INGEST_BULK_QUEUE)
+    return queues
+
+
+def route_records(records, bulk=False):
+    """
+    Split ``records`` by the queue they should be sent to, keeping their
+    order. Returns ``(queue, records)`` pairs, a ``None`` queue leaves the
+    choice to ``CELERY_TASK_ROUTES``.
+    """
+    if bulk and settings.INGEST_BULK_QUEUE:
+        return [(settings.INGEST_BULK_QUEUE, records)]
+    shards = settings.INGEST_SHARDS
+    if not shards:
+        return [(None, records)]
+    routed = {}
+    for record in records:
+        routed.setdefault(shard_of(record['device_id'], shards), []).append(record)
+    return [(shard_queue(index), routed[index]) for index in sorted(routed)]
@@ -0,0 +1,189 @@
+"""
+Columnar message serializer of the ingest tasks.
+
+With the ``json`` serializer every record of an ingest task repeats its key
+names, and its timestamp becomes a tagged ISO 8601 string. The ``columnar``
+serializer packs the records of a message column by column instead:
+
+* the distinct device IDs once, and the index of every record's device,
+* timestamps as int64 microseconds since the epoch,
+* speeds as float64 (integer speeds keep the message in JSON),
+* locations as length-prefixed strings. They are stored verbatim, so they
+  aren't split into coordinates, and compress well.
+
+Messages whose arguments aren't a list of validated records, like other
+tasks' messages, are JSON-encoded inside the same envelope. Messages of at
+least ``compress_min_size`` bytes are zlib compressed. The decoded body is
+what the ``json`` serializer would return, with the timestamps as UTC
+datetimes.
+"""
+import struct
+import sys
+import zlib
+from array import array
+from datetime import datetime, timedelta, timezone
+from kombu.serialization import register
+from kombu.utils.json import dumps, loads
+
+COLUMNAR = 'columnar'
+CONTENT_TYPE = 'application/x-ingest-columnar'
+
+MAGIC = b'EVC'
+VERSION = 1
+FLAG_COMPRESSED = 1
+FLAG_COLUMNAR = 2
+ENVELOPE = struct.Struct('<3sBB')
+HEADER_LENGTH = struct.Struct('<I')
+# Records, devices and the typecode of the device indexes
+COLUMNS = struct.Struct('<IIc')
+
+TIMESTAMP_ABSENT = object()
+TIMESTAMP_MISSING = -2 ** 63
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def from_little_endian(typecode, data, offset, count):
+    values = array(typecode)
+    end = offset + values.itemsize * count
+    values.frombytes(data[offset:end])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values, end
+
+
+def pack_strings(strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    return to_little_endian(array('I', [len(value) for value in encoded])) + b''.join(encoded)
+
+
+def unpack_strings(data, offset, count):
+    lengths, offset = from_little_endian('I', data, offset, count)
+    strings = []
+    for length in lengths:
+        strings.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+    return strings, offset
+
+
+def pack_records(records):
+    """
+    Pack validated records column by column, ``None`` unless every one of
+    them has the shape of validated device data and survives the round trip
+    exactly (float speed, aware timestamp if any).
+    """
+    device_indexes = {}
+    indexes = []
+    timestamps = []
+    speeds = []
+    locations = []
+    for record in records:
+        if record.__class__ is not dict:
+            return None
+        timestamp = record.get('timestamp', TIMESTAMP_ABSENT)
+        if len(record) != (3 if timestamp is TIMESTAMP_ABSENT else 4):
+            return None
+        try:
+            device_id, location, speed = record['device_id'], record['location'], record['speed']
+        except KeyError:
+            return None
+        if device_id.__class__ is not str or location.__class__ is not str or speed.__class__ is not float:
+            return None
+        if timestamp is TIMESTAMP_ABSENT:
+            timestamps.append(TIMESTAMP_MISSING)
+        elif isinstance(timestamp, datetime) and timestamp.utcoffset() is not None:
+            timestamps.append((timestamp - EPOCH) // MICROSECOND)
+        else:
+            return None
+        index = device_indexes.get(device_id)
+        if index is None:
+            index = device_indexes[device_id] = len(device_indexes)
+        indexes.append(index)
+        speeds.append(speed)
+        locations.append(location)
+    index_typecode = 'B' if len(device_indexes) <= 0xFF else 'H' if len(device_indexes) <= 0xFFFF else 'I'
+    return b''.join([
+        COLUMNS.pack(len(records), len(device_indexes), index_typecode.encode('ascii')),
+        pack_strings(list(device_indexes)),
+        to_little_endian(array(index_typecode, indexes)),
+        to_little_endian(array('q', timestamps)),
+        to_little_endian(array('d', speeds)),
+        pack_strings(locations),
+    ])
+
+
+def unpack_records(data, offset=0):
+    count, devices, index_typecode = COLUMNS.unpack_from(data, offset)
+    offset += COLUMNS.size
+    device_ids, offset = unpack_strings(data, offset, devices)
+    indexes, offset = from_little_endian(index_typecode.decode('ascii'), data, offset, count)
+    timestamps, offset = from_little_endian('q', data, offset, count)
+    speeds, offset = from_little_endian('d', data, offset, count)
+    locations, offset = unpack_strings(data, offset, count)
+    records = []
+    for index, timestamp, speed, location in zip(indexes, timestamps, speeds, locations):
+        record = {'device_id': device_ids[index], 'location': location, 'speed': speed}
+        if timestamp != TIMESTAMP_MISSING:
+            record['timestamp'] = EPOCH + timestamp * MICROSECOND
+        records.append(record)
+    return records
+
+
+class ColumnarSerializer:
+    """
+    Encoder and decoder of the ``columnar`` serializer, see the module docstring.
+    """
+
+    def __init__(self, compress_min_size=4096, compress_level=1):
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+
+    def encode(self, body):
+        flags = 0
+        payload = None
+        # A protocol 2 task body: (args, kwargs, embed), the records are the first argument
+        if isinstance(body, (tuple, list)) and len(body) == 3 and body[0] and isinstance(body[0][0], list):
+            args, kwargs, embed = body
+            columns = pack_records(args[0])
+            if columns is not None:
+                header = dumps([list(args[1:]), kwargs, embed]).encode('utf-8')
+                payload = HEADER_LENGTH.pack(len(header)) + header + columns
+                flags |= FLAG_COLUMNAR
+        if payload is None:
+            payload = dumps(body).encode('utf-8')
+        if self.compress_min_size is not None and len(payload) >= self.compress_min_size:
+            payload = zlib.compress(payload, self.compress_level)
+            flags |= FLAG_COMPRESSED
+        return ENVELOPE.pack(MAGIC, VERSION, flags) + payload
+
+    def decode(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        magic, version, flags = ENVELOPE.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a columnar ingest message.')
+        payload = data[ENVELOPE.size:]
+        if flags & FLAG_COMPRESSED:
+            payload = zlib.decompress(payload)
+        if not flags & FLAG_COLUMNAR:
+            return loads(payload)
+        (length,) = HEADER_LENGTH.unpack_from(payload)
+        rest, kwargs, embed = loads(payload[HEADER_LENGTH.size:HEADER_LENGTH.size + length])
+        return [[unpack_records(payload, HEADER_LENGTH.size + length), *rest], kwargs, embed]
+
+
+def register_columnar_serializer(compress_min_size=4096, compress_level=1):
+    """
+    Register the ``columnar`` serializer with kombu. ``compress_min_size``
+    ``None`` disables compression.
+    """
+    serializer = ColumnarSerializer(compress_min_size, compress_level)
+    register(COLUMNAR, serializer.encode, serializer.decode, content_type=CONTENT_TYPE, content_encoding='binary')
+    return serializer
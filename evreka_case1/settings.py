@@ -50,6 +50,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'evreka_case1.middleware.MetricsMiddleware',
+    'evreka_case1.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -95,6 +97,24 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# Use a shared backend (Redis, Memcached) in production so positions written by
+# the Celery workers are visible to every web process.
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+CACHE_SHARED = CACHE_BACKEND not in (
+    'django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache',
+)
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -139,6 +159,135 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Celery Configuration
 CELERY_BROKER_URL = 'amqp://guest@rabbitmq//'
 CELERY_RESULT_BACKEND = 'django-db'
-CELERY_ACCEPT_CONTENT = ['json']
+CELERY_ACCEPT_CONTENT = ['json', 'columnar']
 CELERY_TASK_SERIALIZER = 'json'
-CELERY_RESULT_SERIALIZER = 'json'
\ No newline at end of file
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_RESULT_EXPIRES = int(os.environ.get('CELERY_RESULT_EXPIRES', 86400))  # Seconds, purged daily by beat
+CELERY_BEAT_SCHEDULE = {
+    'expire-ingest-batches': {'task': 'tracking.tasks.expire_ingest_batches', 'schedule': 3600},
+    'expire-tcp-ingest-batches': {'task': 'tcp_tracking.tasks.expire_ingest_batches', 'schedule': 3600},
+}
+
+# TCP Server Configuration
+# 'threaded' handles one message per connection, 'asyncio' keeps connections open
+TCP_SERVER_MODE = os.environ.get('TCP_SERVER_MODE', 'threaded')
+TCP_MAX_FRAME_SIZE = int(os.environ.get('TCP_MAX_FRAME_SIZE', 16 * 1024 * 1024))
+TCP_IDLE_TIMEOUT = int(os.environ.get('TCP_IDLE_TIMEOUT', 300))  # Seconds, 0 disables
+TCP_BACKLOG = int(os.environ.get('TCP_BACKLOG', 4096))
+TCP_WORKERS = int(os.environ.get('TCP_WORKERS', 0))  # Processes sharing the port, 0 uses the CPU count
+TCP_TRACK_BATCHES = os.environ.get('TCP_TRACK_BATCHES', 'False').lower() in ('1', 'true', 'yes')  # batch_id in responses
+TCP_STATS_INTERVAL = int(os.environ.get('TCP_STATS_INTERVAL', 60))  # Seconds between worker counter reports
+
+# Ingest Micro-batching
+# Buffer validated records in-process and send one Celery task per batch
+INGEST_COALESCE = os.environ.get('INGEST_COALESCE', 'False').lower() in ('1', 'true', 'yes')
+INGEST_COALESCE_MAX_RECORDS = int(os.environ.get('INGEST_COALESCE_MAX_RECORDS', 1000))
+INGEST_COALESCE_MAX_AGE_MS = int(os.environ.get('INGEST_COALESCE_MAX_AGE_MS', 200))
+INGEST_COALESCE_MAX_BUFFERED = int(os.environ.get('INGEST_COALESCE_MAX_BUFFERED', 100000))  # Records per process, 0 disables
+
+# Ingest Dispatch
+INGEST_CHUNK_SIZE = int(os.environ.get('INGEST_CHUNK_SIZE', 5000))  # Records per task, larger payloads become a group
+INGEST_BULK_CREATE_BATCH_SIZE = int(os.environ.get('INGEST_BULK_CREATE_BATCH_SIZE', 1000))  # Rows per INSERT
+INGEST_BATCH_TTL = int(os.environ.get('INGEST_BATCH_TTL', 86400))  # Seconds a tracked batch status is kept
+
+# Ingest Task Serializer
+# 'columnar' packs the records of the ingest tasks column by column (see
+# evreka_case1/serialization.py), 'json' keeps the plain Celery format.
+# Workers accept both, deploy them before switching the producers.
+INGEST_TASK_SERIALIZER = os.environ.get('INGEST_TASK_SERIALIZER', 'columnar')
+INGEST_SERIALIZER_COMPRESS_MIN_SIZE = int(os.environ.get('INGEST_SERIALIZER_COMPRESS_MIN_SIZE', 4096))  # Bytes, 0 disables
+INGEST_SERIALIZER_COMPRESS_LEVEL = int(os.environ.get('INGEST_SERIALIZER_COMPRESS_LEVEL', 1))  # zlib level
+
+# Ingest Pipeline
+# 'celery' queues validated records for the Celery workers, 'direct' stores them
+# from a background thread of the receiving process, without a broker.
+INGEST_PIPELINE = os.environ.get('INGEST_PIPELINE', 'celery')
+INGEST_DIRECT_MAX_RECORDS = int(os.environ.get('INGEST_DIRECT_MAX_RECORDS', 5000))  # Records per insert batch
+INGEST_DIRECT_MAX_WAIT_MS = int(os.environ.get('INGEST_DIRECT_MAX_WAIT_MS', 100))
+INGEST_DIRECT_MAX_PENDING = int(os.environ.get('INGEST_DIRECT_MAX_PENDING', 100000))  # Queued records per process
+INGEST_DIRECT_ADD_TIMEOUT = float(os.environ.get('INGEST_DIRECT_ADD_TIMEOUT', 1))  # Seconds before a full queue refuses
+INGEST_DIRECT_RETRY_INTERVAL = float(os.environ.get('INGEST_DIRECT_RETRY_INTERVAL', 1))  # Seconds, while the database is down
+INGEST_DIRECT_MAX_ATTEMPTS = int(os.environ.get('INGEST_DIRECT_MAX_ATTEMPTS', 5))  # Before storing the batches one by one
+INGEST_DIRECT_DRAIN_TIMEOUT = float(os.environ.get('INGEST_DIRECT_DRAIN_TIMEOUT', 30))  # Seconds to store the queue on shutdown
+
+# TCP Write-ahead Spool
+# With a directory the TCP server acknowledges records once they are appended to a
+# local log, a background thread forwards them to the broker. Empty publishes directly.
+TCP_SPOOL_DIR = os.environ.get('TCP_SPOOL_DIR', '')
+TCP_SPOOL_SEGMENT_SIZE = int(os.environ.get('TCP_SPOOL_SEGMENT_SIZE', 64 * 1024 * 1024))  # Bytes per segment file
+TCP_SPOOL_MAX_BYTES = int(os.environ.get('TCP_SPOOL_MAX_BYTES', 4 * 1024 * 1024 * 1024))  # Unforwarded bytes per process
+TCP_SPOOL_FSYNC_MS = int(os.environ.get('TCP_SPOOL_FSYNC_MS', 50))  # Interval of the flushes to disk
+TCP_SPOOL_FORWARD_RECORDS = int(os.environ.get('TCP_SPOOL_FORWARD_RECORDS', 20000))  # Records per forwarded batch
+TCP_SPOOL_RETRY_INTERVAL = float(os.environ.get('TCP_SPOOL_RETRY_INTERVAL', 1))  # Seconds, while the broker is down
+# Wait for RabbitMQ to confirm every publish, so a forwarded segment is really queued
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'confirm_publish': os.environ.get('CELERY_CONFIRM_PUBLISH', str(bool(TCP_SPOOL_DIR))).lower() in ('1', 'true', 'yes'),
+}
+
+# Admission Control
+# Every limit is disabled with 0. HTTP requests over a limit get 429/503 with
+# Retry-After, the TCP server stops reading until there is capacity again.
+ADMISSION_DEVICE_RATE = float(os.environ.get('ADMISSION_DEVICE_RATE', 0))  # Records per second per device
+ADMISSION_DEVICE_BURST = float(os.environ.get('ADMISSION_DEVICE_BURST', 0))  # Defaults to the rate
+ADMISSION_MAX_DEVICES = int(os.environ.get('ADMISSION_MAX_DEVICES', 100000))  # Token buckets kept per process
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 0))  # Records per process not yet queued
+ADMISSION_MAX_QUEUE_DEPTH = int(os.environ.get('ADMISSION_MAX_QUEUE_DEPTH', 0))  # Messages in the ingest queues (all shards)
+ADMISSION_QUEUE_CHECK_INTERVAL = float(os.environ.get('ADMISSION_QUEUE_CHECK_INTERVAL', 1))  # Seconds
+ADMISSION_RETRY_AFTER = float(os.environ.get('ADMISSION_RETRY_AFTER', 1))  # Seconds, when overloaded
+ADMISSION_TCP_MAX_WAIT = float(os.environ.get('ADMISSION_TCP_MAX_WAIT', 30))  # Seconds before a TCP frame is refused
+ADMISSION_BULK_MAX_WAIT = float(os.environ.get('ADMISSION_BULK_MAX_WAIT', 30))  # Seconds before a bulk upload is refused
+TCP_MAX_CONNECTIONS = int(os.environ.get('TCP_MAX_CONNECTIONS', 0))  # Threaded mode, stop accepting above it
+
+# Duplicate Suppression
+# 'off', 'key' (device_id and timestamp) or 'payload' (also location and speed)
+INGEST_DEDUP = os.environ.get('INGEST_DEDUP', 'off')
+INGEST_DEDUP_RECENT_KEYS = int(os.environ.get('INGEST_DEDUP_RECENT_KEYS', 100000))  # Keys remembered per process
+
+# Ingest Consumer
+# The ingest tasks are routed to their own queue, drained in batches by consume_ingest
+INGEST_QUEUE = os.environ.get('INGEST_QUEUE', 'celery')
+CELERY_TASK_ROUTES = {
+    'tracking.tasks.process_device_data': {'queue': INGEST_QUEUE},
+    'tcp_tracking.tasks.process_tcp_data': {'queue': INGEST_QUEUE},
+}
+# Device sharding: the records are hashed by device_id onto <INGEST_QUEUE>.0 .. .<N-1>,
+# with one consumer per shard queue the records of a device are stored in order
+INGEST_SHARDS = int(os.environ.get('INGEST_SHARDS', 0))  # 0 sends everything to INGEST_QUEUE
+INGEST_BULK_QUEUE = os.environ.get('INGEST_BULK_QUEUE', '')  # Bulk uploads, empty routes them like live data
+INGEST_CONSUMER_PREFETCH = int(os.environ.get('INGEST_CONSUMER_PREFETCH', 1000))  # Unacked messages held at once
+INGEST_CONSUMER_MAX_RECORDS = int(os.environ.get('INGEST_CONSUMER_MAX_RECORDS', 10000))  # Records per transaction
+INGEST_CONSUMER_MAX_WAIT_MS = int(os.environ.get('INGEST_CONSUMER_MAX_WAIT_MS', 200))  # Wait for a batch to fill
+
+# Latest Position Cache
+LATEST_CACHE_ALIAS = os.environ.get('LATEST_CACHE_ALIAS', 'default')
+# Seconds in the Django cache, 0 skips it (the default unless CACHE_BACKEND is shared by all processes)
+LATEST_CACHE_TIMEOUT = int(os.environ.get('LATEST_CACHE_TIMEOUT', 300 if CACHE_SHARED else 0))
+LATEST_CACHE_LOCAL_SIZE = int(os.environ.get('LATEST_CACHE_LOCAL_SIZE', 10000))  # Devices kept in-process
+LATEST_CACHE_LOCAL_TTL = float(os.environ.get('LATEST_CACHE_LOCAL_TTL', 2))  # Seconds in-process
+
+# Export
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 5000))  # Rows per keyset seeked query
+
+# Bulk Upload
+BULK_UPLOAD_CHUNK_SIZE = int(os.environ.get('BULK_UPLOAD_CHUNK_SIZE', 1000))  # Records validated and queued at once
+BULK_UPLOAD_MAX_ERRORS = int(os.environ.get('BULK_UPLOAD_MAX_ERRORS', 100))  # Error positions reported back
+
+# Rollups
+ROLLUP_MAX_BUCKETS = int(os.environ.get('ROLLUP_MAX_BUCKETS', 500))  # Buckets per response when picking the resolution
+
+# Metrics
+# Side ports of the processes without a web server, 0 disables. TCP server workers
+# and Celery worker processes add their index to the port.
+METRICS_TCP_PORT = int(os.environ.get('METRICS_TCP_PORT', 9100))
+METRICS_CELERY_PORT = int(os.environ.get('METRICS_CELERY_PORT', 0))
+
+# Profiling
+# Records SQL and Python time of requests and tasks, removed entirely when disabled
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'False').lower() in ('1', 'true', 'yes')
+PROFILING_SLOW_QUERY_MS = float(os.environ.get('PROFILING_SLOW_QUERY_MS', 100))
+PROFILING_N_PLUS_ONE_THRESHOLD = int(os.environ.get('PROFILING_N_PLUS_ONE_THRESHOLD', 10))  # Repeats of one statement
+PROFILING_SAMPLE_RATE = int(os.environ.get('PROFILING_SAMPLE_RATE', 0))  # Stack sample one request in N, 0 disables
+PROFILING_SERVER_TIMING = os.environ.get('PROFILING_SERVER_TIMING', 'True').lower() in ('1', 'true', 'yes')
+PROFILING_LOG_FILE = os.environ.get('PROFILING_LOG_FILE', os.path.join(BASE_DIR, 'profiling.log'))  # Empty disables
+PROFILING_LOG_MAX_BYTES = int(os.environ.get('PROFILING_LOG_MAX_BYTES', 10 * 1024 * 1024))
+PROFILING_LOG_BACKUPS = int(os.environ.get('PROFILING_LOG_BACKUPS', 3))
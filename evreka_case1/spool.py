@@ -0,0 +1,421 @@
+"""
+Local write-ahead spool of validated records.
+
+With a spool the TCP server doesn't publish to the broker before answering a
+client. Records are appended to memory mapped, append-only segment files
+and acknowledged right away, a forwarder thread sends them to the broker in
+large batches and deletes a segment once all of it has been handed over.
+The mappings are flushed to disk at most every ``fsync_ms`` milliseconds, so
+acknowledged records survive a crash of the process, and of the host up to
+that interval.
+
+Every process claims its own directory below the spool root with a lock
+file. A restarted process claims the directory it left behind, together
+with the ones of processes that are no longer running, and forwards the
+records they still hold before its new ones (at least once, a batch that
+was being forwarded during the crash is sent again).
+
+A segment starts with a header holding the offset up to which it has been
+forwarded, followed by frames of a length, a CRC32 and the records in the
+JSON encoding Celery uses (so decimals and datetimes round-trip).
+"""
+import atexit
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from itertools import count
+from django.conf import settings
+from kombu.utils.json import dumps, loads
+from evreka_case1.admission import AdmissionRejected
+from evreka_case1.metrics import ADMISSION_REJECTED, SPOOL_FORWARD_FAILURES, SPOOL_PENDING_BYTES
+
+logger = logging.getLogger(__name__)
+
+SPOOL_FULL = 'spool_full'
+
+SEGMENT_MAGIC = b'SPL1'
+SEGMENT_HEADER = struct.Struct('!4sQ')
+FRAME_HEADER = struct.Struct('!II')
+SEGMENT_SUFFIX = '.seg'
+
+
+class SpoolFull(AdmissionRejected):
+    """
+    Raised when the records would grow the spool over its size limit.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(SPOOL_FULL, retry_after)
+
+
+class Segment:
+    """
+    One memory mapped segment file. Frames are written from ``end`` on, the
+    ones before ``forwarded`` have been handed to the broker.
+    """
+
+    def __init__(self, path, sequence, file, buffer, end, forwarded, recovered=False):
+        self.path = path
+        self.sequence = sequence
+        self.file = file
+        self.buffer = buffer
+        self.end = end
+        self.forwarded = forwarded
+        self.recovered = recovered
+        self.sealed = False
+
+    @classmethod
+    def create(cls, path, sequence, size):
+        file = open(path, 'w+b')
+        file.truncate(size)
+        buffer = mmap.mmap(file.fileno(), size)
+        buffer[:SEGMENT_HEADER.size] = SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_HEADER.size)
+        return cls(path, sequence, file, buffer, SEGMENT_HEADER.size, SEGMENT_HEADER.size)
+
+    @classmethod
+    def recover(cls, path, sequence):
+        """
+        Open a segment left behind by a previous process. The frames are
+        scanned up to the first empty or torn one, which ends the segment.
+        """
+        file = open(path, 'r+b')
+        size = os.fstat(file.fileno()).st_size
+        if size < SEGMENT_HEADER.size:
+            file.close()
+            return None
+        buffer = mmap.mmap(file.fileno(), size)
+        magic, forwarded = SEGMENT_HEADER.unpack_from(buffer)
+        if magic != SEGMENT_MAGIC:
+            buffer.close()
+            file.close()
+            return None
+        end = SEGMENT_HEADER.size
+        while end + FRAME_HEADER.size <= size:
+            length, checksum = FRAME_HEADER.unpack_from(buffer, end)
+            body_end = end + FRAME_HEADER.size + length
+            if not length or body_end > size or zlib.crc32(buffer[end + FRAME_HEADER.size:body_end]) != checksum:
+                break
+            end = body_end
+        segment = cls(path, sequence, file, buffer, end, min(forwarded, end), recovered=True)
+        segment.sealed = True
+        return segment
+
+    @property
+    def size(self):
+        return len(self.buffer)
+
+    @property
+    def pending(self):
+        return self.end - self.forwarded
+
+    def fits(self, length):
+        return self.end + FRAME_HEADER.size + length <= self.size
+
+    def append(self, body):
+        offset = self.end + FRAME_HEADER.size
+        self.buffer[offset:offset + len(body)] = body
+        # The header goes last, a frame is only valid once its checksum matches
+        FRAME_HEADER.pack_into(self.buffer, self.end, len(body), zlib.crc32(body))
+        self.end = offset + len(body)
+
+    def read(self, start, end, max_records):
+        """
+        Decode the frames between ``start`` and ``end`` until ``max_records``
+        records are collected. Returns the records and the offset after them.
+        """
+        records = []
+        offset = start
+        while offset < end and len(records) < max_records:
+            length, _ = FRAME_HEADER.unpack_from(self.buffer, offset)
+            body_start = offset + FRAME_HEADER.size
+            records.extend(loads(self.buffer[body_start:body_start + length]))
+            offset = body_start + length
+        return records, offset
+
+    def mark_forwarded(self, offset):
+        self.forwarded = offset
+        SEGMENT_HEADER.pack_into(self.buffer, 0, SEGMENT_MAGIC, offset)
+
+    def flush(self):
+        self.buffer.flush()
+
+    def close(self, delete=False):
+        self.buffer.close()
+        self.file.close()
+        if delete:
+            os.remove(self.path)
+
+
+def claim_directory(root):
+    """
+    Lock the first directory below ``root`` that no running process holds.
+    Returns the directory and its lock file, which must be kept open.
+    """
+    os.makedirs(root, exist_ok=True)
+    for index in count():
+        directory = os.path.join(root, str(index))
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, 'lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        return directory, lock
+
+
+def adopt_orphans(root, directory):
+    """
+    Move the segments of the directories below ``root`` that no running
+    process holds into ``directory``, after its own ones.
+    """
+    sequence = max([segment_sequence(name) for name in segment_names(directory)], default=0)
+    for name in sorted(os.listdir(root)):
+        orphan = os.path.join(root, name)
+        if orphan == directory or not os.path.isdir(orphan):
+            continue
+        with open(os.path.join(orphan, 'lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            for segment_name in segment_names(orphan):
+                sequence += 1
+                os.rename(os.path.join(orphan, segment_name), os.path.join(directory, segment_file_name(sequence)))
+
+
+def segment_names(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+def segment_sequence(name):
+    return int(name[:-len(SEGMENT_SUFFIX)])
+
+
+def segment_file_name(sequence):
+    return f'{sequence:020d}{SEGMENT_SUFFIX}'
+
+
+class Spool:
+    """
+    Append-only log of record batches forwarded to ``forward`` by a
+    background thread, see the module docstring.
+
+    ``forward`` receives up to ``forward_records`` records at a time and must
+    raise when they could not be handed over; they are retried every
+    ``retry_interval`` seconds. ``append`` raises ``SpoolFull`` (telling the
+    client to retry after ``retry_after`` seconds) once the records not yet
+    forwarded would exceed ``max_bytes``.
+    """
+
+    def __init__(self, root, forward, segment_size, max_bytes, fsync_ms, forward_records,
+                 retry_interval=1.0, retry_after=1.0, name='spool'):
+        self.forward = forward
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_ms / 1000
+        self.forward_records = forward_records
+        self.retry_interval = retry_interval
+        self.retry_after = retry_after
+        self.name = name
+        self.directory, self.lock_file = claim_directory(root)
+        adopt_orphans(root, self.directory)
+        self.segments = []
+        for segment_name in segment_names(self.directory):
+            path = os.path.join(self.directory, segment_name)
+            segment = Segment.recover(path, segment_sequence(segment_name))
+            if segment is None:
+                # Created but never written to
+                logger.warning(f"{name} removed the invalid segment {path}")
+                os.remove(path)
+            else:
+                self.segments.append(segment)
+        if self.segments:
+            logger.info(f"{name} recovered {self.pending_bytes} bytes in {len(self.segments)} segments")
+        # Records appended by this process and not forwarded yet
+        self.pending_records = 0
+        self.dirty = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.rotate(0)
+        self.threads = [
+            threading.Thread(target=self._forward_loop, name=f'{name}-forwarder', daemon=True),
+            threading.Thread(target=self._sync_loop, name=f'{name}-sync', daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def pending_bytes(self):
+        return sum(segment.pending for segment in self.segments)
+
+    def rotate(self, length):
+        """
+        Seal the current segment and start one with room for ``length`` bytes.
+        """
+        sequence = self.segments[-1].sequence + 1 if self.segments else 1
+        if self.segments and not self.segments[-1].sealed:
+            self.segments[-1].flush()
+            self.segments[-1].sealed = True
+        size = max(self.segment_size, SEGMENT_HEADER.size + FRAME_HEADER.size + length)
+        self.segments.append(Segment.create(os.path.join(self.directory, segment_file_name(sequence)), sequence, size))
+
+    def append(self, records):
+        """
+        Write ``records`` to the spool. They are forwarded in the background.
+        """
+        body = dumps(records).encode('utf-8')
+        with self.condition:
+            if self.closed:
+                raise RuntimeError(f'{self.name} is closed')
+            pending = self.pending_bytes
+            if pending and pending + len(body) > self.max_bytes:
+                ADMISSION_REJECTED.labels(self.name, SPOOL_FULL).inc()
+                raise SpoolFull(self.retry_after)
+            if not self.segments[-1].fits(len(body)):
+                self.rotate(len(body))
+            self.segments[-1].append(body)
+            self.pending_records += len(records)
+            self.dirty = True
+            SPOOL_PENDING_BYTES.labels(self.name).set(self.pending_bytes)
+            self.condition.notify_all()
+
+    def forward_pending(self):
+        """
+        Forward one batch from the oldest segment. Returns whether there was
+        anything to forward, raises when ``forward`` failed.
+        """
+        with self.condition:
+            segment = self.segments[0]
+            start, end = segment.forwarded, segment.end
+            if start == end:
+                if not segment.sealed:
+                    return False
+                self.segments.pop(0)
+                segment.close(delete=True)
+                return True
+            records, offset = segment.read(start, end, self.forward_records)
+
+        self.forward(records)
+
+        with self.condition:
+            segment.mark_forwarded(offset)
+            if not segment.recovered:
+                self.pending_records -= len(records)
+            self.dirty = True
+            SPOOL_PENDING_BYTES.labels(self.name).set(self.pending_bytes)
+            self.condition.notify_all()
+        return True
+
+    def drain(self, timeout=None):
+        """
+        Wait until every appended record has been forwarded. Returns whether it was.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending_bytes == 0, timeout=timeout)
+
+    def sync(self):
+        with self.condition:
+            if not self.dirty:
+                return
+            self.dirty = False
+            segments = list(self.segments)
+        for segment in segments:
+            try:
+                segment.flush()
+            except ValueError:
+                # Deleted by the forwarder meanwhile
+                pass
+
+    def close(self):
+        """
+        Stop the background threads and flush the segments. Records that
+        weren't forwarded yet are picked up by the next process.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        with self.condition:
+            for segment in self.segments:
+                segment.flush()
+                segment.close()
+            self.segments = []
+        self.lock_file.close()
+
+    def _forward_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.closed or len(self.segments) > 1 or self.segments[0].pending
+                )
+                if self.closed:
+                    return
+            try:
+                self.forward_pending()
+            except Exception as e:
+                SPOOL_FORWARD_FAILURES.labels(self.name).inc()
+                logger.error(f"Error forwarding records from {self.name}: {e}")
+                with self.condition:
+                    self.condition.wait_for(lambda: self.closed, timeout=self.retry_interval)
+
+    def _sync_loop(self):
+        while True:
+            with self.condition:
+                if self.condition.wait_for(lambda: self.closed, timeout=self.fsync_interval):
+                    return
+            self.sync()
+
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+def get_spool(name, forward):
+    """
+    Return the process wide spool registered under ``name``, created below
+    ``TCP_SPOOL_DIR`` from the ``TCP_SPOOL_*`` settings on first use.
+    """
+    with _spools_lock:
+        if name not in _spools:
+            _spools[name] = Spool(
+                os.path.join(settings.TCP_SPOOL_DIR, name),
+                forward,
+                segment_size=settings.TCP_SPOOL_SEGMENT_SIZE,
+                max_bytes=settings.TCP_SPOOL_MAX_BYTES,
+                fsync_ms=settings.TCP_SPOOL_FSYNC_MS,
+                forward_records=settings.TCP_SPOOL_FORWARD_RECORDS,
+                retry_interval=settings.TCP_SPOOL_RETRY_INTERVAL,
+                retry_after=settings.ADMISSION_RETRY_AFTER,
+                name=f'{name}-spool',
+            )
+        return _spools[name]
+
+
+def spooled_records(name):
+    """
+    Number of records appended to the spool registered under ``name`` by this
+    process and not forwarded yet, 0 if there is none.
+    """
+    with _spools_lock:
+        spool = _spools.get(name)
+    return spool.pending_records if spool is not None else 0
+
+
+@atexit.register
+def close_spools():
+    """
+    Flush every spool to disk, called on interpreter shutdown.
+    """
+    with _spools_lock:
+        spools = list(_spools.values())
+        _spools.clear()
+    for spool in spools:
+        spool.close()
@@ -0,0 +1,122 @@
+import csv
+import io
+import json
+import zlib
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+
+def format_datetime(value):
+    """
+    Format a datetime the way DRF's ``DateTimeField`` does by default.
+    """
+    if value is None:
+        return None
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def format_decimal(value):
+    """
+    Format a decimal the way DRF's ``DecimalField`` does by default.
+    """
+    return None if value is None else '{:f}'.format(value)
+
+
+def stream_json_array(items, rows_per_chunk=500):
+    """
+    Encode an iterable of dictionaries as a JSON array, yielding it in chunks
+    of ``rows_per_chunk`` items so the whole response is never held in memory.
+    """
+    yield b'['
+    encoder = json.JSONEncoder()
+    buffer = []
+    first = True
+    for item in items:
+        encoded = encoder.encode(item)
+        buffer.append(encoded if first else ',' + encoded)
+        first = False
+        if len(buffer) >= rows_per_chunk:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+    yield b']'
+
+
+def stream_ndjson(items, rows_per_chunk=500):
+    """
+    Encode an iterable of dictionaries as newline delimited JSON chunks.
+    """
+    encoder = json.JSONEncoder()
+    buffer = []
+    for item in items:
+        buffer.append(encoder.encode(item))
+        if len(buffer) >= rows_per_chunk:
+            yield ('\n'.join(buffer) + '\n').encode('utf-8')
+            buffer = []
+    if buffer:
+        yield ('\n'.join(buffer) + '\n').encode('utf-8')
+
+
+def stream_csv(items, fields, rows_per_chunk=500):
+    """
+    Encode an iterable of dictionaries as CSV chunks with a header row.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    rows = 0
+    for item in items:
+        writer.writerow([item[field] for field in fields])
+        rows += 1
+        if rows >= rows_per_chunk:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            rows = 0
+    yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_stream(chunks, level=6):
+    """
+    Gzip a stream of byte chunks on the fly.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+}
+
+
+def export_response(items, fields, output, compress=False, filename='export'):
+    """
+    Build a streaming file download of ``items`` in one of ``EXPORT_FORMATS``,
+    optionally gzipped on the fly.
+    """
+    content_type, extension = EXPORT_FORMATS[output]
+    if output == 'csv':
+        chunks = stream_csv(items, fields)
+    else:
+        chunks = stream_ndjson(items)
+
+    filename = f'{filename}.{extension}'
+    if compress:
+        chunks = gzip_stream(chunks)
+        content_type = 'application/gzip'
+        filename += '.gz'
+
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -16,9 +16,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from .views import metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('tracking/', include('tracking.urls')),
     path('tcp_tracking/', include('tcp_tracking.urls')),
+    path('metrics/', metrics, name='metrics'),
 ]
\ No newline at end of file
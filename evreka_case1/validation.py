@@ -0,0 +1,209 @@
+"""
+Fast path validation of ingested device data.
+
+``DeviceDataValidator`` makes the same accept/reject decisions and produces the
+same validated data and error shapes as ``DeviceDataInputSerializer`` with
+``many=True``, without building a DRF field tree for every record.
+"""
+from collections.abc import Mapping
+from django.core.validators import ProhibitNullCharactersValidator
+from django.utils.dateparse import parse_datetime
+from rest_framework import fields, serializers
+from rest_framework.exceptions import ErrorDetail, ValidationError
+from rest_framework.settings import api_settings
+from rest_framework.validators import ProhibitSurrogateCharactersValidator
+
+CHAR_FIELDS = ('device_id', 'location')
+MAX_LENGTH = 255
+
+# Largest speed magnitude the DecimalField(max_digits=10, decimal_places=2) columns hold
+MAX_SPEED = 99999999.99
+
+
+def error(message, code, **params):
+    return ErrorDetail(str(message).format(**params), code=code)
+
+
+class DeviceDataValidator:
+    """
+    Validator for the ``device_id``/``location``/``speed``/``timestamp`` schema.
+
+    ``serializer_class`` is only used for the cases the fast path does not
+    handle itself (HTML form input, non ISO 8601 timestamps) and for the exact
+    timezone handling of parsed timestamps.
+    """
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        serializer_fields = serializer_class().fields
+        self.timestamp_field = serializer_fields['timestamp']
+        self.speed_min = serializer_fields['speed'].min_value
+        self.speed_max = serializer_fields['speed'].max_value
+
+    def validate_char(self, value):
+        """
+        Mirror ``CharField(max_length=255)``: returns ``(value, errors)``.
+        """
+        if value is fields.empty:
+            return None, [error(fields.Field.default_error_messages['required'], 'required')]
+        if isinstance(value, str):
+            value = value.strip()
+            if not value:
+                return None, [error(fields.CharField.default_error_messages['blank'], 'blank')]
+        elif value is None:
+            return None, [error(fields.Field.default_error_messages['null'], 'null')]
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            # The serializer tests blank values before the type, e.g. on str(value)
+            if str(value).strip() == '':
+                return None, [error(fields.CharField.default_error_messages['blank'], 'blank')]
+            return None, [error(fields.CharField.default_error_messages['invalid'], 'invalid')]
+        else:
+            value = str(value).strip()
+
+        errors = []
+        if len(value) > MAX_LENGTH:
+            errors.append(error(fields.CharField.default_error_messages['max_length'], 'max_length', max_length=MAX_LENGTH))
+        if '\x00' in value:
+            errors.append(error(ProhibitNullCharactersValidator.message, ProhibitNullCharactersValidator.code))
+        if not value.isascii():
+            for character in value:
+                if 0xD800 <= ord(character) <= 0xDFFF:
+                    errors.append(error(
+                        ProhibitSurrogateCharactersValidator.message,
+                        ProhibitSurrogateCharactersValidator.code,
+                        code_point=ord(character),
+                    ))
+                    break
+        return (None, errors) if errors else (value, None)
+
+    def validate_speed(self, value):
+        """
+        Mirror ``FloatField(min_value=..., max_value=...)``: returns ``(value, errors)``.
+        """
+        if value.__class__ is not float:
+            if value is fields.empty:
+                return None, [error(fields.Field.default_error_messages['required'], 'required')]
+            if value is None:
+                return None, [error(fields.Field.default_error_messages['null'], 'null')]
+            if isinstance(value, str) and len(value) > fields.FloatField.MAX_STRING_LENGTH:
+                return None, [error(fields.FloatField.default_error_messages['max_string_length'], 'max_string_length')]
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return None, [error(fields.FloatField.default_error_messages['invalid'], 'invalid')]
+            except OverflowError:
+                return None, [error(fields.FloatField.default_error_messages['overflow'], 'overflow')]
+        if self.speed_max is not None and value > self.speed_max:
+            return None, [error(fields.FloatField.default_error_messages['max_value'], 'max_value', max_value=self.speed_max)]
+        if self.speed_min is not None and value < self.speed_min:
+            return None, [error(fields.FloatField.default_error_messages['min_value'], 'min_value', min_value=self.speed_min)]
+        return value, None
+
+    def current_timezone(self):
+        field = self.timestamp_field
+        return field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+
+    def validate_timestamp(self, value, field_timezone=fields.empty):
+        """
+        Mirror ``DateTimeField(required=False)``: returns ``(value, errors)``.
+        ISO 8601 strings are parsed here, anything else goes through the field.
+        """
+        if isinstance(value, str):
+            try:
+                parsed = parse_datetime(value)
+            except ValueError:
+                parsed = None
+            if parsed is not None:
+                if field_timezone is fields.empty:
+                    field_timezone = self.current_timezone()
+                if field_timezone is not None and parsed.tzinfo is not None:
+                    # Looking up the current timezone per record is the costly part of enforce_timezone()
+                    try:
+                        return parsed.astimezone(field_timezone), None
+                    except OverflowError:
+                        pass
+                try:
+                    return self.timestamp_field.enforce_timezone(parsed), None
+                except ValidationError as e:
+                    return None, e.detail
+        try:
+            return self.timestamp_field.run_validation(value), None
+        except ValidationError as e:
+            return None, e.detail
+
+    def validate(self, item, field_timezone=fields.empty):
+        """
+        Validate a single record, returning a ``(validated_data, errors)`` pair
+        where exactly one of both is ``None``.
+        """
+        if item is None:
+            return None, [error(fields.Field.default_error_messages['null'], 'null')]
+        if not isinstance(item, Mapping):
+            message = serializers.Serializer.default_error_messages['invalid']
+            return None, {api_settings.NON_FIELD_ERRORS_KEY: [error(message, 'invalid', datatype=type(item).__name__)]}
+
+        validated = {}
+        errors = {}
+        for name in CHAR_FIELDS:
+            value, field_errors = self.validate_char(item.get(name, fields.empty))
+            if field_errors:
+                errors[name] = field_errors
+            else:
+                validated[name] = value
+
+        value, field_errors = self.validate_speed(item.get('speed', fields.empty))
+        if field_errors:
+            errors['speed'] = field_errors
+        else:
+            validated['speed'] = value
+
+        if 'timestamp' in item:
+            value, field_errors = self.validate_timestamp(item['timestamp'], field_timezone)
+            if field_errors:
+                errors['timestamp'] = field_errors
+            else:
+                validated['timestamp'] = value
+
+        return (None, errors) if errors else (validated, None)
+
+    def validate_many(self, records):
+        """
+        Validate a list of records like ``serializer_class(data=records, many=True)``.
+
+        Returns ``(validated_data, errors)``: ``validated_data`` is None unless
+        every record is valid, ``errors`` has one entry per record (an empty
+        dict for valid records) and is None when every record is valid.
+        """
+        if any(hasattr(item, 'getlist') for item in records):
+            # HTML form input has its own empty value semantics
+            serializer = self.serializer_class(data=records, many=True)
+            if serializer.is_valid():
+                return [dict(item) for item in serializer.validated_data], None
+            return None, list(serializer.errors)
+
+        field_timezone = self.current_timezone()
+        validated = []
+        errors = []
+        invalid = False
+        for item in records:
+            data, item_errors = self.validate(item, field_timezone)
+            if item_errors:
+                invalid = True
+                errors.append(item_errors)
+            else:
+                validated.append(data)
+                errors.append({})
+        return (None, errors) if invalid else (validated, None)
+
+    def validate_each(self, records):
+        """
+        Validate a list of records, returning a ``(validated_data, errors)``
+        pair per record so valid records can be kept when others are rejected.
+        """
+        if any(hasattr(item, 'getlist') for item in records):
+            return [
+                (data[0], None) if data is not None else (None, errors[0])
+                for data, errors in (self.validate_many([item]) for item in records)
+            ]
+        field_timezone = self.current_timezone()
+        return [self.validate(item, field_timezone) for item in records]
@@ -0,0 +1,9 @@
+from django.http import HttpResponse
+from .metrics import CONTENT_TYPE, REGISTRY
+
+
+def metrics(request):
+    """
+    Expose the metrics of this process in the Prometheus text format.
+    """
+    return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,153 @@
+"""
+Compact binary frame format for the TCP server.
+
+A frame is a fixed size header followed by ``count`` fixed width records, all
+fields in network byte order::
+
+    header:  magic (u8, 0xEB) | version (u8) | device id width (u8) | reserved (u8) | count (u32)
+    record:  device id (width bytes, UTF-8, NUL padded) | timestamp (i64, epoch millis, 0 = server time)
+             | latitude (f64) | longitude (f64) | speed (f32)
+
+The server answers every frame with an acknowledgement::
+
+    ack:     magic (u8) | status (u8) | accepted record count (u32)
+
+The magic byte can never start a JSON or a length prefixed frame, so binary and
+JSON clients share the same port.
+"""
+import math
+import struct
+from datetime import datetime, timezone
+from evreka_case1.validation import MAX_SPEED
+
+MAGIC = 0xEB
+VERSION = 1
+DEFAULT_DEVICE_ID_WIDTH = 16
+
+HEADER = struct.Struct('!BBBxI')
+ACK = struct.Struct('!BBI')
+
+STATUS_OK = 0
+STATUS_INVALID = 1
+STATUS_ERROR = 2
+STATUS_BUSY = 3  # Not accepted because of admission control, resend later
+
+
+class BinaryFrameError(ValueError):
+    pass
+
+
+def record_struct(device_id_width):
+    return struct.Struct(f'!{device_id_width}sqddf')
+
+
+def to_epoch_millis(timestamp):
+    if timestamp is None:
+        return 0
+    if isinstance(timestamp, datetime):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return int(timestamp.timestamp() * 1000)
+    return int(timestamp)
+
+
+def encode_batch(records, device_id_width=DEFAULT_DEVICE_ID_WIDTH):
+    """
+    Encode records into a binary frame. This is the client side encoder.
+
+    Every record is a dictionary with ``device_id``, ``latitude``, ``longitude``,
+    ``speed`` and an optional ``timestamp`` (datetime or epoch millis).
+    """
+    record = record_struct(device_id_width)
+    buffer = bytearray(HEADER.size + record.size * len(records))
+    HEADER.pack_into(buffer, 0, MAGIC, VERSION, device_id_width, len(records))
+
+    offset = HEADER.size
+    for item in records:
+        device_id = item['device_id'].encode('utf-8')
+        if len(device_id) > device_id_width:
+            raise BinaryFrameError(f"Device id {item['device_id']!r} is longer than {device_id_width} bytes")
+        record.pack_into(
+            buffer,
+            offset,
+            device_id,
+            to_epoch_millis(item.get('timestamp')),
+            item['latitude'],
+            item['longitude'],
+            item['speed'],
+        )
+        offset += record.size
+    return bytes(buffer)
+
+
+def decode_header(header):
+    """
+    Decode a frame header, returning ``(device_id_width, count, payload_size)``.
+    """
+    magic, version, device_id_width, count = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise BinaryFrameError('Invalid magic byte')
+    if version != VERSION:
+        raise BinaryFrameError(f'Unsupported version {version}')
+    if device_id_width == 0:
+        raise BinaryFrameError('Invalid device id width')
+    return device_id_width, count, count * record_struct(device_id_width).size
+
+
+def decode_records(device_id_width, payload):
+    """
+    Decode the records of a frame in bulk.
+
+    Returns a ``(records, errors)`` pair. Records have the same shape as the
+    validated data of ``DeviceDataInputSerializer``, errors map the index of a
+    rejected record to its error messages.
+    """
+    records = []
+    errors = {}
+    for index, (device_id, millis, latitude, longitude, speed) in enumerate(
+        record_struct(device_id_width).iter_unpack(payload)
+    ):
+        try:
+            device_id = device_id.rstrip(b'\x00').decode('utf-8').strip()
+        except UnicodeDecodeError:
+            device_id = ''
+        if not device_id:
+            errors[index] = {'device_id': ['This field may not be blank.']}
+            continue
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            errors[index] = {'location': ['Invalid coordinates.']}
+            continue
+        if not math.isfinite(speed):
+            errors[index] = {'speed': ['A valid number is required.']}
+            continue
+        if abs(speed) > MAX_SPEED:
+            errors[index] = {'speed': [f'Ensure this value is less than or equal to {MAX_SPEED}.']}
+            continue
+
+        record = {
+            'device_id': device_id,
+            'location': f'{latitude}, {longitude}',
+            'speed': speed,
+        }
+        if millis:
+            try:
+                record['timestamp'] = datetime.fromtimestamp(millis / 1000, tz=timezone.utc)
+            except (OverflowError, OSError, ValueError):
+                errors[index] = {'timestamp': ['Invalid timestamp.']}
+                continue
+        records.append(record)
+    return records, errors
+
+
+def encode_ack(status, count):
+    return ACK.pack(MAGIC, status, count)
+
+
+def decode_ack(data):
+    """
+    Decode an acknowledgement, returning ``(status, count)``. Client side helper.
+    """
+    magic, status, count = ACK.unpack(data)
+    if magic != MAGIC:
+        raise BinaryFrameError('Invalid magic byte')
+    return status, count
@@ -0,0 +1,70 @@
+from django.conf import settings
+from evreka_case1.coalescer import buffered_records, get_coalescer
+from evreka_case1.dedup import drop_recent_duplicates, get_recent_keys
+from evreka_case1.ingest import dispatch_chunks
+from evreka_case1.metrics import DISPATCH_SECONDS
+from evreka_case1.pipeline import direct_pipeline, get_direct_writer
+from evreka_case1.spool import get_spool, spooled_records
+from .models import IngestBatch
+from .tasks import process_tcp_data, writer
+
+
+def send_batch(batch, track=False, wait=False):
+    if direct_pipeline():
+        return get_direct_writer('tcp_tracking', writer).add(batch, IngestBatch if track else None, wait)
+    with DISPATCH_SECONDS.labels('process_tcp_data').time():
+        return dispatch_chunks(process_tcp_data, batch, settings.INGEST_CHUNK_SIZE, IngestBatch if track else None)
+
+
+def forward_spooled(batch):
+    # A spooled batch is only dropped from the spool once it is stored by a direct writer
+    send_batch(batch, wait=True)
+
+
+def get_tcp_spool():
+    return get_spool('tcp_tracking', forward_spooled)
+
+
+def buffered_tcp_data():
+    """
+    Records admitted by this process and still held by its coalescer or spool.
+    """
+    return buffered_records('tcp_tracking') + spooled_records('tcp_tracking')
+
+
+def dispatch_tcp_data(validated_data, track=False):
+    """
+    Queue validated TCP data for processing.
+
+    With ``INGEST_COALESCE`` enabled the records are buffered and sent to the
+    Celery task in batches instead of one task per message.
+
+    With ``TCP_SPOOL_DIR`` set the records are appended to the local
+    write-ahead spool instead, which forwards them to the Celery task in the
+    background. Raises ``SpoolFull`` when it has reached its size limit.
+
+    With ``INGEST_PIPELINE = 'direct'`` the records are stored by the direct
+    writer of this process instead of the Celery task, without coalescing.
+
+    With ``INGEST_DEDUP`` enabled records seen recently by this process are dropped.
+
+    With ``track`` the records are never buffered or spooled and the progress of the
+    batch is kept in IngestBatch. Returns its id, ``None`` when not tracked
+    or all of the records are duplicates.
+    """
+    records, keys = drop_recent_duplicates('tcp_tracking', validated_data)
+    if not records:
+        return None
+    try:
+        if settings.TCP_SPOOL_DIR and not track:
+            get_tcp_spool().append(records)
+            return None
+        if settings.INGEST_COALESCE and not track and not direct_pipeline():
+            coalescer = get_coalescer('tcp_tracking', send_batch)
+            coalescer.add(records)
+            return None
+        return send_batch(records, track)
+    except Exception:
+        # Nothing was queued, a resend of these records must not be dropped
+        get_recent_keys('tcp_tracking').forget(keys)
+        raise
@@ -3,4 +3,12 @@ class BaseTrackingException(Exception):
 
 
 class InvalidTimeException(BaseTrackingException):
-    pass
\ No newline at end of file
+    pass
+
+
+class InvalidBoundingBoxException(BaseTrackingException):
+    pass
+
+
+class FrameTooLargeException(BaseTrackingException):
+    pass
@@ -0,0 +1,47 @@
+import logging
+from evreka_case1.latest import LatestCache, iter_latest, upsert_latest
+from evreka_case1.streaming import format_datetime
+from .models import LatestDeviceData
+from .serializers import DeviceDataInputSerializer
+
+logger = logging.getLogger(__name__)
+
+latest_cache = LatestCache('tcp_tracking', lambda instance: DeviceDataInputSerializer(instance).data)
+
+
+def get_latest_device_data(device_id):
+    """
+    Return the serialized latest record of a device, or None if it has no data.
+    """
+    return latest_cache.get(
+        device_id,
+        lambda: LatestDeviceData.objects.filter(device_id=device_id).first(),
+    )
+
+
+def update_latest_device_data(instances):
+    """
+    Update the latest records and the cache from newly stored device data.
+
+    The latest store can always be rebuilt from the history table, so a failure
+    here is logged instead of failing the ingest.
+    """
+    try:
+        latest_cache.update(upsert_latest(LatestDeviceData, instances))
+    except Exception as e:
+        logger.error(f"Error updating latest device data: {e}")
+
+
+def iter_latest_device_data(device_ids=None):
+    """
+    Yield the latest record of the given devices (or of every device) as
+    dictionaries shaped like ``DeviceDataInputSerializer`` output, without
+    the serializer overhead.
+    """
+    for _, device_id, timestamp, location, speed in iter_latest(LatestDeviceData, device_ids):
+        yield {
+            'device_id': device_id,
+            'location': location,
+            'speed': float(speed),
+            'timestamp': format_datetime(timestamp),
+        }
@@ -0,0 +1,39 @@
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from evreka_case1.ingest import replay_dead_letters
+from tcp_tracking.models import DeadLetter
+from tcp_tracking.tasks import writer
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay or purge the TCP device data records the ingest could not store. '
+        'Replayed records are deleted from the dead-letter table, records failing again keep their row.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['replay', 'purge'])
+        parser.add_argument('--before', help='Only the records dead-lettered before this date.')
+        parser.add_argument('--id', type=int, action='append', dest='ids', help='Only this record, can be repeated.')
+
+    def handle(self, *args, **options):
+        letters = DeadLetter.objects.all()
+        before = options['before']
+        if before:
+            try:
+                before = parse(before)
+            except (ValueError, OverflowError):
+                raise CommandError(f'Invalid date format: {before}')
+            if timezone.is_naive(before):
+                before = timezone.make_aware(before)
+            letters = letters.filter(created_at__lt=before)
+        if options['ids']:
+            letters = letters.filter(pk__in=options['ids'])
+
+        if options['action'] == 'purge':
+            count, _ = letters.delete()
+            self.stdout.write(self.style.SUCCESS(f'Purged {count} records.'))
+        else:
+            replayed, failed = replay_dead_letters(writer, letters)
+            self.stdout.write(self.style.SUCCESS(f'Replayed {replayed} records, {failed} failed again.'))
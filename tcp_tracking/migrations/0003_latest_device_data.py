@@ -0,0 +1,48 @@
+# Generated by Django 5.1.3 on 2026-10-18 08:33
+
+from django.db import migrations, models
+
+
+def backfill_latest_device_data(apps, schema_editor):
+    """
+    Fill the latest store with the newest history record of every device.
+    Each lookup is a single seek on the (device_id, timestamp) index.
+    """
+    DeviceData = apps.get_model('tcp_tracking', 'DeviceData')
+    LatestDeviceData = apps.get_model('tcp_tracking', 'LatestDeviceData')
+
+    rows = []
+    device_ids = DeviceData.objects.values_list('device_id', flat=True).distinct().order_by()
+    for device_id in device_ids.iterator():
+        newest = DeviceData.objects.filter(device_id=device_id).order_by('-timestamp', '-id').first()
+        rows.append(LatestDeviceData(
+            device_id=newest.device_id,
+            timestamp=newest.timestamp,
+            location=newest.location,
+            speed=newest.speed,
+        ))
+        if len(rows) >= 1000:
+            LatestDeviceData.objects.bulk_create(rows)
+            rows = []
+    LatestDeviceData.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tcp_tracking', '0002_device_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LatestDeviceData',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.CharField(max_length=255, unique=True)),
+                ('timestamp', models.DateTimeField()),
+                ('location', models.CharField(max_length=255)),
+                ('speed', models.DecimalField(decimal_places=2, max_digits=10)),
+            ],
+        ),
+        migrations.RunPython(backfill_latest_device_data, migrations.RunPython.noop),
+    ]
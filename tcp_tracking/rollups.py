@@ -0,0 +1,60 @@
+import logging
+from django.db import transaction
+from evreka_case1.pagination import keyset_iterator
+from evreka_case1.rollups import RESOLUTIONS, aggregate_records, bucket_start, merge_rollups, serialize_rollup, update_rollups
+from .models import DeviceData, DeviceDataRollup
+
+logger = logging.getLogger(__name__)
+
+
+def update_device_data_rollups(instances):
+    """
+    Fold newly stored device data into the rollups.
+
+    The rollups can always be rebuilt from the history table with the
+    ``rebuild_tcp_rollups`` command, so a failure here is logged instead of failing the ingest.
+    """
+    try:
+        update_rollups(DeviceDataRollup, instances)
+    except Exception as e:
+        logger.error(f"Error updating device data rollups: {e}")
+
+
+def rebuild_device_data_rollups(since=None, chunk_size=5000):
+    """
+    Recompute the rollups from the history table, from the start of the day
+    of ``since`` or from the beginning. Returns the number of records read.
+    """
+    rollups = DeviceDataRollup.objects.all()
+    records = DeviceData.objects.order_by('-timestamp', '-id').values_list('timestamp', 'id', 'device_id', 'location', 'speed')
+    if since is not None:
+        since = bucket_start(since, max(RESOLUTIONS.values()))
+        rollups = rollups.filter(bucket__gte=since)
+        records = records.filter(timestamp__gte=since)
+
+    with transaction.atomic():
+        rollups.delete()
+        count = 0
+        chunk = []
+        for timestamp, pk, device_id, location, speed in keyset_iterator(records, position=lambda row: row[:2], chunk_size=chunk_size):
+            chunk.append((device_id, timestamp, location, speed))
+            if len(chunk) >= chunk_size:
+                merge_rollups(DeviceDataRollup, aggregate_records(chunk))
+                count += len(chunk)
+                chunk = []
+        merge_rollups(DeviceDataRollup, aggregate_records(chunk))
+    return count + len(chunk)
+
+
+def get_device_data_rollups(device_id, resolution, start, end):
+    """
+    Return the serialized rollups of a device at ``resolution`` with buckets
+    overlapping ``start`` to ``end``, oldest first.
+    """
+    seconds = RESOLUTIONS[resolution]
+    rows = DeviceDataRollup.objects.filter(
+        device_id=device_id,
+        resolution=seconds,
+        bucket__range=(bucket_start(start, seconds), end),
+    ).order_by('bucket')
+    return [serialize_rollup(row) for row in rows]
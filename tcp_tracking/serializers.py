@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from evreka_case1.validation import MAX_SPEED, DeviceDataValidator
 from .models import DeviceData
 
 class DeviceDataSerializer(serializers.ModelSerializer):
@@ -10,5 +11,9 @@ class DeviceDataSerializer(serializers.ModelSerializer):
 class DeviceDataInputSerializer(serializers.Serializer):
     device_id = serializers.CharField(max_length=255)
     location = serializers.CharField(max_length=255)
-    speed = serializers.FloatField()
-    timestamp = serializers.DateTimeField(required=False)
\ No newline at end of file
+    speed = serializers.FloatField(min_value=-MAX_SPEED, max_value=MAX_SPEED)
+    timestamp = serializers.DateTimeField(required=False)
+
+
+# Fast path equivalent of DeviceDataInputSerializer used on the ingest hot path
+device_data_validator = DeviceDataValidator(DeviceDataInputSerializer)
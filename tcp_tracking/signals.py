@@ -0,0 +1,15 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from .models import DeviceData
+from .latest import update_latest_device_data
+
+
+@receiver(post_save, sender=DeviceData)
+def update_latest_on_save(sender, instance, created, **kwargs):
+    """
+    Keep the latest store in sync with records saved one by one (admin, shell).
+    The ingest task uses bulk_create, which does not send this signal, and
+    updates the latest store itself.
+    """
+    if created:
+        update_latest_device_data([instance])
@@ -1,10 +1,16 @@
 from celery import shared_task
-from django.utils import timezone
-from .models import DeviceData
+from django.conf import settings
+from evreka_case1.ingest import IngestWriter, expire_batches
+from .models import DeadLetter, DeviceData, IngestBatch
+from .latest import update_latest_device_data
+from .rollups import update_device_data_rollups
 import logging
 logger = logging.getLogger(__name__)
-@shared_task
-def process_tcp_data(data_list):
+# Shared with the batching consumer (consume_ingest)
+writer = IngestWriter(DeviceData, DeadLetter, IngestBatch, after_save=[update_latest_device_data, update_device_data_rollups])
+
+@shared_task(ignore_result=True, serializer=settings.INGEST_TASK_SERIALIZER)
+def process_tcp_data(data_list, batch_id=None):
     """
     This function processes a list of device data and stores them in the database.
 
@@ -12,26 +18,29 @@ def process_tcp_data(data_list):
     data_list (list): A list of dictionaries, where each dictionary represents a device data.
                       The dictionary should have the following keys: 'device_id', 'location', 'speed', and optionally 'timestamp'.
                       If 'timestamp' is not provided, the current time will be used.
+    batch_id (str): The tracked IngestBatch this chunk belongs to, if any.
 
     Returns:
     None
 
+    Records that can't be stored are written to the DeadLetter table, the rest of the batch is stored.
+
     Raises:
-    Exception: If any error occurs during the processing of device data.
+    Exception: If any other error (e.g. a lost database connection) occurs during the processing of device data.
     """
     try:
-
-        device_data_instances = [
-            DeviceData(
-                device_id=data['device_id'],
-                location=data['location'],
-                speed=data['speed'],
-                timestamp=data['timestamp'] if 'timestamp' in data else timezone.now()
-            )
-            for data in data_list
-        ]
-        DeviceData.objects.bulk_create(device_data_instances)
+        device_data_instances = writer.store(data_list)
         logger.info(f"Successfully processed {len(device_data_instances)} device data.")
     except Exception as e:
         logger.error(f"Error processing device data: {e}")
-        raise
\ No newline at end of file
+        writer.finish_batch(batch_id, failed=True)
+        raise
+    writer.finish_batch(batch_id, len(device_data_instances))
+
+@shared_task(ignore_result=True)
+def expire_ingest_batches():
+    """
+    Delete the tracked ingest batches older than INGEST_BATCH_TTL, run periodically by Celery beat.
+    """
+    count = expire_batches(IngestBatch, settings.INGEST_BATCH_TTL)
+    logger.info(f"Expired {count} ingest batches.")
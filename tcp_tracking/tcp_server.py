@@ -4,6 +4,11 @@ import socket
 import threading
 import sys
 import json
+import asyncio
+import argparse
+import multiprocessing
+import signal
+import time
 
 # Add the project root directory to sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -12,61 +17,121 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'evreka_case1.settings')
 django.setup()
 # This can't be imported without Django settings module installed
-from tcp_tracking.serializers import DeviceDataInputSerializer
-from tcp_tracking.tasks import process_tcp_data
+from django.conf import settings
+from django.db import connections
+from tcp_tracking.serializers import device_data_validator
+from tcp_tracking.dispatch import buffered_tcp_data, dispatch_tcp_data, get_tcp_spool
+from tcp_tracking.exceptions import FrameTooLargeException
+from tcp_tracking import binary_protocol
+from evreka_case1.admission import AdmissionRejected, get_admission_controller
+from evreka_case1.metrics import record_validation, start_metrics_server
 HOST = '0.0.0.0'
 PORT = 9999
 
-def handle_client_connection(client_socket):
+# Frames starting with a NUL byte carry a 4 byte big-endian length prefix,
+# frames starting with the binary protocol magic byte are binary batches and
+# anything else is read up to the next newline.
+LENGTH_PREFIX_SIZE = 4
+FRAMING_LINE = 'line'
+FRAMING_LENGTH = 'length'
+FRAMING_BINARY = 'binary'
+
+
+class WorkerCounters:
+    """
+    Accepted connection and processed record counters of a server process.
+
+    The counters live in shared memory so the supervisor can report them for
+    every worker process it manages.
+    """
+    ACCEPTED = 0
+    PROCESSED = 1
+
+    def __init__(self, values=None):
+        self.values = values if values is not None else multiprocessing.Array('Q', 2)
+
+    def connection_accepted(self):
+        with self.values.get_lock():
+            self.values[self.ACCEPTED] += 1
+
+    def records_processed(self, count):
+        with self.values.get_lock():
+            self.values[self.PROCESSED] += count
+
+    @property
+    def accepted(self):
+        return self.values[self.ACCEPTED]
+
+    @property
+    def processed(self):
+        return self.values[self.PROCESSED]
+
+
+# Counters of the current process, replaced in every forked worker
+counters = WorkerCounters()
+
+
+def process_payload(data_json):
+    """
+    Validate a decoded JSON payload and hand it over to the Celery task.
+
+    Returns the response dictionary that should be sent back to the client.
+    """
+    # Ensure the data is a list for processing
+    data_list = data_json if isinstance(data_json, list) else [data_json]
+
+    # Validate the data, same rules as DeviceDataInputSerializer
+    validated_data, errors = device_data_validator.validate_many(data_list)
+    record_validation('tcp', len(data_list), 0 if errors is None else sum(1 for error in errors if error))
+    if errors is None:
+        # Send the validated data to the Celery task
+        try:
+            # Blocks while ingest is overloaded, so the connection isn't read meanwhile
+            with get_admission_controller('tcp', buffered_tcp_data).admit(validated_data, wait=settings.ADMISSION_TCP_MAX_WAIT):
+                batch_id = dispatch_tcp_data(validated_data, track=settings.TCP_TRACK_BATCHES)
+        except AdmissionRejected as e:
+            return {'message': str(e), 'retry_after': e.retry_after}
+        counters.records_processed(len(validated_data))
+        return {'message': 'Data received', 'batch_id': batch_id, 'data': data_list}
+
+    # Identify missing fields
+    required_fields = {'device_id', 'location', 'speed'}
+    missing_fields = set()
+
+    for item in data_list:
+        if not isinstance(item, dict):
+            continue  # Skip invalid items
+        missing_fields.update(required_fields - item.keys())
+
+    if missing_fields:
+        return {'message': f"Invalid input data. Missing fields: {', '.join(missing_fields)}"}
+    return {'message': 'Invalid input data format.'}
+
+
+def process_raw_message(raw):
+    """
+    Decode a raw JSON message and process it, returning the response dictionary.
+    """
+    try:
+        # Parse the data as JSON
+        data_json = json.loads(raw)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return {'message': 'Invalid JSON format.'}
+    return process_payload(data_json)
+
+
+def handle_client_connection(client_socket, slots=None):
     """
     Handle incoming client connection by reading data from the socket,
     processing it asynchronously, and sending a confirmation back to the client.
+    ``slots`` is released once the connection is closed.
     """
+    counters.connection_accepted()
     try: 
         # Receive and decode the incoming data
         data = client_socket.recv(1024).decode('utf-8')
-        
-        try:
-            # Parse the data as JSON
-            data_json = json.loads(data)
-        except json.JSONDecodeError:
-            error_message = "Invalid JSON format."
-            client_socket.send(b'{"message": "' + error_message.encode('utf-8') + b'"}')
-            return
-
-        # Ensure the data is a list for processing
-        data_list = data_json if isinstance(data_json, list) else [data_json]
-
-        # Validate the data using the serializer
-        serializer = DeviceDataInputSerializer(data=data_list, many=True)
-        if serializer.is_valid():
-            validated_data = [dict(item) for item in serializer.validated_data]
-            
-            # Send the validated data to the Celery task
-            process_tcp_data.delay(validated_data)
-
-            # Send confirmation back to the client
-            client_socket.send(
-                b'{"message": "Data received", "data": ' +
-                json.dumps(data_list).encode('utf-8') +
-                b'}'
-            )
-        else:
-            # Identify missing fields
-            required_fields = {'device_id', 'location', 'speed'}
-            missing_fields = set()
-
-            for item in data_list:
-                if not isinstance(item, dict):
-                    continue  # Skip invalid items
-                missing_fields.update(required_fields - item.keys())
-
-            if missing_fields:
-                message = f"Invalid input data. Missing fields: {', '.join(missing_fields)}"
-                client_socket.send(b'{"message": "' + message.encode('utf-8') + b'"}')
-            else:
-                client_socket.send(b'{"message": "Invalid input data format."}')
-    
+        response = process_raw_message(data)
+        client_socket.send(json.dumps(response).encode('utf-8'))
     except Exception as e:
         # Log and send error back to the client
         print(f"Error processing data: {e}")
@@ -74,25 +139,344 @@ def handle_client_connection(client_socket):
     finally:
         # Close the client socket when done
         client_socket.close()
+        if slots is not None:
+            slots.release()
 
-def start_tcp_server():
+def create_server_socket(host=HOST, port=PORT, reuse_port=False, backlog=100):
     """
-    Start a TCP server that listens for incoming connections on the specified host and port.
+    Create a listening socket. With ``reuse_port`` several processes can bind
+    the same port and the kernel balances new connections between them.
     """
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((HOST, PORT))
-    server.listen(100) # Listen for 100 connections
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((host, port))
+    server.listen(backlog)
+    return server
+
+def start_tcp_server(reuse_port=False):
+    """
+    Start a TCP server that listens for incoming connections on the specified host and port.
+    """
+    server = create_server_socket(reuse_port=reuse_port) # Listen for 100 connections
     print(f'TCP server listening on {HOST}:{PORT}')
 
     ### We're keeping the connection open for multiple clients
     ### We also use threading to handle multiple clients concurrently
+    # With TCP_MAX_CONNECTIONS new connections wait in the backlog while that many are handled
+    slots = threading.BoundedSemaphore(settings.TCP_MAX_CONNECTIONS) if settings.TCP_MAX_CONNECTIONS else None
     while True:
+        if slots is not None:
+            slots.acquire()
         client_sock, address = server.accept()
         client_handler = threading.Thread(
             target=handle_client_connection,
-            args=(client_sock,)
+            args=(client_sock, slots)
         )
         client_handler.start()
 
+
+async def read_frame(reader):
+    """
+    Read a single frame from the stream.
+
+    Returns a ``(framing, payload)`` tuple, or ``None`` once the client has
+    closed the connection. Empty lines are skipped so clients can use them as
+    keep-alives.
+    """
+    while True:
+        first = await reader.read(1)
+        if not first:
+            return None
+
+        if first == b'\x00':
+            header = first + await reader.readexactly(LENGTH_PREFIX_SIZE - 1)
+            length = int.from_bytes(header, 'big')
+            if length > settings.TCP_MAX_FRAME_SIZE:
+                raise FrameTooLargeException(f'Frame of {length} bytes exceeds the limit.')
+            return FRAMING_LENGTH, await reader.readexactly(length)
+
+        if first[0] == binary_protocol.MAGIC:
+            header = first + await reader.readexactly(binary_protocol.HEADER.size - 1)
+            device_id_width, count, size = binary_protocol.decode_header(header)
+            if size > settings.TCP_MAX_FRAME_SIZE:
+                raise FrameTooLargeException(f'Frame of {size} bytes exceeds the limit.')
+            return FRAMING_BINARY, (device_id_width, await reader.readexactly(size))
+
+        try:
+            line = first + await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            # The client half-closed the connection without a trailing newline
+            line = first + e.partial
+        except asyncio.LimitOverrunError:
+            raise FrameTooLargeException('Frame exceeds the limit.')
+
+        line = line.strip()
+        if line:
+            return FRAMING_LINE, line
+
+
+def encode_frame(response, framing):
+    """
+    Encode a response dictionary using the same framing as the request.
+    """
+    body = json.dumps(response).encode('utf-8')
+    if framing == FRAMING_LENGTH:
+        return len(body).to_bytes(LENGTH_PREFIX_SIZE, 'big') + body
+    return body + b'\n'
+
+
+def process_binary_frame(device_id_width, payload):
+    """
+    Decode the records of a binary frame and hand them over to the Celery task.
+
+    Like JSON messages, a frame with any invalid record is rejected as a whole.
+    Returns the acknowledgement to send back to the client.
+    """
+    records, errors = binary_protocol.decode_records(device_id_width, payload)
+    record_validation('tcp_binary', len(records) + len(errors), len(errors))
+    if errors:
+        return binary_protocol.encode_ack(binary_protocol.STATUS_INVALID, 0)
+    if records:
+        try:
+            with get_admission_controller('tcp', buffered_tcp_data).admit(records, wait=settings.ADMISSION_TCP_MAX_WAIT):
+                dispatch_tcp_data(records)
+        except AdmissionRejected:
+            return binary_protocol.encode_ack(binary_protocol.STATUS_BUSY, 0)
+        counters.records_processed(len(records))
+    return binary_protocol.encode_ack(binary_protocol.STATUS_OK, len(records))
+
+
+def process_frame(framing, payload):
+    """
+    Process a frame read by ``read_frame`` and return the encoded response.
+    """
+    if framing == FRAMING_BINARY:
+        return process_binary_frame(*payload)
+    return encode_frame(process_raw_message(payload), framing)
+
+
+async def handle_stream_connection(reader, writer):
+    """
+    Serve a persistent client connection.
+
+    Frames are processed in order and every frame gets its own response, so a
+    tracker can keep a single connection open and stream records over it.
+    """
+    counters.connection_accepted()
+    loop = asyncio.get_running_loop()
+    idle_timeout = settings.TCP_IDLE_TIMEOUT or None
+    try:
+        while True:
+            frame = await asyncio.wait_for(read_frame(reader), timeout=idle_timeout)
+            if frame is None:
+                break
+
+            # Publishing to the broker blocks, keep it off the event loop
+            response = await loop.run_in_executor(None, process_frame, *frame)
+            writer.write(response)
+            await writer.drain()
+    except FrameTooLargeException:
+        writer.write(encode_frame({'message': 'Frame too large.'}, FRAMING_LINE))
+    except binary_protocol.BinaryFrameError:
+        # The stream can't be resynchronised after a broken header
+        writer.write(binary_protocol.encode_ack(binary_protocol.STATUS_ERROR, 0))
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        print(f"Error processing data: {e}")
+        writer.write(b'{"message": "There was an error processing the data."}\n')
+    finally:
+        writer.close()
+
+
+async def serve_stream(host=HOST, port=PORT, reuse_port=False):
+    """
+    Start the asyncio TCP server and serve until cancelled.
+    """
+    server = await asyncio.start_server(
+        handle_stream_connection,
+        sock=create_server_socket(host, port, reuse_port, settings.TCP_BACKLOG),
+        limit=settings.TCP_MAX_FRAME_SIZE,
+    )
+    print(f'Asyncio TCP server listening on {host}:{port}')
+    async with server:
+        await server.serve_forever()
+
+
+def start_asyncio_server(reuse_port=False):
+    """
+    Start the asyncio based TCP server which keeps client connections open.
+    """
+    asyncio.run(serve_stream(reuse_port=reuse_port))
+
+
+def exit_on_sigterm(signum, frame):
+    """
+    Turn SIGTERM into a normal exit so buffered records are flushed.
+    """
+    sys.exit(0)
+
+
+def start_metrics(offset=0):
+    """
+    Serve the metrics of this process on ``METRICS_TCP_PORT`` + ``offset``.
+    """
+    if settings.METRICS_TCP_PORT:
+        start_metrics_server(settings.METRICS_TCP_PORT + offset)
+        print(f'Metrics available on port {settings.METRICS_TCP_PORT + offset}')
+
+
+def start_spool():
+    """
+    Open the write-ahead spool of this process, so the records left behind
+    by a previous one are forwarded before the first new message arrives.
+    """
+    if settings.TCP_SPOOL_DIR:
+        spool = get_tcp_spool()
+        print(f'Spooling records in {spool.directory}')
+
+
+def run_worker(mode, values, index=0):
+    """
+    Entry point of a forked worker process.
+    """
+    global counters
+    counters = WorkerCounters(values)
+
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # Connections inherited from the supervisor must not be shared
+    connections.close_all()
+    # Every worker has its own metrics, served on its own port
+    start_metrics(index)
+    start_spool()
+
+    if mode == 'asyncio':
+        start_asyncio_server(reuse_port=True)
+    else:
+        start_tcp_server(reuse_port=True)
+
+
+def report_worker_counters(processes, worker_counters):
+    """
+    Print the counters of every worker so the load distribution can be checked.
+    """
+    for index, (process, values) in enumerate(zip(processes, worker_counters)):
+        pid = process.pid if process is not None else '-'
+        print(
+            f'Worker {index} (pid {pid}): '
+            f'accepted={values.accepted} processed={values.processed}'
+        )
+
+
+# Seconds before restarting a dead worker, doubled while it keeps dying
+# within RESTART_BACKOFF_RESET seconds of its start
+RESTART_BACKOFF_MIN = 1.0
+RESTART_BACKOFF_MAX = 60.0
+RESTART_BACKOFF_RESET = 60.0
+
+
+def restart_delay(previous, uptime):
+    """
+    Seconds to wait before restarting a worker that died after ``uptime``
+    seconds, the previous delay was ``previous``.
+    """
+    if not previous or uptime >= RESTART_BACKOFF_RESET:
+        return RESTART_BACKOFF_MIN
+    return min(previous * 2, RESTART_BACKOFF_MAX)
+
+
+def supervise(workers, mode):
+    """
+    Fork ``workers`` server processes that all bind the same port with
+    SO_REUSEPORT, restart the ones that die (with an exponential backoff
+    per worker) and report their counters.
+    """
+    context = multiprocessing.get_context('fork')
+    worker_counters = [WorkerCounters(context.Array('Q', 2)) for _ in range(workers)]
+    processes = [None] * workers
+    started_at = [0.0] * workers
+    delays = [0.0] * workers
+    restart_at = [None] * workers
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f'Supervising {workers} TCP server workers in {mode} mode')
+
+    last_report = time.monotonic()
+    while not stopping:
+        now = time.monotonic()
+        for index, process in enumerate(processes):
+            if process is not None:
+                if process.is_alive():
+                    continue
+                if restart_at[index] is None:
+                    delays[index] = restart_delay(delays[index], now - started_at[index])
+                    restart_at[index] = now + delays[index]
+                    print(
+                        f'Worker {index} (pid {process.pid}) exited with {process.exitcode}, '
+                        f'restarting in {delays[index]:.0f}s'
+                    )
+                if now < restart_at[index]:
+                    continue
+            process = context.Process(
+                target=run_worker,
+                args=(mode, worker_counters[index].values, index),
+                name=f'tcp-worker-{index}',
+            )
+            process.start()
+            processes[index] = process
+            started_at[index] = now
+            restart_at[index] = None
+
+        if time.monotonic() - last_report >= settings.TCP_STATS_INTERVAL:
+            report_worker_counters(processes, worker_counters)
+            last_report = time.monotonic()
+        time.sleep(1)
+
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    report_worker_counters(processes, worker_counters)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Device tracking TCP server')
+    parser.add_argument(
+        '--mode',
+        choices=['threaded', 'asyncio'],
+        default=settings.TCP_SERVER_MODE,
+        help='threaded: one thread and one message per connection, '
+             'asyncio: persistent connections with framed messages',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=settings.TCP_WORKERS,
+        help='number of server processes sharing the port, 0 uses the CPU count',
+    )
+    args = parser.parse_args(argv)
+
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    workers = args.workers or os.cpu_count()
+    if workers > 1:
+        supervise(workers, args.mode)
+        return
+
+    start_metrics()
+    start_spool()
+    if args.mode == 'asyncio':
+        start_asyncio_server()
+    else:
+        start_tcp_server()
+
 if __name__ == '__main__':
-    start_tcp_server()
+    main()
@@ -1,11 +1,26 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
 from unittest.mock import patch, MagicMock
 from django.utils.timezone import now
-from tcp_tracking.models import DeviceData
+from tcp_tracking.models import DeviceData, DeviceDataRollup
 from tcp_tracking.tasks import process_tcp_data
 from tcp_tracking.serializers import DeviceDataInputSerializer
+from tcp_tracking.latest import latest_cache
+from tcp_tracking import binary_protocol
+from evreka_case1.admission import get_admission_controller
+from evreka_case1.spool import Spool, SpoolFull, get_spool
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+import io
 import json
+import os
 import socket
+import struct
+import tempfile
+import threading
+import asyncio
 
 class DeviceDataTests(TestCase):
     def setUp(self):
@@ -66,7 +81,7 @@ class TCPServerTests(TestCase):
             {"location": "34.0522, -118.2437", "speed": 25}  # Missing device_id
         ]
         
-    @patch('tcp_tracking.tasks.process_tcp_data.delay')
+    @patch('tcp_tracking.tasks.process_tcp_data.apply_async')
     def test_handle_client_connection_valid_data(self, mock_process_tcp_data):
         """
         Test handling client connection with valid data.
@@ -82,7 +97,7 @@ class TCPServerTests(TestCase):
         handle_client_connection(mock_client_socket)
 
         # Verify data was sent to Celery task
-        mock_process_tcp_data.assert_called_once_with(self.valid_data)
+        mock_process_tcp_data.assert_called_once_with((self.valid_data,))
 
         # Check the response sent back to the client
         response = mock_client_socket.send.call_args[0][0]
@@ -128,3 +143,452 @@ class TCPServerTests(TestCase):
         response_data = json.loads(response.decode('utf-8'))
         self.assertIn("message", response_data)
         self.assertEqual(response_data["message"], "Invalid JSON format.")
+
+
+class AsyncioTCPServerTests(TestCase):
+    def setUp(self):
+        """
+        Set up initial data for the asyncio server tests.
+        """
+        self.valid_data = [
+            {"device_id": "123", "location": "51.5074, -0.1278", "speed": 40},
+            {"device_id": "124", "location": "40.7128, -74.0060", "speed": 30}
+        ]
+
+    def run_session(self, *frames):
+        """
+        Start the asyncio server on a free port, send the given frames over a
+        single connection and return the raw bytes sent back by the server.
+        """
+        from .tcp_server import handle_stream_connection
+
+        async def session():
+            server = await asyncio.start_server(handle_stream_connection, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for frame in frames:
+                writer.write(frame)
+            writer.write_eof()
+            response = await reader.read()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response
+
+        return asyncio.run(session())
+
+    @patch('tcp_tracking.tasks.process_tcp_data.apply_async')
+    def test_newline_delimited_frames(self, mock_process_tcp_data):
+        """
+        Test that several newline delimited frames are served over one connection.
+        """
+        frame = json.dumps(self.valid_data).encode('utf-8') + b'\n'
+        response = self.run_session(frame, b'\n', frame)
+
+        lines = response.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])["message"], "Data received")
+        self.assertEqual(mock_process_tcp_data.call_count, 2)
+
+    @patch('tcp_tracking.tasks.process_tcp_data.apply_async')
+    def test_length_prefixed_frame(self, mock_process_tcp_data):
+        """
+        Test that length prefixed frames are answered with a length prefix.
+        """
+        body = json.dumps(self.valid_data).encode('utf-8')
+        response = self.run_session(len(body).to_bytes(4, 'big') + body)
+
+        length = int.from_bytes(response[:4], 'big')
+        self.assertEqual(len(response), length + 4)
+        self.assertEqual(json.loads(response[4:])["message"], "Data received")
+        mock_process_tcp_data.assert_called_once_with((self.valid_data,))
+
+    @patch('tcp_tracking.tasks.process_tcp_data.apply_async')
+    def test_invalid_json_keeps_connection_open(self, mock_process_tcp_data):
+        """
+        Test that an invalid frame does not close the connection.
+        """
+        frame = json.dumps(self.valid_data).encode('utf-8') + b'\n'
+        response = self.run_session(b'{invalid_json:}\n', frame)
+
+        lines = response.splitlines()
+        self.assertEqual(json.loads(lines[0])["message"], "Invalid JSON format.")
+        self.assertEqual(json.loads(lines[1])["message"], "Data received")
+        mock_process_tcp_data.assert_called_once_with((self.valid_data,))
+
+    @patch('tcp_tracking.tasks.process_tcp_data.apply_async')
+    def test_binary_and_json_frames_on_one_connection(self, mock_process_tcp_data):
+        """
+        Test that binary frames are negotiated by their magic byte next to JSON frames.
+        """
+        frame = binary_protocol.encode_batch([
+            {"device_id": "123", "latitude": 51.5074, "longitude": -0.1278, "speed": 40},
+            {"device_id": "124", "latitude": 40.7128, "longitude": -74.006, "speed": 30},
+        ])
+        response = self.run_session(frame, json.dumps(self.valid_data).encode('utf-8') + b'\n')
+
+        ack = response[:binary_protocol.ACK.size]
+        self.assertEqual(binary_protocol.decode_ack(ack), (binary_protocol.STATUS_OK, 2))
+        self.assertEqual(json.loads(response[binary_protocol.ACK.size:])["message"], "Data received")
+        self.assertEqual(mock_process_tcp_data.call_args_list[0][0][0][0][0], self.valid_data[0])
+        self.assertEqual(mock_process_tcp_data.call_count, 2)
+
+    @patch('tcp_tracking.tasks.process_tcp_data.apply_async')
+    def test_binary_frame_with_invalid_record(self, mock_process_tcp_data):
+        """
+        Test that a binary frame with an invalid record is rejected as a whole.
+        """
+        frame = binary_protocol.encode_batch([
+            {"device_id": "123", "latitude": 51.5074, "longitude": -0.1278, "speed": 40},
+            {"device_id": "124", "latitude": 140.0, "longitude": -74.006, "speed": 30},
+        ])
+        response = self.run_session(frame)
+        self.assertEqual(binary_protocol.decode_ack(response), (binary_protocol.STATUS_INVALID, 0))
+        mock_process_tcp_data.assert_not_called()
+
+    @patch('tcp_tracking.tasks.process_tcp_data.apply_async')
+    def test_out_of_range_timestamp_gets_invalid_ack(self, mock_process_tcp_data):
+        """
+        Test that the frame is refused with an ack instead of dropping the connection.
+        """
+        frame = binary_protocol.encode_batch([{"device_id": "123", "latitude": 0, "longitude": 0, "speed": 1}])
+        header = frame[:binary_protocol.HEADER.size]
+        record = bytearray(frame[binary_protocol.HEADER.size:])
+        struct.pack_into('!q', record, 16, 2 ** 62)
+        response = self.run_session(header + bytes(record))
+        self.assertEqual(binary_protocol.decode_ack(response), (binary_protocol.STATUS_INVALID, 0))
+        mock_process_tcp_data.assert_not_called()
+
+
+class BinaryProtocolTests(TestCase):
+    def test_round_trip(self):
+        """
+        Test that decoded records match what the serializer would validate.
+        """
+        timestamp = datetime(2024, 11, 12, 10, 25, 30, 123000, tzinfo=dt_timezone.utc)
+        frame = binary_protocol.encode_batch([
+            {"device_id": "device123", "latitude": 51.5074, "longitude": -0.1278, "speed": 55.5, "timestamp": timestamp},
+        ])
+        width, count, size = binary_protocol.decode_header(frame[:binary_protocol.HEADER.size])
+        self.assertEqual((width, count, len(frame) - binary_protocol.HEADER.size), (16, 1, size))
+
+        records, errors = binary_protocol.decode_records(width, frame[binary_protocol.HEADER.size:])
+        self.assertEqual(errors, {})
+        serializer = DeviceDataInputSerializer(data={
+            "device_id": "device123", "location": "51.5074, -0.1278", "speed": 55.5, "timestamp": timestamp.isoformat()
+        })
+        self.assertTrue(serializer.is_valid())
+        self.assertEqual(records, [dict(serializer.validated_data)])
+
+    def test_out_of_range_timestamp(self):
+        """
+        Test that a timestamp outside of the datetime range rejects its record only.
+        """
+        record_struct = binary_protocol.record_struct(16)
+        payload = record_struct.pack(b'123', 2 ** 62, 0.0, 0.0, 1.0) + record_struct.pack(b'124', 0, 0.0, 0.0, 1.0)
+        records, errors = binary_protocol.decode_records(16, payload)
+        self.assertEqual(errors, {0: {'timestamp': ['Invalid timestamp.']}})
+        self.assertEqual([record['device_id'] for record in records], ['124'])
+
+    def test_speed_out_of_column_range(self):
+        """
+        Test that a speed too large for the speed column rejects its record only.
+        """
+        record_struct = binary_protocol.record_struct(16)
+        payload = record_struct.pack(b'123', 0, 0.0, 0.0, -1e12) + record_struct.pack(b'124', 0, 0.0, 0.0, 1e7)
+        records, errors = binary_protocol.decode_records(16, payload)
+        self.assertEqual(list(errors), [0])
+        self.assertEqual([record['device_id'] for record in records], ['124'])
+
+    def test_device_id_too_long(self):
+        """
+        Test that the encoder refuses device ids wider than the field.
+        """
+        with self.assertRaises(binary_protocol.BinaryFrameError):
+            binary_protocol.encode_batch([{"device_id": "x" * 17, "latitude": 0, "longitude": 0, "speed": 0}])
+
+
+class WorkerSupervisorTests(TestCase):
+    def test_server_sockets_share_port(self):
+        """
+        Test that several server sockets can bind the same port with SO_REUSEPORT.
+        """
+        from .tcp_server import create_server_socket
+
+        first = create_server_socket('127.0.0.1', 0, reuse_port=True)
+        port = first.getsockname()[1]
+        second = create_server_socket('127.0.0.1', port, reuse_port=True)
+        self.assertEqual(second.getsockname()[1], port)
+        first.close()
+        second.close()
+
+    def test_restart_backoff(self):
+        """
+        Test that a worker dying right after its start is restarted with a growing delay.
+        """
+        from .tcp_server import RESTART_BACKOFF_MAX, restart_delay
+
+        delay = 0.0
+        delays = []
+        for _ in range(8):
+            delay = restart_delay(delay, uptime=0.5)
+            delays.append(delay)
+        self.assertEqual(delays[:4], [1.0, 2.0, 4.0, 8.0])
+        self.assertEqual(delays[-1], RESTART_BACKOFF_MAX)
+        self.assertEqual(restart_delay(delay, uptime=3600), 1.0)
+
+    @patch('tcp_tracking.tasks.process_tcp_data.apply_async')
+    def test_worker_counters(self, mock_process_tcp_data):
+        """
+        Test that accepted connections and processed records are counted.
+        """
+        from . import tcp_server
+
+        counters = tcp_server.WorkerCounters()
+        mock_client_socket = MagicMock()
+        mock_client_socket.recv.return_value = json.dumps([
+            {"device_id": "123", "location": "51.5074, -0.1278", "speed": 40},
+            {"device_id": "124", "location": "40.7128, -74.0060", "speed": 30}
+        ]).encode('utf-8')
+
+        with patch.object(tcp_server, 'counters', counters):
+            tcp_server.handle_client_connection(mock_client_socket)
+
+        self.assertEqual(counters.accepted, 1)
+        self.assertEqual(counters.processed, 2)
+
+
+class LatestDeviceDataTests(TestCase):
+    def setUp(self):
+        """
+        Start every test with an empty latest cache.
+        """
+        cache.clear()
+        latest_cache.local.clear()
+
+    def test_latest_is_served_from_latest_store(self):
+        """
+        Test that the latest endpoint reads the record stored by the task.
+        """
+        process_tcp_data([{"device_id": "123", "location": "51.5074, -0.1278", "speed": 40}])
+        response = self.client.get(reverse('tcp_latest_device_data', args=['123']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["location"], "51.5074, -0.1278")
+        self.assertEqual(response.json()["speed"], 40.0)
+
+    def test_bulk_latest_matches_latest_endpoint(self):
+        """
+        Test that the bulk endpoint returns the same shape as the latest endpoint.
+        """
+        process_tcp_data([{"device_id": "123", "location": "51.5074, -0.1278", "speed": 40}])
+        response = self.client.get(reverse('tcp_bulk_latest_device_data') + '?device_id=123')
+        data = json.loads(b''.join(response.streaming_content))
+        latest = self.client.get(reverse('tcp_latest_device_data', args=['123'])).json()
+        self.assertEqual(data, [latest])
+
+
+class DeviceDataExportTests(TestCase):
+    def test_export_matches_list_endpoint(self):
+        """
+        Test that the NDJSON export contains the same rows as the list endpoint.
+        """
+        process_tcp_data([
+            {"device_id": "123", "location": "51.5074, -0.1278", "speed": 40},
+            {"device_id": "124", "location": "40.7128, -74.0060", "speed": 30}
+        ])
+        response = self.client.get(reverse('tcp_device_data_export'))
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        listed = self.client.get(reverse('tcp_device_data_list')).json()["results"]
+        self.assertEqual(rows, listed)
+
+
+class DeviceDataRollupTests(TestCase):
+    def test_rollups_follow_ingest(self):
+        """
+        Test that the rollup endpoint aggregates the records stored by the task.
+        """
+        process_tcp_data([
+            {"device_id": "123", "location": "51.5074, -0.1278", "speed": 40},
+            {"device_id": "123", "location": "51.5080, -0.1280", "speed": 20}
+        ])
+        response = self.client.get(reverse('tcp_device_data_rollups', args=['123']), {'resolution': '1d'})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["count"], 2)
+        self.assertEqual(results[0]["avg_speed"], "30.00")
+        self.assertEqual(results[0]["last_location"], "51.5080, -0.1280")
+
+    def test_rebuild_command(self):
+        """
+        Test that the rebuild command recomputes the rollups from the history.
+        """
+        process_tcp_data([{"device_id": "123", "location": "51.5074, -0.1278", "speed": 40}])
+        DeviceDataRollup.objects.all().delete()
+        call_command('rebuild_tcp_rollups', stdout=io.StringIO())
+        self.assertEqual(DeviceDataRollup.objects.filter(device_id="123").count(), 3)
+
+
+class MetricsTests(TestCase):
+    @patch('tcp_tracking.tasks.process_tcp_data.apply_async')
+    def test_side_port_metrics(self, mock_delay):
+        """
+        Test that TCP ingest counters are served on the metrics side port.
+        """
+        from urllib.request import urlopen
+        from evreka_case1.metrics import start_metrics_server
+        from .tcp_server import process_payload
+
+        process_payload([{"device_id": "123", "location": "51.5074, -0.1278", "speed": 40}])
+        server = start_metrics_server(0, host='127.0.0.1')
+        try:
+            with urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+                body = response.read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('ingest_records_validated_total{source="tcp"}', body)
+        self.assertIn('ingest_dispatch_seconds_count{task="process_tcp_data"}', body)
+
+@patch('tcp_tracking.tasks.process_tcp_data.apply_async')
+class BackpressureTests(TestCase):
+    def setUp(self):
+        patcher = patch.dict('evreka_case1.admission._controllers', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.records = [{"device_id": "123", "location": "51.5074, -0.1278", "speed": 40}]
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=1)
+    def test_frame_waits_for_capacity(self, mock_apply_async):
+        """
+        Test that a frame over the in-flight limit waits instead of being refused.
+        """
+        from .tcp_server import process_payload
+        in_flight = get_admission_controller('tcp').in_flight
+        in_flight.acquire(1)
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(process_payload(self.records)))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        mock_apply_async.assert_not_called()
+        in_flight.release(1)
+        thread.join(5)
+        self.assertEqual(responses[0]['message'], 'Data received')
+        mock_apply_async.assert_called_once()
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=1, ADMISSION_TCP_MAX_WAIT=0.05)
+    def test_frame_is_refused_after_waiting(self, mock_apply_async):
+        """
+        Test that JSON and binary frames are refused once the wait runs out.
+        """
+        from .tcp_server import process_binary_frame, process_payload
+        get_admission_controller('tcp').in_flight.acquire(1)
+        response = process_payload(self.records)
+        self.assertEqual(response['retry_after'], 1)
+        frame = binary_protocol.encode_batch([{"device_id": "123", "latitude": 51.5074, "longitude": -0.1278, "speed": 40}])
+        device_id_width, _, _ = binary_protocol.decode_header(frame[:binary_protocol.HEADER.size])
+        ack = process_binary_frame(device_id_width, frame[binary_protocol.HEADER.size:])
+        self.assertEqual(binary_protocol.decode_ack(ack), (binary_protocol.STATUS_BUSY, 0))
+        mock_apply_async.assert_not_called()
+
+class SpoolTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.forwarded = []
+        self.records = [
+            {'device_id': str(index), 'location': '51.5074, -0.1278', 'speed': Decimal('40.50'),
+             'timestamp': datetime(2024, 6, 1, 10, index, tzinfo=dt_timezone.utc)}
+            for index in range(6)
+        ]
+
+    def open_spool(self, forward=None, **kwargs):
+        options = {'segment_size': 256, 'max_bytes': 1024 * 1024, 'fsync_ms': 10, 'forward_records': 100, 'retry_interval': 60}
+        options.update(kwargs)
+        spool = Spool(self.root, forward or self.forwarded.extend, **options)
+        self.addCleanup(spool.close)
+        return spool
+
+    def test_records_are_forwarded(self):
+        """
+        Test that spooled records are forwarded in order and drained segments are deleted.
+        """
+        spool = self.open_spool()
+        for record in self.records:
+            spool.append([record])
+        self.assertTrue(spool.drain(timeout=5))
+        self.assertEqual(self.forwarded, self.records)
+        self.assertEqual(spool.pending_records, 0)
+        self.assertEqual(len(os.listdir(spool.directory)), 2)  # The lock and the current segment
+
+    def test_unforwarded_records_are_recovered(self):
+        """
+        Test that records spooled while the broker was down are forwarded by the next process.
+        """
+        def broker_down(records):
+            raise ConnectionError('Broker is down')
+
+        spool = self.open_spool(broker_down, segment_size=4096)
+        spool.append(self.records[:3])
+        spool.append(self.records[3:])
+        self.assertEqual(spool.pending_records, 6)
+        segment = spool.segments[-1]
+        path, end = segment.path, segment.end
+        spool.close()
+        # A torn frame written during the crash is ignored
+        with open(path, 'r+b') as file:
+            file.seek(end)
+            file.write(b'\x00\x00\x00\x05\x01\x02\x03\x04t')
+
+        spool = self.open_spool()
+        self.assertTrue(spool.drain(timeout=5))
+        self.assertEqual(self.forwarded, self.records)
+        # Admitted by the previous process, they never counted here
+        self.assertEqual(spool.pending_records, 0)
+
+    def test_orphaned_directories_are_adopted(self):
+        """
+        Test that a process forwards the spool of a process that is no longer running.
+        """
+        blocked = threading.Event()
+        first = self.open_spool(lambda records: blocked.wait())
+        second = self.open_spool(lambda records: blocked.wait())
+        self.assertNotEqual(first.directory, second.directory)
+        second.append(self.records)
+        blocked.set()
+        second.close()
+        first.close()
+
+        spool = self.open_spool()
+        self.assertTrue(spool.drain(timeout=5))
+        self.assertEqual(self.forwarded, self.records)
+
+    def test_full_spool_refuses_records(self):
+        """
+        Test that records over the size limit are refused until the spool is forwarded.
+        """
+        spool = self.open_spool(lambda records: 1 / 0, max_bytes=500)
+        spool.append(self.records)
+        with self.assertRaises(SpoolFull) as context:
+            spool.append(self.records)
+        self.assertEqual(context.exception.status_code, 503)
+
+    @patch('tcp_tracking.tasks.process_tcp_data.apply_async')
+    def test_payload_is_acknowledged_before_forwarding(self, mock_apply_async):
+        """
+        Test that the TCP server answers once the records are spooled.
+        """
+        from .tcp_server import process_payload
+        patcher = patch.dict('evreka_case1.spool._spools', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with override_settings(TCP_SPOOL_DIR=self.root):
+            response = process_payload([{"device_id": "123", "location": "51.5074, -0.1278", "speed": 40}])
+            spool = get_spool('tcp_tracking', None)
+        self.addCleanup(spool.close)
+        self.assertEqual(response['message'], 'Data received')
+        self.assertTrue(spool.drain(timeout=5))
+        records = mock_apply_async.call_args[0][0][0]
+        self.assertEqual((records[0]['device_id'], records[0]['speed']), ('123', Decimal('40')))
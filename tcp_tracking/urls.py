@@ -1,7 +1,11 @@
 from django.urls import path
-from .views import DeviceDataListAPI, LatestDeviceDataAPI
+from .views import DeviceDataListAPI, IngestBatchAPI, LatestDeviceDataAPI, BulkLatestDeviceDataAPI, DeviceDataExportAPI, DeviceDataRollupAPI
 
 urlpatterns = [
+    path('data/batches/<uuid:batch_id>/', IngestBatchAPI.as_view(), name='tcp_ingest_batch'),
     path('data/list/', DeviceDataListAPI.as_view(), name='tcp_device_data_list'),
+    path('data/export/', DeviceDataExportAPI.as_view(), name='tcp_device_data_export'),
+    path('data/latest/', BulkLatestDeviceDataAPI.as_view(), name='tcp_bulk_latest_device_data'),
     path('data/latest/<str:device_id>/', LatestDeviceDataAPI.as_view(), name='tcp_latest_device_data'),
+    path('data/rollups/<str:device_id>/', DeviceDataRollupAPI.as_view(), name='tcp_device_data_rollups'),
 ]
\ No newline at end of file
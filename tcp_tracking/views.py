@@ -1,22 +1,52 @@
 from rest_framework.views import APIView
+from django.http import StreamingHttpResponse
+from evreka_case1.streaming import EXPORT_FORMATS, export_response, format_datetime, stream_json_array
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.generics import GenericAPIView
-from rest_framework.pagination import PageNumberPagination
-from .models import DeviceData
-from .exceptions import InvalidTimeException
+from django.conf import settings
+from evreka_case1.pagination import KeysetPagination, keyset_iterator
+from .models import DeviceData, IngestBatch
+from evreka_case1.ingest import batch_status
+from .exceptions import BaseTrackingException, InvalidBoundingBoxException, InvalidTimeException
+from evreka_case1.geo import filter_bbox, parse_bbox
 from dateutil.parser import parse
-from datetime import datetime
+from datetime import datetime, timedelta
+from django.utils import timezone
+from evreka_case1.rollups import RESOLUTIONS, choose_resolution
+from .rollups import get_device_data_rollups
 from .serializers import DeviceDataInputSerializer
+from .latest import get_latest_device_data, iter_latest_device_data
 from django.core.exceptions import ValidationError
 
+class IngestBatchAPI(APIView):
+    """
+    get:
+    Retrieve the progress of a tracked ingest batch.
+
+    Batches are tracked when `TCP_TRACK_BATCHES` is enabled, the TCP server then returns a `batch_id` for every JSON message, and expire `INGEST_BATCH_TTL` seconds after their last update.
+
+    Parameters:
+        - batch_id (uuid): The `batch_id` returned when the data was received.
+
+    Responses:
+        200: The status (`pending`, `completed` or `failed`) with the number of chunks, completed and failed chunks,
+             received and stored records (rejected and duplicate records aren't stored).
+        404: Unknown or expired batch.
+    """
+    def get(self, request, batch_id):
+        batch = IngestBatch.objects.filter(batch_id=batch_id).first()
+        if batch is None:
+            return Response({'message': 'No batch found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(batch_status(batch), status=status.HTTP_200_OK)
+
 class DeviceDataListAPI(GenericAPIView):
     """
         Returns a list of device data based on the query parameters.
         [Paginated]
     """
     serializer_class = DeviceDataInputSerializer
-    pagination_class = PageNumberPagination
+    pagination_class = KeysetPagination
 
     def get(self, request):
         try:
@@ -27,7 +57,7 @@ class DeviceDataListAPI(GenericAPIView):
                 return self.get_paginated_response(serializer.data)
             serializer = self.get_serializer(queryset, many=True)
             return Response(serializer.data)
-        except InvalidTimeException as e:
+        except BaseTrackingException as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
     def get_queryset(self, request):
@@ -38,6 +68,7 @@ class DeviceDataListAPI(GenericAPIView):
             start_date = request.query_params.get('start_date')
             end_date = request.query_params.get('end_date')
             device_id = request.query_params.get('device_id')
+            bbox = request.query_params.get('bbox')
 
             queryset = DeviceData.objects.all()
 
@@ -60,20 +91,122 @@ class DeviceDataListAPI(GenericAPIView):
                 queryset = queryset.filter(device_id=device_id)
             if start_date and end_date:
                 queryset = queryset.filter(timestamp__range=[start_date, end_date])
+            if bbox:
+                try:
+                    queryset = filter_bbox(queryset, parse_bbox(bbox))
+                except ValueError as e:
+                    raise InvalidBoundingBoxException(str(e))
 
-            return queryset.order_by('-timestamp').only('device_id', 'location', 'speed', 'timestamp')
+            return queryset.order_by('-timestamp', '-id').only('device_id', 'location', 'speed', 'timestamp')
         except ValidationError as e:
 
             raise InvalidTimeException(f'Invalid time format: {e}')
 
+class DeviceDataExportAPI(DeviceDataListAPI):
+    """
+    Exports the full filtered device data history as a streamed NDJSON or CSV file.
+    Takes the list filters plus `output` (`ndjson` or `csv`) and `compress=gzip`.
+    Rows are read in keyset seeked chunks, so memory stays constant regardless of the range.
+    """
+    pagination_class = None
+    fields = ['device_id', 'location', 'speed', 'timestamp']
+
+    def get(self, request):
+        output = request.query_params.get('output', 'ndjson')
+        if output not in EXPORT_FORMATS:
+            return Response({'error': f'Invalid output format: {output}'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            queryset = self.get_queryset(request).values_list('id', *self.fields)
+        except BaseTrackingException as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        rows = keyset_iterator(queryset, position=lambda row: (row[4], row[0]), chunk_size=settings.EXPORT_CHUNK_SIZE)
+        items = (
+            {
+                'device_id': device_id,
+                'location': location,
+                'speed': float(speed),
+                'timestamp': format_datetime(timestamp),
+            }
+            for pk, device_id, location, speed, timestamp in rows
+        )
+        return export_response(
+            items,
+            self.fields,
+            output,
+            compress=request.query_params.get('compress') == 'gzip',
+            filename='tcp_device_data',
+        )
+
 class LatestDeviceDataAPI(APIView):
     """
     Retrieves the latest device data for a specific device ID.
+    Served from the latest position store and its cache.
     """
     def get(self, request, device_id):
-        data = DeviceData.objects.filter(device_id=device_id).order_by('-timestamp').first()
+        data = get_latest_device_data(device_id)
         if data:
-            serializer = DeviceDataInputSerializer(data)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            return Response(data, status=status.HTTP_200_OK)
         else:
-            return Response({'message': 'No data found'}, status=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+            return Response({'message': 'No data found'}, status=status.HTTP_404_NOT_FOUND)
+
+class BulkLatestDeviceDataAPI(APIView):
+    """
+    Retrieves the latest device data of many devices in a single streamed response.
+    GET takes `device_id` (repeated or comma separated, all devices when omitted),
+    POST takes `{"device_ids": [...]}` or a plain array of device IDs.
+    """
+    def get(self, request):
+        device_ids = [
+            device_id
+            for value in request.query_params.getlist('device_id')
+            for device_id in value.split(',')
+            if device_id
+        ]
+        return self.stream(device_ids or None)
+
+    def post(self, request):
+        device_ids = request.data.get('device_ids') if isinstance(request.data, dict) else request.data
+        if not isinstance(device_ids, list) or not all(isinstance(device_id, str) for device_id in device_ids):
+            return Response({'error': 'Expected a list of device IDs.'}, status=status.HTTP_400_BAD_REQUEST)
+        return self.stream(device_ids)
+
+    def stream(self, device_ids):
+        return StreamingHttpResponse(
+            stream_json_array(iter_latest_device_data(device_ids)),
+            content_type='application/json',
+        )
+
+class DeviceDataRollupAPI(APIView):
+    """
+    Retrieves the precomputed aggregates (count, average/min/max speed, first/last position)
+    of a device per time bucket. Takes `start`, `end` (default: the last day) and `resolution`
+    (`5m`, `1h` or `1d`, by default the finest that fits in `ROLLUP_MAX_BUCKETS` buckets).
+    """
+    def get(self, request, device_id):
+        try:
+            end = self.parse_time(request.query_params.get('end')) or timezone.now()
+            start = self.parse_time(request.query_params.get('start')) or end - timedelta(days=1)
+        except InvalidTimeException as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if start > end:
+            return Response({'error': 'start must be before end.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        resolution = request.query_params.get('resolution') or choose_resolution(start, end, settings.ROLLUP_MAX_BUCKETS)
+        if resolution not in RESOLUTIONS:
+            return Response({'error': f'Invalid resolution: {resolution}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'device_id': device_id,
+            'resolution': resolution,
+            'results': get_device_data_rollups(device_id, resolution, start, end),
+        }, status=status.HTTP_200_OK)
+
+    def parse_time(self, value):
+        if not value:
+            return None
+        try:
+            value = parse(value)
+        except (ValueError, OverflowError):
+            raise InvalidTimeException(f"Invalid date format: {value}")
+        return timezone.make_aware(value) if timezone.is_naive(value) else value
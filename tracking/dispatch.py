@@ -0,0 +1,58 @@
+from django.conf import settings
+from evreka_case1.coalescer import buffered_records, get_coalescer
+from evreka_case1.dedup import drop_recent_duplicates, get_recent_keys
+from evreka_case1.ingest import dispatch_chunks
+from evreka_case1.metrics import DISPATCH_SECONDS
+from evreka_case1.pipeline import direct_pipeline, get_direct_writer
+from .models import IngestBatch
+from .tasks import process_device_data, writer
+
+
+def send_batch(batch, track=False, wait=False, bulk=False):
+    if direct_pipeline():
+        return get_direct_writer('tracking', writer).add(batch, IngestBatch if track else None, wait)
+    with DISPATCH_SECONDS.labels('process_device_data').time():
+        return dispatch_chunks(
+            process_device_data, batch, settings.INGEST_CHUNK_SIZE, IngestBatch if track else None, bulk
+        )
+
+
+def buffered_device_data():
+    """
+    Records admitted by this process and still held by its coalescer.
+    """
+    return buffered_records('tracking')
+
+
+def dispatch_device_data(validated_data, track=False, bulk=False):
+    """
+    Queue validated device data for processing.
+
+    With ``INGEST_COALESCE`` enabled the records are buffered and sent to the
+    Celery task in batches instead of one task per request.
+
+    With ``INGEST_PIPELINE = 'direct'`` the records are stored by the direct
+    writer of this process instead of the Celery task, without coalescing.
+
+    With ``bulk`` (uploads and backfills) the records are never buffered and
+    go to ``INGEST_BULK_QUEUE`` when it is set.
+
+    With ``INGEST_DEDUP`` enabled records seen recently by this process are dropped.
+
+    With ``track`` the records are never buffered and the progress of the
+    batch is kept in IngestBatch. Returns its id, ``None`` when not tracked
+    or all of the records are duplicates.
+    """
+    records, keys = drop_recent_duplicates('tracking', validated_data)
+    if not records:
+        return None
+    try:
+        if settings.INGEST_COALESCE and not track and not bulk and not direct_pipeline():
+            coalescer = get_coalescer('tracking', send_batch)
+            coalescer.add(records)
+            return None
+        return send_batch(records, track, bulk=bulk)
+    except Exception:
+        # Nothing was queued, a resend of these records must not be dropped
+        get_recent_keys('tracking').forget(keys)
+        raise
@@ -3,4 +3,8 @@ class BaseTrackingException(Exception):
 
 
 class InvalidTimeException(BaseTrackingException):
-    pass
\ No newline at end of file
+    pass
+
+
+class InvalidBoundingBoxException(BaseTrackingException):
+    pass
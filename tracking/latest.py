@@ -0,0 +1,48 @@
+import logging
+from evreka_case1.latest import LatestCache, iter_latest, upsert_latest
+from evreka_case1.streaming import format_datetime, format_decimal
+from .models import LatestDeviceData
+from .serializers import LatestDeviceDataSerializer
+
+logger = logging.getLogger(__name__)
+
+latest_cache = LatestCache('tracking', lambda instance: LatestDeviceDataSerializer(instance).data)
+
+
+def get_latest_device_data(device_id):
+    """
+    Return the serialized latest record of a device, or None if it has no data.
+    """
+    return latest_cache.get(
+        device_id,
+        lambda: LatestDeviceData.objects.filter(device_id=device_id).first(),
+    )
+
+
+def update_latest_device_data(instances):
+    """
+    Update the latest records and the cache from newly stored device data.
+
+    The latest store can always be rebuilt from the history table, so a failure
+    here is logged instead of failing the ingest.
+    """
+    try:
+        latest_cache.update(upsert_latest(LatestDeviceData, instances))
+    except Exception as e:
+        logger.error(f"Error updating latest device data: {e}")
+
+
+def iter_latest_device_data(device_ids=None):
+    """
+    Yield the latest record of the given devices (or of every device) as
+    dictionaries shaped like ``LatestDeviceDataSerializer`` output, without
+    the serializer overhead.
+    """
+    for pk, device_id, timestamp, location, speed in iter_latest(LatestDeviceData, device_ids):
+        yield {
+            'id': pk,
+            'device_id': device_id,
+            'timestamp': format_datetime(timestamp),
+            'location': location,
+            'speed': format_decimal(speed),
+        }
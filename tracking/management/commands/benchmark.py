@@ -0,0 +1,48 @@
+import json
+from django.core.management.base import BaseCommand
+from benchmarks.runner import run
+from evreka_case1.pipeline import INGEST_PIPELINES
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark ingest throughput over HTTP and TCP and the storage/query paths. '
+        'Runs against a throwaway copy of the configured database and prints the results as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        load = parser.add_argument_group('ingest load')
+        load.add_argument('--devices', type=int, default=1000, help='Devices in the synthetic fleet.')
+        load.add_argument('--http-clients', type=int, default=4, help='Concurrent HTTP clients, 0 to skip.')
+        load.add_argument('--tcp-clients', type=int, default=4, help='Concurrent TCP connections, 0 to skip.')
+        load.add_argument('--batches', type=int, default=100, help='Batches sent by every client.')
+        load.add_argument('--batch-size', type=int, default=50, help='Records per batch.')
+        load.add_argument('--rate', type=float, default=0, help='Records/sec per client, 0 sends as fast as possible.')
+        load.add_argument('--binary', action='store_true', help='Use binary frames instead of JSON over TCP.')
+        load.add_argument('--base-url', help='Post to a running server instead of in-process.')
+        load.add_argument('--tcp-host', default='127.0.0.1')
+        load.add_argument('--tcp-port', type=int, help='Use a running TCP server instead of a local one.')
+        load.add_argument('--pipelines', nargs='+', choices=INGEST_PIPELINES, default=['celery'],
+                          help='Ingest pipelines to run the load against, one after the other.')
+        load.add_argument('--skip-ingest', action='store_true')
+        load.add_argument('--no-eager', dest='eager', action='store_false',
+                          help='Publish to the configured broker instead of running the tasks in-process.')
+
+        storage = parser.add_argument_group('storage and queries')
+        storage.add_argument('--rows', type=int, default=1_000_000, help='Rows to store before timing queries, 0 to skip.')
+        storage.add_argument('--insert-batch-size', type=int, default=5000)
+        storage.add_argument('--query-repeat', type=int, default=50)
+
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database between runs.')
+        parser.add_argument('--output', help='Write the JSON results to this file.')
+
+    def handle(self, *args, **options):
+        keys = [
+            'devices', 'http_clients', 'tcp_clients', 'batches', 'batch_size', 'rate', 'binary', 'base_url',
+            'tcp_host', 'tcp_port', 'pipelines', 'skip_ingest', 'eager', 'rows', 'insert_batch_size', 'query_repeat', 'keepdb',
+        ]
+        results = json.dumps(run({key: options[key] for key in keys}), indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(results + '\n')
+        self.stdout.write(results)
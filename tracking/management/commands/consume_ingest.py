@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from evreka_case1.celery import app
+from evreka_case1.consumer import BatchConsumer
+from evreka_case1.routing import ingest_queues
+from tcp_tracking.tasks import process_tcp_data, writer as tcp_writer
+from tracking.tasks import process_device_data, writer
+
+
+class Command(BaseCommand):
+    help = (
+        'Consume the ingest queue in batches: the records of all prefetched ingest tasks are '
+        'stored in one transaction and the messages acknowledged once it is committed. '
+        'Replaces a Celery worker on the ingest queues.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue', action='append', dest='queues',
+                            help='Queue to consume, repeat for several. Defaults to the ingest queues.')
+        parser.add_argument('--shards', help='Device shards to consume with INGEST_SHARDS, like 0-3,6. Defaults to all.')
+        parser.add_argument('--bulk', action='store_true', help='Also consume INGEST_BULK_QUEUE.')
+        parser.add_argument('--batch-size', type=int, default=settings.INGEST_CONSUMER_MAX_RECORDS,
+                            help='Records stored per transaction.')
+        parser.add_argument('--max-wait-ms', type=int, default=settings.INGEST_CONSUMER_MAX_WAIT_MS,
+                            help='Time to wait for a batch to fill.')
+        parser.add_argument('--prefetch', type=int, default=settings.INGEST_CONSUMER_PREFETCH,
+                            help='Unacknowledged messages held at once.')
+        parser.add_argument('--drain', action='store_true', help='Exit once the queue is empty.')
+
+    def handle(self, *args, **options):
+        queues = options['queues']
+        if not queues:
+            try:
+                queues = ingest_queues(options['shards'], options['bulk'])
+            except ValueError as e:
+                raise CommandError(e)
+        consumer = BatchConsumer(
+            app,
+            queues,
+            {process_device_data.name: writer, process_tcp_data.name: tcp_writer},
+            prefetch=options['prefetch'],
+            max_records=options['batch_size'],
+            max_wait_ms=options['max_wait_ms'],
+        )
+        try:
+            consumer.run(stop_when_idle=options['drain'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'Stored {consumer.stored} records.'))
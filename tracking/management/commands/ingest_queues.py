@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from evreka_case1.routing import ingest_queues
+
+
+class Command(BaseCommand):
+    help = (
+        'Print the comma separated ingest queues of a set of device shards, to subscribe a '
+        'Celery worker with -Q.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('shards', nargs='?', help='Device shards like 0-3,6. Defaults to all.')
+        parser.add_argument('--bulk', action='store_true', help='Also include INGEST_BULK_QUEUE.')
+
+    def handle(self, *args, **options):
+        try:
+            queues = ingest_queues(options['shards'], options['bulk'])
+        except ValueError as e:
+            raise CommandError(e)
+        self.stdout.write(','.join(queues))
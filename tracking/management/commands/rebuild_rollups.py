@@ -0,0 +1,26 @@
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from tracking.rollups import rebuild_device_data_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the device data rollups from the history table. '
+        'Run it while ingest is quiet, records stored during the rebuild may be counted twice or missed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only rebuild the buckets from the start of this day on.')
+
+    def handle(self, *args, **options):
+        since = options['since']
+        if since:
+            try:
+                since = parse(since)
+            except (ValueError, OverflowError):
+                raise CommandError(f'Invalid date format: {since}')
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        count = rebuild_device_data_rollups(since)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the rollups from {count} records.'))
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.3 on 2026-10-18 08:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='devicedata',
+            index=models.Index(fields=['device_id', 'timestamp'], name='tracking_device_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 5.1.3 on 2026-10-18 08:40
+
+import math
+import re
+
+from django.db import migrations, models, transaction
+
+# Frozen copy of evreka_case1.geo at the time of this migration, so later
+# changes to the grid or the location format don't change what it writes
+CELL_SIZE = 0.1
+COLUMNS = round(360 / CELL_SIZE)
+ROWS = round(180 / CELL_SIZE)
+
+LOCATION_PATTERN = re.compile(r'^\s*\(?\s*([-+]?\d+(?:\.\d*)?|[-+]?\.\d+)\s*[,; ]\s*([-+]?\d+(?:\.\d*)?|[-+]?\.\d+)\s*\)?\s*$')
+
+
+def location_fields(location):
+    """
+    Return the ``latitude``, ``longitude`` and ``cell`` values of a location.
+    """
+    match = LOCATION_PATTERN.match(location or '')
+    if match is None:
+        return {'latitude': None, 'longitude': None, 'cell': None}
+    latitude, longitude = float(match.group(1)), float(match.group(2))
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return {'latitude': None, 'longitude': None, 'cell': None}
+    row = min(int(math.floor((latitude + 90) / CELL_SIZE)), ROWS - 1)
+    column = min(int(math.floor((longitude + 180) / CELL_SIZE)), COLUMNS - 1)
+    return {'latitude': latitude, 'longitude': longitude, 'cell': row * COLUMNS + column}
+
+
+def backfill_location_columns(apps, schema_editor):
+    """
+    Parse the coordinates and grid cell of the existing rows, seeking through
+    the primary key in batches so every batch is a short transaction.
+    """
+    DeviceData = apps.get_model('tracking', 'DeviceData')
+    batch_size = 1000
+    last_id = 0
+    while True:
+        rows = list(DeviceData.objects.filter(id__gt=last_id).order_by('id').only('id', 'location')[:batch_size])
+        if not rows:
+            return
+        for row in rows:
+            for name, value in location_fields(row.location).items():
+                setattr(row, name, value)
+        with transaction.atomic(using=schema_editor.connection.alias):
+            DeviceData.objects.bulk_update(rows, ['latitude', 'longitude', 'cell'])
+        last_id = rows[-1].id
+
+
+class Migration(migrations.Migration):
+
+    # The backfill commits batch by batch instead of in one long transaction
+    atomic = False
+
+    dependencies = [
+        ('tracking', '0003_latest_device_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicedata',
+            name='cell',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='devicedata',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='devicedata',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='devicedata',
+            index=models.Index(fields=['cell', 'timestamp'], name='tracking_cell_ts_idx'),
+        ),
+        migrations.RunPython(backfill_location_columns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.3 on 2026-10-18 08:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0004_device_location_columns'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceDataRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.CharField(max_length=255)),
+                ('resolution', models.PositiveIntegerField()),
+                ('bucket', models.DateTimeField()),
+                ('count', models.PositiveBigIntegerField()),
+                ('speed_sum', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('speed_min', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('speed_max', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_location', models.CharField(max_length=255)),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_location', models.CharField(max_length=255)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('device_id', 'resolution', 'bucket'), name='tracking_rollup_bucket_uniq')],
+            },
+        ),
+    ]
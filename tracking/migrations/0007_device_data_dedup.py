@@ -0,0 +1,24 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0006_dead_letter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicedata',
+            name='dedup_key',
+            field=models.CharField(blank=True, max_length=32, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='devicedata',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,12 +1,98 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 class DeviceData(models.Model):
     device_id = models.CharField(max_length=255)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # The device's own timestamp when it sends one, auto_now_add would overwrite it
+    timestamp = models.DateTimeField(default=timezone.now)
     location = models.CharField(max_length=255)
     speed = models.DecimalField(max_digits=10, decimal_places=2)
+    # Parsed from location on ingest, see evreka_case1.geo
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    cell = models.BigIntegerField(null=True, blank=True)
+    # Set with INGEST_DEDUP, see evreka_case1.dedup
+    dedup_key = models.CharField(max_length=32, null=True, blank=True, unique=True)
     # Add other fields as needed
 
+    class Meta:
+        indexes = [
+            # Serves the device filtered, newest first list and keyset queries
+            models.Index(fields=['device_id', 'timestamp'], name='tracking_device_ts_idx'),
+            # Serves the bbox cell range lookups
+            models.Index(fields=['cell', 'timestamp'], name='tracking_cell_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.device_id} at {self.timestamp}"
+
+class LatestDeviceData(models.Model):
+    """
+    Latest record of every device, kept up to date by the ingest task so the
+    latest endpoint never has to search the history table.
+    """
+    device_id = models.CharField(max_length=255, unique=True)
+    timestamp = models.DateTimeField()
+    location = models.CharField(max_length=255)
+    speed = models.DecimalField(max_digits=10, decimal_places=2)
+
+    def __str__(self):
+        return f"{self.device_id} at {self.timestamp}"
+
+class DeviceDataRollup(models.Model):
+    """
+    Aggregates of the records of a device in one time bucket, see evreka_case1.rollups.
+    """
+    device_id = models.CharField(max_length=255)
+    resolution = models.PositiveIntegerField()  # Bucket length in seconds
+    bucket = models.DateTimeField()  # Bucket start
+    count = models.PositiveBigIntegerField()
+    speed_sum = models.DecimalField(max_digits=20, decimal_places=2)
+    speed_min = models.DecimalField(max_digits=10, decimal_places=2)
+    speed_max = models.DecimalField(max_digits=10, decimal_places=2)
+    first_timestamp = models.DateTimeField()
+    first_location = models.CharField(max_length=255)
+    last_timestamp = models.DateTimeField()
+    last_location = models.CharField(max_length=255)
+
+    class Meta:
+        constraints = [
+            # Also serves the device, resolution and time range queries
+            models.UniqueConstraint(fields=['device_id', 'resolution', 'bucket'], name='tracking_rollup_bucket_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.device_id} at {self.bucket} ({self.resolution}s)"
+
+class DeadLetter(models.Model):
+    """
+    Validated records the ingest could not store, with the error. Replayed or
+    purged with the ``dead_letters`` command.
+    """
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    error = models.TextField()
+    attempts = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.error} ({self.attempts} attempts)"
+
+class IngestBatch(models.Model):
+    """
+    Progress of an ingest payload whose caller asked to track it, updated by
+    every processed chunk and expired by the ``expire_ingest_batches`` task.
+    """
+    batch_id = models.UUIDField(primary_key=True)
+    records = models.PositiveIntegerField()
+    chunks = models.PositiveIntegerField()
+    completed_chunks = models.PositiveIntegerField(default=0)
+    failed_chunks = models.PositiveIntegerField(default=0)
+    stored = models.PositiveIntegerField(default=0)  # Records stored, without rejected and duplicate ones
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
     def __str__(self):
-        return f"{self.device_id} at {self.timestamp}"
\ No newline at end of file
+        return f"{self.batch_id} ({self.completed_chunks}/{self.chunks} chunks)"
@@ -1,14 +1,33 @@
 from rest_framework import serializers
-from .models import DeviceData
+from evreka_case1.validation import MAX_SPEED, DeviceDataValidator
+from .models import DeviceData, LatestDeviceData
 
 class DeviceDataSerializer(serializers.ModelSerializer):
     class Meta:
         model = DeviceData
-        fields = '__all__'
+        fields = ['id', 'device_id', 'timestamp', 'location', 'speed']
 
 
 class DeviceDataInputSerializer(serializers.Serializer):
     device_id = serializers.CharField(max_length=255)
     location = serializers.CharField(max_length=255)
-    speed = serializers.FloatField()
-    timestamp = serializers.DateTimeField(required=False)
\ No newline at end of file
+    speed = serializers.FloatField(min_value=-MAX_SPEED, max_value=MAX_SPEED)
+    timestamp = serializers.DateTimeField(required=False)
+
+class LatestDeviceDataSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = LatestDeviceData
+        fields = ['id', 'device_id', 'timestamp', 'location', 'speed']
+
+
+
+# Fast path equivalent of DeviceDataInputSerializer used on the ingest hot path
+device_data_validator = DeviceDataValidator(DeviceDataInputSerializer)
+
+
+def validate_device_data(records):
+    """
+    Validate a list of records one by one, returning a ``(validated_data, errors)``
+    pair for every record so valid records can be kept when others are rejected.
+    """
+    return device_data_validator.validate_each(records)
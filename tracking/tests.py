@@ -1,7 +1,65 @@
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+from types import SimpleNamespace
+from unittest.mock import patch
+from django.conf import settings
+from django.core.cache import cache
+from kombu.utils import json as kombu_json
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import override_settings
 from django.urls import reverse
-from rest_framework.test import APITestCase
+from django.utils import timezone
+from rest_framework.test import APITestCase, APITransactionTestCase
 from rest_framework import status
-from .models import DeviceData
+from benchmarks.fleet import Fleet, to_json_records
+from benchmarks.stats import summarize
+from evreka_case1.admission import TokenBuckets, get_admission_controller
+from evreka_case1.celery import app
+from evreka_case1.coalescer import BatchCoalescer, CoalescerFull, close_coalescers
+from evreka_case1.consumer import BatchConsumer
+from evreka_case1.dedup import RecentKeys, dedup_key
+from evreka_case1.pipeline import DirectWriter, WriterFull, close_direct_writers, get_direct_writer
+from evreka_case1.metrics import Registry, RECORDS_REJECTED, RECORDS_VALIDATED, TASK_QUEUE_LAG_SECONDS
+from evreka_case1.celery import record_queue_lag
+from evreka_case1 import profiling
+from evreka_case1.geo import cell_ranges, location_fields, parse_bbox, parse_location
+from evreka_case1.latest import upsert_latest, upsert_sql
+from evreka_case1.pagination import KeysetPagination
+from evreka_case1.routing import ingest_queues, parse_shards, route_records, shard_of, shard_queue
+from evreka_case1.rollups import choose_resolution, update_rollups
+from evreka_case1.serialization import FLAG_COLUMNAR, ColumnarSerializer
+from evreka_case1.validation import DeviceDataValidator
+from .latest import latest_cache
+from .models import DeadLetter, DeviceData, DeviceDataRollup, IngestBatch, LatestDeviceData
+from .rollups import rebuild_device_data_rollups
+from .serializers import DeviceDataInputSerializer
+from .tasks import expire_ingest_batches, process_device_data, writer
+
+# The Celery app reads its CELERY_ settings from Django on every lookup
+eager_tasks = override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+
+
+def memory_broker():
+    """
+    Point the Celery app to kombu's in-memory transport, so the tests talking
+    to a broker run without RabbitMQ.
+    """
+    return override_settings(CELERY_BROKER_URL='memory://')
+
+
+def send_task(name, args, **options):
+    # On a connection of its own, the producer pool keeps the broker it was created with
+    with app.connection_for_write() as connection:
+        app.send_task(name, args=args, connection=connection, **options)
 
 class DeviceDataTests(APITestCase):
     def test_post_data(self):
@@ -14,4 +72,1127 @@ class DeviceDataTests(APITestCase):
         DeviceData.objects.create(device_id='123', location='X', speed='50.0')
         url = reverse('latest_device_data', args=['123'])
         response = self.client.get(url)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+class BatchCoalescerTests(APITestCase):
+    def test_flush_on_size(self):
+        batches = []
+        coalescer = BatchCoalescer(batches.append, max_records=3, max_age_ms=60000)
+        coalescer.add([{'device_id': '1'}, {'device_id': '2'}])
+        self.assertEqual(batches, [])
+        coalescer.add([{'device_id': '3'}])
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), 3)
+        coalescer.close()
+
+    def test_flush_on_age(self):
+        flushed = threading.Event()
+        batches = []
+
+        def flush(batch):
+            batches.append(batch)
+            flushed.set()
+
+        coalescer = BatchCoalescer(flush, max_records=100, max_age_ms=10)
+        coalescer.add([{'device_id': '1'}])
+        coalescer.add([{'device_id': '2'}])
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual(batches, [[{'device_id': '1'}, {'device_id': '2'}]])
+        coalescer.close()
+
+    def test_flush_on_close(self):
+        batches = []
+        coalescer = BatchCoalescer(batches.append, max_records=100, max_age_ms=60000)
+        coalescer.add([{'device_id': '1'}])
+        coalescer.close()
+        self.assertEqual(batches, [[{'device_id': '1'}]])
+
+    def test_failed_flush_keeps_records_and_buffer_is_capped(self):
+        batches = []
+
+        def flush(batch):
+            if broker_down:
+                raise ConnectionError('broker is down')
+            batches.append(batch)
+
+        broker_down = True
+        coalescer = BatchCoalescer(flush, max_records=2, max_age_ms=60000, max_buffered=3)
+        coalescer.add([{'device_id': '1'}, {'device_id': '2'}])
+        self.assertEqual(coalescer.buffered, 2)
+        with self.assertRaises(CoalescerFull):
+            coalescer.add([{'device_id': '3'}, {'device_id': '4'}])
+        broker_down = False
+        coalescer.add([{'device_id': '3'}])
+        self.assertEqual(batches, [[{'device_id': '1'}, {'device_id': '2'}, {'device_id': '3'}]])
+        self.assertEqual(coalescer.buffered, 0)
+        coalescer.close()
+
+    @override_settings(INGEST_COALESCE=True, INGEST_COALESCE_MAX_RECORDS=2, INGEST_COALESCE_MAX_AGE_MS=60000)
+    @patch('tracking.tasks.process_device_data.apply_async')
+    def test_post_data_is_coalesced(self, mock_apply_async):
+        url = reverse('device_data')
+        for device_id in ('1', '2'):
+            data = {'device_id': device_id, 'location': 'X', 'speed': '50.0'}
+            self.client.post(url, data, format='json')
+        close_coalescers()
+        mock_apply_async.assert_called_once()
+        self.assertEqual([item['device_id'] for item in mock_apply_async.call_args[0][0][0]], ['1', '2'])
+
+
+class KeysetPaginationTests(APITestCase):
+    def setUp(self):
+        start = timezone.now() - timedelta(hours=1)
+        for index in range(5):
+            data = DeviceData.objects.create(device_id='123', location='X', speed='50.0')
+            # Two rows share a timestamp to exercise the id tie-break
+            DeviceData.objects.filter(pk=data.pk).update(timestamp=start + timedelta(minutes=index // 2))
+
+    @patch.object(KeysetPagination, 'page_size', 2)
+    def test_keyset_pages_cover_all_rows(self):
+        url = reverse('device_data_list') + '?device_id=123&cursor='
+        seen = []
+        pages = 0
+        while url:
+            pages += 1
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            seen.extend(response.data['results'])
+            url = response.data['next']
+
+        expected = list(DeviceData.objects.order_by('-timestamp', '-id').values_list('id', flat=True))
+        self.assertEqual([item['id'] for item in seen], expected)
+        self.assertEqual(pages, 3)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('device_data_list') + '?cursor=invalid')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_page_number_mode_is_default(self):
+        response = self.client.get(reverse('device_data_list'))
+        self.assertEqual(response.data['count'], 5)
+
+
+class LatestDeviceDataTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        latest_cache.local.clear()
+
+    def test_task_updates_latest(self):
+        process_device_data([
+            {'device_id': '123', 'location': 'X', 'speed': 50.0},
+            {'device_id': '123', 'location': 'Y', 'speed': 60.0},
+        ])
+        latest = LatestDeviceData.objects.get(device_id='123')
+        self.assertEqual(latest.location, 'Y')
+
+    def test_older_record_does_not_overwrite(self):
+        now = timezone.now()
+        upsert_latest(LatestDeviceData, [DeviceData(device_id='123', location='new', speed=1, timestamp=now)])
+        upsert_latest(LatestDeviceData, [
+            DeviceData(device_id='123', location='old', speed=1, timestamp=now - timedelta(minutes=1)),
+            DeviceData(device_id='124', location='other', speed=1, timestamp=now),
+        ])
+        self.assertEqual(LatestDeviceData.objects.get(device_id='123').location, 'new')
+        self.assertEqual(LatestDeviceData.objects.get(device_id='124').location, 'other')
+
+    def test_upsert_guards_the_timestamp_in_the_statement(self):
+        mysql = SimpleNamespace(vendor='mysql', ops=connection.ops)
+        sql = upsert_sql(mysql, LatestDeviceData, [None])
+        self.assertIn('ON DUPLICATE KEY UPDATE', sql)
+        self.assertTrue(sql.endswith('"timestamp" = IF(VALUES("timestamp") >= "timestamp", VALUES("timestamp"), "timestamp")'))
+        self.assertIn('WHERE excluded."timestamp" >=', upsert_sql(connection, LatestDeviceData, [None]))
+
+    def test_latest_response_keeps_id(self):
+        latest = LatestDeviceData.objects.create(device_id='123', location='X', speed='50.0', timestamp=timezone.now())
+        response = self.client.get(reverse('latest_device_data', args=['123']))
+        self.assertEqual(response.data['id'], latest.pk)
+
+    def test_per_process_cache_is_skipped(self):
+        self.assertEqual(settings.LATEST_CACHE_TIMEOUT, 0)
+        LatestDeviceData.objects.create(device_id='123', location='X', speed='50.0', timestamp=timezone.now())
+        self.client.get(reverse('latest_device_data', args=['123']))
+        self.assertIsNone(cache.get(latest_cache.make_key('123')))
+
+    def test_latest_is_cached(self):
+        LatestDeviceData.objects.create(device_id='123', location='X', speed='50.0', timestamp=timezone.now())
+        url = reverse('latest_device_data', args=['123'])
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.data['location'], 'X')
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_latest_not_found(self):
+        response = self.client.get(reverse('latest_device_data', args=['missing']))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BulkLatestDeviceDataTests(APITestCase):
+    def setUp(self):
+        now = timezone.now()
+        for index in range(5):
+            LatestDeviceData.objects.create(device_id=str(index), location='X', speed='50.0', timestamp=now)
+
+    def read(self, response):
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return json.loads(b''.join(response.streaming_content))
+
+    def test_all_devices(self):
+        data = self.read(self.client.get(reverse('bulk_latest_device_data')))
+        self.assertEqual(sorted(item['device_id'] for item in data), ['0', '1', '2', '3', '4'])
+
+    def test_selected_devices(self):
+        data = self.read(self.client.get(reverse('bulk_latest_device_data') + '?device_id=1,3&device_id=missing'))
+        self.assertEqual(sorted(item['device_id'] for item in data), ['1', '3'])
+
+    def test_post_device_ids(self):
+        url = reverse('bulk_latest_device_data')
+        with self.assertNumQueries(1):
+            data = self.read(self.client.post(url, {'device_ids': ['0', '4']}, format='json'))
+        self.assertEqual(sorted(item['device_id'] for item in data), ['0', '4'])
+
+    def test_matches_latest_endpoint(self):
+        data = self.read(self.client.post(reverse('bulk_latest_device_data'), ['2'], format='json'))
+        response = self.client.get(reverse('latest_device_data', args=['2']))
+        self.assertEqual(data, [response.data])
+
+    def test_invalid_device_ids(self):
+        response = self.client.post(reverse('bulk_latest_device_data'), {'device_ids': 'x'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DeviceDataExportTests(APITestCase):
+    def setUp(self):
+        start = timezone.now() - timedelta(hours=1)
+        for index in range(7):
+            data = DeviceData.objects.create(device_id='123' if index % 2 else '124', location='X', speed='50.0')
+            DeviceData.objects.filter(pk=data.pk).update(timestamp=start + timedelta(minutes=index // 2))
+
+    def read(self, response):
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content)
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_ndjson_export(self):
+        content = self.read(self.client.get(reverse('device_data_export') + '?device_id=123'))
+        rows = [json.loads(line) for line in content.splitlines()]
+        expected = DeviceData.objects.filter(device_id='123').order_by('-timestamp', '-id')
+        self.assertEqual([row['id'] for row in rows], [data.id for data in expected])
+
+    def test_ndjson_matches_list_endpoint(self):
+        content = self.read(self.client.get(reverse('device_data_export')))
+        rows = [json.loads(line) for line in content.splitlines()]
+        response = self.client.get(reverse('device_data_list'))
+        self.assertEqual(rows, response.data['results'])
+
+    def test_gzip_csv_export(self):
+        response = self.client.get(reverse('device_data_export') + '?output=csv&compress=gzip')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = list(csv.reader(io.StringIO(gzip.decompress(self.read(response)).decode('utf-8'))))
+        self.assertEqual(rows[0], ['id', 'device_id', 'timestamp', 'location', 'speed'])
+        self.assertEqual(len(rows), 8)
+
+    def test_invalid_output(self):
+        response = self.client.get(reverse('device_data_export') + '?output=xml')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DeviceDataBulkTests(APITestCase):
+    def upload(self, lines, compress=True):
+        body = ''.join(line + '\n' for line in lines).encode('utf-8')
+        headers = {}
+        if compress:
+            body = gzip.compress(body)
+            headers['HTTP_CONTENT_ENCODING'] = 'gzip'
+        return self.client.post(reverse('device_data_bulk'), body, content_type='application/x-ndjson', **headers)
+
+    @override_settings(BULK_UPLOAD_CHUNK_SIZE=2)
+    @patch('tracking.tasks.process_device_data.apply_async')
+    def test_gzip_ndjson_upload(self, mock_apply_async):
+        lines = [json.dumps({'device_id': str(index), 'location': 'X', 'speed': index}) for index in range(5)]
+        lines.insert(2, '{invalid')
+        lines.insert(4, json.dumps({'device_id': '9', 'speed': 1}))
+        lines.insert(5, '')
+        response = self.upload(lines)
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['accepted'], 5)
+        self.assertEqual(response.data['rejected'], 2)
+        self.assertEqual([error['line'] for error in response.data['errors']], [3, 5])
+        self.assertIn('location', response.data['errors'][1]['errors'])
+        self.assertNotIn('data', response.data)
+
+        dispatched = [item['device_id'] for call in mock_apply_async.call_args_list for item in call[0][0][0]]
+        self.assertEqual(dispatched, ['0', '1', '2', '3', '4'])
+        self.assertTrue(all(len(call[0][0][0]) <= 2 for call in mock_apply_async.call_args_list))
+
+    @patch('tracking.tasks.process_device_data.apply_async')
+    def test_plain_ndjson_upload(self, mock_apply_async):
+        response = self.upload([json.dumps({'device_id': '1', 'location': 'X', 'speed': 1})], compress=False)
+        self.assertEqual(response.data['accepted'], 1)
+        mock_apply_async.assert_called_once()
+
+    @patch('tracking.tasks.process_device_data.apply_async')
+    def test_corrupt_gzip(self, mock_apply_async):
+        response = self.client.post(
+            reverse('device_data_bulk'), b'not gzip', content_type='application/x-ndjson', HTTP_CONTENT_ENCODING='gzip'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_apply_async.assert_not_called()
+
+class DeviceDataValidatorTests(APITestCase):
+    VALUES = [
+        '123', ' 123 ', '', '   ', 'x' * 255, 'x' * 256, 'a\x00b', '\ud800', 'caf\u00e9', 12, 1.5, 0, True,
+        None, [], {}, ['1'], '50.5', '-1e3', 'inf', '-inf', '1' * 1001, 10 ** 400, 2 ** 63,
+        99999999.99, 1e8, -1e12, '1e12',
+        '2024-01-01T10:00:00Z', '2024-01-01T10:00:00', '2024-01-01 10:00:00+03:00', '2024-01-01',
+        '2024-13-01T10:00:00Z', 'not a date', 1700000000,
+    ]
+
+    def assertSameResult(self, records):
+        validator = DeviceDataValidator(DeviceDataInputSerializer)
+        serializer = DeviceDataInputSerializer(data=records, many=True)
+        validated_data, errors = validator.validate_many(records)
+        if serializer.is_valid():
+            self.assertIsNone(errors)
+            self.assertEqual(validated_data, [dict(item) for item in serializer.validated_data])
+        else:
+            self.assertIsNone(validated_data)
+            self.assertEqual(errors, serializer.errors)
+            self.assertEqual(self.codes(errors), self.codes(serializer.errors))
+
+    def codes(self, errors):
+        if isinstance(errors, dict):
+            return {key: self.codes(value) for key, value in errors.items()}
+        if isinstance(errors, list):
+            return [self.codes(value) for value in errors]
+        return errors.code
+
+    def test_valid_records(self):
+        self.assertSameResult([
+            {'device_id': '1', 'location': 'X', 'speed': 50.0},
+            {'device_id': '2', 'location': '40.7, -74.0', 'speed': '12', 'timestamp': '2024-01-01T10:00:00Z'},
+            {'device_id': 3, 'location': 'Y', 'speed': 0, 'extra': 'ignored'},
+        ])
+
+    def test_field_values(self):
+        for field in ('device_id', 'location', 'speed', 'timestamp'):
+            for value in self.VALUES:
+                with self.subTest(field=field, value=value):
+                    record = {'device_id': '1', 'location': 'X', 'speed': 1.0, field: value}
+                    self.assertSameResult([record])
+
+    def test_missing_fields(self):
+        record = {'device_id': '1', 'location': 'X', 'speed': 1.0}
+        for field in record:
+            with self.subTest(field=field):
+                self.assertSameResult([{key: value for key, value in record.items() if key != field}])
+        self.assertSameResult([{}])
+
+    def test_invalid_items(self):
+        for item in (None, 'record', 1, ['device_id'], {'device_id': None, 'location': None, 'speed': None}):
+            with self.subTest(item=item):
+                self.assertSameResult([{'device_id': '1', 'location': 'X', 'speed': 1.0}, item])
+
+    @override_settings(USE_TZ=False)
+    def test_naive_timestamps(self):
+        for value in ('2024-01-01T10:00:00Z', '2024-01-01T10:00:00'):
+            with self.subTest(value=value):
+                self.assertSameResult([{'device_id': '1', 'location': 'X', 'speed': 1.0, 'timestamp': value}])
+
+    def test_post_errors(self):
+        data = [{'device_id': '1', 'location': 'X', 'speed': 1.0}, {'device_id': '', 'speed': 'fast'}]
+        response = self.client.post(reverse('device_data'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        serializer = DeviceDataInputSerializer(data=data, many=True)
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(response.data, serializer.errors)
+
+class BoundingBoxTests(APITestCase):
+    def setUp(self):
+        process_device_data([
+            {'device_id': 'istanbul', 'location': '41.0082, 28.9784', 'speed': 10.0},
+            {'device_id': 'ankara', 'location': '39.9334, 32.8597', 'speed': 20.0},
+            {'device_id': 'edge', 'location': '41.0082, 29.5', 'speed': 30.0},
+            {'device_id': 'unknown', 'location': 'X', 'speed': 40.0},
+        ])
+
+    def test_parse_location(self):
+        self.assertEqual(parse_location('41.0082, 28.9784'), (41.0082, 28.9784))
+        self.assertEqual(parse_location('(-33.8,151.2)'), (-33.8, 151.2))
+        self.assertEqual(parse_location('X'), (None, None))
+        self.assertEqual(parse_location('91, 0'), (None, None))
+        self.assertEqual(location_fields('X'), {'latitude': None, 'longitude': None, 'cell': None})
+
+    def test_task_stores_coordinates(self):
+        row = DeviceData.objects.get(device_id='istanbul')
+        self.assertEqual((row.latitude, row.longitude), (41.0082, 28.9784))
+        self.assertEqual(row.cell, location_fields(row.location)['cell'])
+        self.assertIsNone(DeviceData.objects.get(device_id='unknown').cell)
+
+    def test_cell_ranges_are_capped(self):
+        self.assertEqual(len(cell_ranges(28, 40.05, 30, 41.95)), 20)
+        ranges = cell_ranges(-180, -90, 180, 90, max_ranges=8)
+        self.assertLessEqual(len(ranges), 8)
+        self.assertEqual(ranges[0][0], location_fields('-90, -180')['cell'])
+        self.assertEqual(ranges[-1][1], location_fields('90, 180')['cell'])
+
+    def test_invalid_bbox(self):
+        for value in ('1,2,3', 'a,b,c,d', '30,40,28,42', '0,-100,1,1', 'nan,0,1,1'):
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    parse_bbox(value)
+        response = self.client.get(reverse('device_data_list') + '?bbox=1,2,3')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_bbox(self):
+        response = self.client.get(reverse('device_data_list') + '?bbox=28.5,40.5,29.2,41.5')
+        self.assertEqual([item['device_id'] for item in response.data['results']], ['istanbul'])
+
+    def test_export_bbox(self):
+        response = self.client.get(reverse('device_data_export') + '?bbox=28,39,33,42')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(sorted(json.loads(line)['device_id'] for line in lines), ['ankara', 'edge', 'istanbul'])
+
+class DeviceDataRollupTests(APITestCase):
+    def setUp(self):
+        self.start = datetime(2024, 1, 1, 10, 0, tzinfo=dt_timezone.utc)
+        self.records = [
+            DeviceData(device_id='123', location=f'P{index}', speed=speed, timestamp=self.start + timedelta(minutes=minutes))
+            for index, (minutes, speed) in enumerate([(1, 10), (4, 20), (7, 30), (70, 40)])
+        ]
+
+    def buckets(self, resolution):
+        return list(DeviceDataRollup.objects.filter(resolution=resolution).order_by('bucket').values_list(
+            'bucket', 'count', 'speed_sum', 'speed_min', 'speed_max', 'first_location', 'last_location'
+        ))
+
+    def test_incremental_updates(self):
+        update_rollups(DeviceDataRollup, self.records[2:])
+        update_rollups(DeviceDataRollup, self.records[:2])
+        self.assertEqual([row[1:] for row in self.buckets(300)], [
+            (2, 30, 10, 20, 'P0', 'P1'),
+            (1, 30, 30, 30, 'P2', 'P2'),
+            (1, 40, 40, 40, 'P3', 'P3'),
+        ])
+        self.assertEqual([row[1:] for row in self.buckets(3600)], [(3, 60, 10, 30, 'P0', 'P2'), (1, 40, 40, 40, 'P3', 'P3')])
+        self.assertEqual([row[:2] for row in self.buckets(86400)], [(datetime(2024, 1, 1, tzinfo=dt_timezone.utc), 4)])
+
+    def test_task_updates_rollups(self):
+        process_device_data([{'device_id': '123', 'location': 'X', 'speed': 50.0}])
+        self.assertEqual(DeviceDataRollup.objects.filter(device_id='123').count(), 3)
+
+    def test_rebuild_matches_incremental(self):
+        update_rollups(DeviceDataRollup, self.records)
+        expected = [self.buckets(seconds) for seconds in (300, 3600, 86400)]
+        for record in self.records:
+            DeviceData.objects.create(device_id=record.device_id, location=record.location, speed=record.speed)
+            DeviceData.objects.filter(location=record.location).update(timestamp=record.timestamp)
+        DeviceDataRollup.objects.update(count=0)
+
+        self.assertEqual(rebuild_device_data_rollups(chunk_size=3), 4)
+        self.assertEqual([self.buckets(seconds) for seconds in (300, 3600, 86400)], expected)
+
+    def test_choose_resolution(self):
+        self.assertEqual(choose_resolution(self.start, self.start + timedelta(hours=12), 500), '5m')
+        self.assertEqual(choose_resolution(self.start, self.start + timedelta(days=7), 500), '1h')
+        self.assertEqual(choose_resolution(self.start, self.start + timedelta(days=90), 500), '1d')
+        self.assertEqual(choose_resolution(self.start, self.start + timedelta(days=900), 500), '1d')
+
+    def test_rollup_endpoint(self):
+        update_rollups(DeviceDataRollup, self.records)
+        url = reverse('device_data_rollups', args=['123'])
+        response = self.client.get(url, {'start': '2024-01-01T10:00:00Z', 'end': '2024-01-01T11:00:00Z'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['resolution'], '5m')
+        self.assertEqual([item['count'] for item in response.data['results']], [2, 1])
+        self.assertEqual(response.data['results'][0]['avg_speed'], '15.00')
+
+        response = self.client.get(url, {'start': '2024-01-01', 'end': '2024-01-02', 'resolution': '1h'})
+        self.assertEqual([item['count'] for item in response.data['results']], [3, 1])
+
+    def test_rollup_endpoint_errors(self):
+        url = reverse('device_data_rollups', args=['123'])
+        for params in ({'resolution': '1w'}, {'start': 'invalid'}, {'start': '2024-01-02', 'end': '2024-01-01'}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(url, params).status_code, status.HTTP_400_BAD_REQUEST)
+
+class BenchmarkTests(APITestCase):
+    def test_fleet_records_are_valid(self):
+        records = to_json_records(Fleet(devices=10).batch(100))
+        validated_data, errors = DeviceDataValidator(DeviceDataInputSerializer).validate_many(records)
+        self.assertIsNone(errors)
+        self.assertLessEqual(len({record['device_id'] for record in validated_data}), 10)
+
+    def test_summarize(self):
+        summary = summarize([index / 1000 for index in range(1, 101)], records=500, elapsed=2)
+        self.assertEqual(summary['records_per_sec'], 250)
+        self.assertEqual(summary['requests_per_sec'], 50)
+        self.assertEqual(summary['latency_ms'], {'p50': 50, 'p95': 95, 'p99': 99, 'max': 100})
+
+class IngestBatchTests(APITestCase):
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(latest_cache.local.clear)
+
+    @override_settings(INGEST_CHUNK_SIZE=2)
+    @eager_tasks
+    def test_large_payload_is_chunked(self):
+        data = [{'device_id': str(index), 'location': '40.0,29.0', 'speed': index} for index in range(5)]
+        data[4]['speed'] = 'fast'
+        with patch('tracking.serializers.device_data_validator.validate_many', return_value=(data, None)), \
+                patch('tracking.tasks.writer.build', wraps=writer.build) as mock_build:
+            response = self.client.post(reverse('device_data') + '?track=true', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        # The failing last chunk is retried once by the isolation
+        self.assertEqual([len(call[0][0]) for call in mock_build.call_args_list], [2, 2, 1, 1])
+        self.assertEqual(DeviceData.objects.count(), 4)
+
+        batch_id = response.data['batch_id']
+        response = self.client.get(reverse('ingest_batch', args=[batch_id]))
+        self.assertEqual(response.data, {
+            'batch_id': batch_id, 'status': 'completed', 'chunks': 3, 'completed': 3, 'failed': 0,
+            'records': 5, 'stored': 4,
+        })
+
+    @patch('tracking.tasks.process_device_data.apply_async')
+    def test_untracked_by_default(self, mock_apply_async):
+        response = self.client.post(reverse('device_data'), {'device_id': '1', 'location': 'X', 'speed': 1}, format='json')
+        self.assertIsNone(response.data['batch_id'])
+        self.assertFalse(IngestBatch.objects.exists())
+        self.assertEqual(mock_apply_async.call_args[0][0], ([{'device_id': '1', 'location': 'X', 'speed': 1.0}],))
+
+    def test_ingest_tasks_keep_no_result(self):
+        self.assertTrue(process_device_data.ignore_result)
+
+    def test_unknown_batch(self):
+        response = self.client.get(reverse('ingest_batch', args=[uuid.uuid4()]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_expire_batches(self):
+        old = IngestBatch.objects.create(batch_id=uuid.uuid4(), records=1, chunks=1)
+        IngestBatch.objects.filter(pk=old.pk).update(updated_at=timezone.now() - timedelta(days=2))
+        IngestBatch.objects.create(batch_id=uuid.uuid4(), records=1, chunks=1)
+        expire_ingest_batches()
+        self.assertEqual(IngestBatch.objects.count(), 1)
+        self.assertFalse(IngestBatch.objects.filter(pk=old.pk).exists())
+
+class DeadLetterTests(APITestCase):
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(latest_cache.local.clear)
+
+    def records(self, bad):
+        return [
+            {'device_id': str(index), 'location': 'X', 'speed': 'fast' if index in bad else index}
+            for index in range(16)
+        ]
+
+    def test_bad_records_are_isolated(self):
+        with patch('tracking.tasks.writer.save', wraps=writer.save) as mock_save:
+            process_device_data(self.records(bad={3, 12}))
+        self.assertEqual(DeviceData.objects.count(), 14)
+        self.assertEqual(sorted(letter.payload['device_id'] for letter in DeadLetter.objects.all()), ['12', '3'])
+        self.assertIn('must be a decimal number', DeadLetter.objects.first().error)
+        # One failed insert of the whole batch, then bisected without reinserting it in full
+        self.assertLessEqual(mock_save.call_count, 1 + 2 * 2 * 4)
+        self.assertEqual(sum(len(call[0][0]) for call in mock_save.call_args_list if call[0][0][0].pk), 14)
+
+    @override_settings(INGEST_DEDUP='payload')
+    def test_unparseable_records_are_isolated(self):
+        records = self.records(bad={5})
+        del records[1]['location']
+        records[2]['timestamp'] = 'yesterday'
+        records[3]['timestamp'] = '2024-02-30T00:00:00Z'
+        records[4]['location'] = 12
+        process_device_data(records)
+        self.assertEqual(DeviceData.objects.count(), 11)
+        errors = {letter.payload['device_id']: letter.error for letter in DeadLetter.objects.all()}
+        self.assertEqual(sorted(errors), ['1', '2', '3', '4', '5'])
+        self.assertIn('This field is required', errors['1'])
+        self.assertIn('Enter a valid date/time', errors['2'])
+        self.assertIn('Enter a valid date/time', errors['3'])
+        self.assertIn('Not a valid string', errors['4'])
+        self.assertIn('must be a decimal number', errors['5'])
+
+    def test_out_of_range_speed_is_isolated(self):
+        process_device_data([
+            {'device_id': 'a', 'location': '1, 2', 'speed': 5.0},
+            {'device_id': 'b', 'location': '1, 2', 'speed': 1e12},
+        ])
+        self.assertEqual(list(DeviceData.objects.values_list('device_id', flat=True)), ['a'])
+        letter = DeadLetter.objects.get()
+        self.assertEqual(letter.payload['device_id'], 'b')
+        self.assertIn('no more than 8 digits before the decimal point', letter.error)
+
+    def test_programming_errors_fail_the_batch(self):
+        with patch('evreka_case1.ingest.location_fields', side_effect=TypeError('bug')):
+            with self.assertRaises(TypeError):
+                process_device_data(self.records(bad=set()))
+        self.assertEqual(DeviceData.objects.count(), 0)
+        self.assertFalse(DeadLetter.objects.exists())
+
+    def test_replay(self):
+        DeadLetter.objects.create(payload={'device_id': '1', 'location': 'X', 'speed': '5.00'}, error='Lost')
+        failing = DeadLetter.objects.create(payload={'device_id': '2', 'location': 'X', 'speed': 'fast'}, error='Lost')
+        call_command('dead_letters', 'replay', stdout=io.StringIO())
+        self.assertEqual(list(DeviceData.objects.values_list('device_id', flat=True)), ['1'])
+        self.assertEqual(list(DeadLetter.objects.values_list('pk', flat=True)), [failing.pk])
+        failing.refresh_from_db()
+        self.assertEqual(failing.attempts, 2)
+        self.assertIn('must be a decimal number', failing.error)
+
+    def test_purge_before(self):
+        old = DeadLetter.objects.create(payload={}, error='Old')
+        DeadLetter.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=10))
+        DeadLetter.objects.create(payload={}, error='New')
+        before = (timezone.now() - timedelta(days=1)).isoformat()
+        call_command('dead_letters', 'purge', '--before', before, stdout=io.StringIO())
+        self.assertEqual(list(DeadLetter.objects.values_list('error', flat=True)), ['New'])
+
+@override_settings(INGEST_DEDUP='key')
+class DedupTests(APITestCase):
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(latest_cache.local.clear)
+        patcher = patch.dict('evreka_case1.dedup._recent_keys', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.records = [
+            {'device_id': '1', 'location': 'X', 'speed': 10, 'timestamp': '2024-06-01T10:00:00Z'},
+            {'device_id': '1', 'location': 'X', 'speed': 10, 'timestamp': '2024-06-01T10:00:05Z'},
+        ]
+
+    def test_device_timestamp_is_stored(self):
+        process_device_data(self.records[:1])
+        self.assertEqual(DeviceData.objects.get().timestamp, datetime(2024, 6, 1, 10, tzinfo=dt_timezone.utc))
+
+    def test_resent_records_are_stored_once(self):
+        process_device_data(self.records + self.records[:1])
+        process_device_data(self.records)
+        process_device_data([{'device_id': '1', 'location': 'X', 'speed': 10}])
+        self.assertEqual(DeviceData.objects.count(), 3)
+        day = DeviceDataRollup.objects.get(resolution=86400, bucket=datetime(2024, 6, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(day.count, 2)
+
+    def test_concurrently_stored_records_are_skipped(self):
+        process_device_data(self.records[:1])
+        checks = []
+        real = writer.drop_duplicates
+
+        def racing(instances, locking=False):
+            # The first check misses the row stored by a concurrent worker
+            checks.append(locking)
+            return instances if len(checks) == 1 else real(instances, locking)
+
+        with patch.object(writer, 'drop_duplicates', side_effect=racing):
+            process_device_data(self.records)
+        self.assertEqual(checks, [False, True])
+        self.assertEqual(DeviceData.objects.count(), 2)
+        self.assertFalse(DeadLetter.objects.exists())
+
+    def test_key_modes(self):
+        moved = {**self.records[0], 'location': 'Y', 'timestamp': '2024-06-01T13:00:00+03:00'}
+        self.assertEqual(dedup_key(self.records[0], 'key'), dedup_key(moved, 'key'))
+        self.assertNotEqual(dedup_key(self.records[0], 'payload'), dedup_key(moved, 'payload'))
+        self.assertIsNone(dedup_key(self.records[0], 'off'))
+
+    @override_settings(INGEST_DEDUP='payload')
+    @patch('tracking.tasks.process_device_data.apply_async')
+    def test_huge_speed_gets_a_key(self, mock_apply_async):
+        huge = {**self.records[0], 'speed': 1e30}
+        self.assertNotEqual(dedup_key(huge, 'payload'), dedup_key({**huge, 'speed': 1e31}, 'payload'))
+        self.assertIsNotNone(dedup_key({**huge, 'speed': float('inf')}, 'payload'))
+        # The endpoint now refuses speeds the column can't hold, before computing their key
+        response = self.client.post(reverse('device_data'), [huge], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0]['speed'][0].code, 'max_value')
+        mock_apply_async.assert_not_called()
+
+    @patch('tracking.tasks.process_device_data.apply_async')
+    def test_recent_duplicates_are_not_queued(self, mock_apply_async):
+        self.client.post(reverse('device_data'), self.records, format='json')
+        response = self.client.post(reverse('device_data'), self.records, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIsNone(response.data['batch_id'])
+        mock_apply_async.assert_called_once()
+
+    @patch('tracking.tasks.process_device_data.apply_async', side_effect=ConnectionError)
+    def test_failed_dispatch_is_forgotten(self, mock_apply_async):
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.client.post(reverse('device_data'), self.records, format='json')
+        self.assertEqual(mock_apply_async.call_count, 2)
+
+    def test_recent_keys_are_bounded(self):
+        recent = RecentKeys(max_size=2)
+        records = [{**self.records[0], 'device_id': str(index)} for index in range(3)]
+        self.assertEqual(len(recent.filter(records)[0]), 3)
+        self.assertEqual(len(recent), 2)
+        fresh, keys = recent.filter(records)
+        self.assertEqual([record['device_id'] for record in fresh], ['0'])
+
+class BatchConsumerTests(APITestCase):
+    queue = 'ingest-test'
+
+    def setUp(self):
+        self.enterContext(memory_broker())
+        self.addCleanup(cache.clear)
+        self.addCleanup(latest_cache.local.clear)
+
+    def consume(self, **kwargs):
+        consumer = BatchConsumer(app, self.queue, {process_device_data.name: writer}, max_wait_ms=10, **kwargs)
+        consumer.run(stop_when_idle=True)
+        return consumer
+
+    def send(self, data_list, *args):
+        send_task(process_device_data.name, [data_list, *args], queue=self.queue)
+
+    def pending_messages(self):
+        with app.connection_for_read() as connection:
+            return connection.default_channel.queue_declare(self.queue, passive=True).message_count
+
+    def test_batches_are_stored_and_acked(self):
+        for index in range(5):
+            self.send([{'device_id': str(index), 'location': '40.0,29.0', 'speed': index} for _ in range(3)])
+        consumer = self.consume()
+        self.assertEqual(consumer.stored, 15)
+        self.assertEqual(DeviceData.objects.count(), 15)
+        self.assertEqual(DeviceData.objects.filter(cell__isnull=False).count(), 15)
+        self.assertEqual(LatestDeviceData.objects.count(), 5)
+        self.assertEqual(self.pending_messages(), 0)
+
+    def test_tracked_batches_are_counted(self):
+        batch = IngestBatch.objects.create(batch_id=uuid.uuid4(), records=4, chunks=2)
+        self.send([{'device_id': '1', 'location': 'X', 'speed': 1}] * 3, str(batch.batch_id))
+        self.send([{'device_id': '2', 'location': 'X', 'speed': 'fast'}], str(batch.batch_id))
+        self.consume()
+        batch.refresh_from_db()
+        self.assertEqual((batch.completed_chunks, batch.failed_chunks, batch.stored), (2, 0, 3))
+
+    def test_shard_queues_are_consumed_together(self):
+        self.queue = ['ingest-test.0', 'ingest-test.1']
+        for index, queue in enumerate(self.queue):
+            send_task(process_device_data.name, [[{'device_id': str(index), 'location': 'X', 'speed': 1}]], queue=queue)
+        consumer = self.consume()
+        self.assertEqual(consumer.stored, 2)
+
+    def test_failing_message_does_not_block_batch(self):
+        self.send([{'device_id': '1', 'location': 'X', 'speed': 1}])
+        self.send([{'device_id': '2', 'location': 'X', 'speed': 'fast'}])
+        self.send([{'device_id': '3', 'location': 'X', 'speed': 3}])
+        consumer = self.consume()
+        self.assertEqual(consumer.stored, 2)
+        self.assertEqual(sorted(DeviceData.objects.values_list('device_id', flat=True)), ['1', '3'])
+        self.assertEqual([letter.payload['device_id'] for letter in DeadLetter.objects.all()], ['2'])
+        self.assertEqual(self.pending_messages(), 0)
+
+    def test_message_failing_on_its_own_is_rejected(self):
+        def fields(location):
+            if location == 'poison':
+                raise TypeError('bug')
+            return location_fields(location)
+
+        batch = IngestBatch.objects.create(batch_id=uuid.uuid4(), records=2, chunks=2)
+        self.send([{'device_id': '1', 'location': 'poison', 'speed': 1}], str(batch.batch_id))
+        self.send([{'device_id': '2', 'location': 'X', 'speed': 2}], str(batch.batch_id))
+        with patch('evreka_case1.ingest.location_fields', side_effect=fields):
+            consumer = self.consume()
+        self.assertEqual(consumer.stored, 1)
+        self.assertEqual(list(DeviceData.objects.values_list('device_id', flat=True)), ['2'])
+        self.assertEqual(self.pending_messages(), 0)
+        batch.refresh_from_db()
+        self.assertEqual((batch.completed_chunks, batch.failed_chunks, batch.stored), (1, 1, 1))
+
+    def test_database_errors_leave_messages_to_be_redelivered(self):
+        self.send([{'device_id': '1', 'location': 'X', 'speed': 1}])
+        # The memory transport drops unacked messages on close instead of redelivering them
+        with patch('kombu.message.Message.ack') as mock_ack, patch('kombu.message.Message.reject') as mock_reject:
+            with patch.object(writer, 'save_many', side_effect=OperationalError('Database is down')):
+                with self.assertRaises(OperationalError):
+                    self.consume()
+        mock_ack.assert_not_called()
+        mock_reject.assert_not_called()
+
+    def test_columnar_messages_are_stored(self):
+        records = Fleet(devices=3).batch(10)
+        send_task(process_device_data.name, [records], queue=self.queue, serializer='columnar')
+        consumer = self.consume()
+        self.assertEqual(consumer.stored, 10)
+        self.assertEqual(
+            sorted(DeviceData.objects.values_list('device_id', 'timestamp')),
+            sorted((record['device_id'], record['timestamp']) for record in records),
+        )
+
+@patch('tracking.tasks.process_device_data.apply_async')
+class AdmissionTests(APITestCase):
+    queue = 'admission-test'
+    bulk_queue = 'admission-test-bulk'
+
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(latest_cache.local.clear)
+        patcher = patch.dict('evreka_case1.admission._controllers', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.records = [{'device_id': '1', 'location': 'X', 'speed': 10}] * 2
+
+    def test_token_buckets(self, mock_apply_async):
+        buckets = TokenBuckets(rate=1, burst=2)
+        self.assertEqual(buckets.take({'1': 2}, now=0), 0)
+        self.assertEqual(buckets.take({'1': 1, '2': 1}, now=0.5), 0.5)
+        self.assertEqual(buckets.take({'2': 1}, now=0.5), 0)
+        self.assertEqual(buckets.take({'1': 1}, now=1), 0)
+
+    @override_settings(ADMISSION_DEVICE_RATE=1, ADMISSION_DEVICE_BURST=2)
+    def test_device_over_rate_is_rejected(self, mock_apply_async):
+        response = self.client.post(reverse('device_data'), self.records, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        response = self.client.post(reverse('device_data'), self.records[:1], format='json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '1')
+        mock_apply_async.assert_called_once()
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=2, ADMISSION_RETRY_AFTER=3)
+    def test_in_flight_records_are_capped(self, mock_apply_async):
+        # Records of another request still being handed to a slow broker
+        in_flight = get_admission_controller('http').in_flight
+        in_flight.acquire(2)
+        response = self.client.post(reverse('device_data'), self.records[:1], format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '3')
+        in_flight.release(2)
+        response = self.client.post(reverse('device_data'), self.records, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(in_flight.count, 0)
+
+    @override_settings(
+        ADMISSION_MAX_IN_FLIGHT=2, INGEST_COALESCE=True, INGEST_COALESCE_MAX_RECORDS=100, INGEST_COALESCE_MAX_AGE_MS=60000,
+    )
+    def test_coalesced_records_stay_in_flight(self, mock_apply_async):
+        self.addCleanup(close_coalescers)
+        response = self.client.post(reverse('device_data'), self.records, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(get_admission_controller('http').in_flight.total(), 2)
+        response = self.client.post(reverse('device_data'), self.records[:1], format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        close_coalescers()
+        self.assertEqual(get_admission_controller('http').in_flight.total(), 0)
+        mock_apply_async.assert_called_once()
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=2, ADMISSION_BULK_MAX_WAIT=0, BULK_UPLOAD_CHUNK_SIZE=1)
+    def test_bulk_upload_is_admitted(self, mock_apply_async):
+        in_flight = get_admission_controller('http_bulk', bulk=True).in_flight
+        body = '\n'.join(json.dumps(record) for record in self.records)
+        response = self.client.post(reverse('device_data_bulk'), body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        in_flight.acquire(2)
+        self.addCleanup(in_flight.release, 2)
+        response = self.client.post(reverse('device_data_bulk'), body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual((response.data['accepted'], response.data['rejected']), (0, 0))
+        self.assertEqual(mock_apply_async.call_count, 2)
+
+    def test_queue_backlog_is_rejected(self, mock_apply_async):
+        self.enterContext(memory_broker())
+        self.addCleanup(self.purge)
+        for _ in range(3):
+            send_task(process_device_data.name, [self.records], queue=self.queue)
+        with override_settings(INGEST_QUEUE=self.queue, ADMISSION_MAX_QUEUE_DEPTH=3):
+            response = self.client.post(reverse('device_data'), self.records, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        mock_apply_async.assert_not_called()
+
+    def test_bulk_uploads_check_the_bulk_queue(self, mock_apply_async):
+        self.enterContext(memory_broker())
+        self.enterContext(override_settings(
+            INGEST_QUEUE=self.queue, INGEST_BULK_QUEUE=self.bulk_queue, ADMISSION_MAX_QUEUE_DEPTH=3,
+            ADMISSION_QUEUE_CHECK_INTERVAL=0, ADMISSION_BULK_MAX_WAIT=0,
+        ))
+        self.addCleanup(self.purge)
+        body = '\n'.join(json.dumps(record) for record in self.records)
+        for _ in range(3):
+            send_task(process_device_data.name, [self.records], queue=self.queue)
+        response = self.client.post(reverse('device_data_bulk'), body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        for _ in range(3):
+            send_task(process_device_data.name, [self.records], queue=self.bulk_queue)
+        response = self.client.post(reverse('device_data_bulk'), body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def purge(self):
+        with app.connection_for_write() as connection:
+            for queue in (self.queue, self.bulk_queue):
+                connection.default_channel.queue_purge(queue)
+
+class RecordingWriter:
+    def __init__(self, fail=0, blocked=None):
+        self.calls = []
+        self.fail = fail
+        self.blocked = blocked
+
+    def write_many(self, data_lists):
+        if self.blocked is not None:
+            self.blocked.wait()
+        if self.fail:
+            self.fail -= 1
+            raise OperationalError('Database is down')
+        self.calls.append(data_lists)
+        return data_lists
+
+    def write(self, data_list):
+        return self.write_many([data_list])[0]
+
+    def finish_batch(self, batch_id, stored=0, failed=False):
+        pass
+
+    def after_save(self, instances):
+        pass
+
+class DirectWriterTests(APITestCase):
+    def open_writer(self, writer, **kwargs):
+        options = {'max_records': 4, 'max_wait_ms': 10000, 'max_pending': 100, 'add_timeout': 0, 'retry_interval': 0}
+        options.update(kwargs)
+        direct_writer = DirectWriter(writer, **options)
+        self.addCleanup(direct_writer.close, 5)
+        return direct_writer
+
+    def test_records_are_written_in_batches(self):
+        recording = RecordingWriter()
+        direct_writer = self.open_writer(recording)
+        for index in range(3):
+            direct_writer.add([index] * 2)
+        # The last item is only written on close, long before its wait is over
+        direct_writer.close(5)
+        self.assertEqual(recording.calls, [[[0, 0], [1, 1]], [[2, 2]]])
+
+    def test_failed_batch_is_retried(self):
+        recording = RecordingWriter(fail=2)
+        direct_writer = self.open_writer(recording, max_wait_ms=0)
+        direct_writer.add([1], wait=True)
+        self.assertEqual(recording.calls, [[[1]]])
+
+    def test_retries_are_capped(self):
+        recording = RecordingWriter(fail=3)
+        direct_writer = self.open_writer(recording, max_wait_ms=0, max_attempts=2)
+        with self.assertRaises(RuntimeError):
+            direct_writer.add([1], wait=True)
+        direct_writer.add([2], wait=True)
+        self.assertEqual(recording.calls, [[[2]]])
+
+    def test_full_queue_refuses_records(self):
+        blocked = threading.Event()
+        direct_writer = self.open_writer(RecordingWriter(blocked=blocked), max_records=1, max_pending=2)
+        self.addCleanup(blocked.set)
+        direct_writer.add([1, 2])
+        with self.assertRaises(WriterFull) as context:
+            direct_writer.add([3])
+        self.assertEqual(context.exception.status_code, 503)
+
+@override_settings(INGEST_PIPELINE='direct', INGEST_DIRECT_MAX_WAIT_MS=0)
+class DirectPipelineTests(APITransactionTestCase):
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(latest_cache.local.clear)
+        patcher = patch.dict('evreka_case1.pipeline._writers', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(close_direct_writers, 5)
+
+    @patch('tracking.tasks.process_device_data.apply_async')
+    def test_records_are_stored_without_broker(self, mock_apply_async):
+        records = [{'device_id': str(index), 'location': '40.0,29.0', 'speed': index} for index in range(3)]
+        response = self.client.post(reverse('device_data') + '?track=true', records, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        close_direct_writers(5)
+        mock_apply_async.assert_not_called()
+        self.assertEqual(DeviceData.objects.count(), 3)
+        self.assertEqual(LatestDeviceData.objects.count(), 3)
+        batch = IngestBatch.objects.get(batch_id=response.data['batch_id'])
+        self.assertEqual((batch.completed_chunks, batch.stored), (1, 3))
+
+    def test_failing_batch_does_not_block_the_queue(self):
+        def fields(location):
+            if location == 'poison':
+                raise TypeError('bug')
+            return location_fields(location)
+
+        direct_writer = get_direct_writer('tracking', writer)
+        with patch('evreka_case1.ingest.location_fields', side_effect=fields):
+            with self.assertRaises(RuntimeError):
+                direct_writer.add([{'device_id': '1', 'location': 'poison', 'speed': 1}], wait=True)
+            direct_writer.add([{'device_id': '2', 'location': 'poison', 'speed': 2}])
+            direct_writer.add([{'device_id': '3', 'location': '40.0,29.0', 'speed': 3}])
+            self.assertTrue(direct_writer.drain(5))
+        self.assertEqual(list(DeviceData.objects.values_list('device_id', flat=True)), ['3'])
+
+@override_settings(INGEST_QUEUE='ingest', INGEST_SHARDS=4)
+class ShardingTests(APITestCase):
+    def records(self, *device_ids):
+        return [{'device_id': device_id, 'location': '40.0,29.0', 'speed': index} for index, device_id in enumerate(device_ids)]
+
+    def test_devices_keep_their_queue_and_order(self):
+        records = self.records(*[str(index % 10) for index in range(50)])
+        routed = route_records(records)
+        self.assertEqual(sum(len(chunk) for _, chunk in routed), 50)
+        for queue, chunk in routed:
+            self.assertEqual({shard_queue(shard_of(record['device_id'], 4)) for record in chunk}, {queue})
+            self.assertEqual([record['speed'] for record in chunk], sorted(record['speed'] for record in chunk))
+
+    @patch('tracking.tasks.process_device_data.apply_async')
+    def test_live_and_bulk_queues(self, mock_apply_async):
+        self.client.post(reverse('device_data'), self.records('7', '7'), format='json')
+        self.assertEqual(mock_apply_async.call_args[1], {'queue': shard_queue(shard_of('7', 4))})
+        with override_settings(INGEST_BULK_QUEUE='ingest.bulk'):
+            body = '\n'.join(json.dumps(record) for record in self.records('1', '2', '3'))
+            self.client.post(reverse('device_data_bulk'), body, content_type='application/x-ndjson')
+        self.assertEqual(mock_apply_async.call_args[1], {'queue': 'ingest.bulk'})
+
+    def test_shard_subsets(self):
+        self.assertEqual(ingest_queues('0-1,3'), ['ingest.0', 'ingest.1', 'ingest.3'])
+        with override_settings(INGEST_BULK_QUEUE='ingest.bulk'):
+            out = io.StringIO()
+            call_command('ingest_queues', '2', '--bulk', stdout=out)
+            self.assertEqual(out.getvalue().strip(), 'ingest.2,ingest.bulk')
+        with self.assertRaises(ValueError):
+            parse_shards('2-4', 4)
+
+class ColumnarSerializerTests(APITestCase):
+    embed = {'callbacks': None, 'errbacks': None, 'chain': None, 'chord': None}
+
+    def test_round_trip(self):
+        records = Fleet(devices=300).batch(400)
+        del records[0]['timestamp']
+        records[1]['timestamp'] = datetime(2024, 1, 1, 12, tzinfo=timezone.get_fixed_timezone(180))
+        for serializer in (ColumnarSerializer(), ColumnarSerializer(compress_min_size=None)):
+            data = serializer.encode([[records, 'batch'], {}, self.embed])
+            self.assertEqual(serializer.decode(memoryview(data)), [[records, 'batch'], {}, self.embed])
+        self.assertLess(len(ColumnarSerializer().encode([[records], {}, self.embed])), len(kombu_json.dumps(records)) / 5)
+
+    def test_other_bodies_stay_json(self):
+        serializer = ColumnarSerializer()
+        bodies = [
+            [[[{'device_id': '1', 'location': 'X', 'speed': 1}]], {}, self.embed],
+            [[[{'device_id': '1', 'location': 'X', 'speed': 1.0, 'extra': True}]], {}, self.embed],
+            [[[{'device_id': '1', 'location': 'X', 'speed': 1.0, 'timestamp': '2024-01-01T00:00:00Z'}]], {}, self.embed],
+            [[], {}, self.embed],
+            {'status': 'SUCCESS'},
+        ]
+        for body in bodies:
+            data = serializer.encode(body)
+            self.assertFalse(data[4] & FLAG_COLUMNAR)
+            self.assertEqual(serializer.decode(data), body)
+
+    def test_ingest_tasks_only(self):
+        self.assertEqual(process_device_data.serializer, 'columnar')
+        self.assertEqual(expire_ingest_batches.serializer, 'json')
+        with self.assertRaises(ValueError):
+            ColumnarSerializer().decode(b'{"status": "SUCCESS"}')
+
+class MetricsTests(APITestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = registry.counter('records_total', 'Records.', ['source'])
+        histogram = registry.histogram('duration_seconds', 'Duration.', buckets=(0.1, 1))
+        counter.labels('a"b').inc(3)
+        histogram.labels().observe(0.5)
+        histogram.labels().observe(5)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP records_total Records.',
+            '# TYPE records_total counter',
+            'records_total{source="a\\"b"} 3',
+            '# HELP duration_seconds Duration.',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{le="0.1"} 0',
+            'duration_seconds_bucket{le="1"} 1',
+            'duration_seconds_bucket{le="+Inf"} 2',
+            'duration_seconds_sum 5.5',
+            'duration_seconds_count 2',
+        ])
+
+    @patch('tracking.tasks.process_device_data.apply_async')
+    def test_ingest_counters(self, mock_apply_async):
+        validated = RECORDS_VALIDATED.labels('http').value
+        rejected = RECORDS_REJECTED.labels('http').value
+        data = [{'device_id': '1', 'location': 'X', 'speed': 1}, {'device_id': '2', 'location': 'X', 'speed': 'fast'}]
+        self.client.post(reverse('device_data'), data, format='json')
+        self.client.post(reverse('device_data'), data[:1], format='json')
+        self.assertEqual(RECORDS_VALIDATED.labels('http').value - validated, 2)
+        self.assertEqual(RECORDS_REJECTED.labels('http').value - rejected, 1)
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('device_data_list'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode('utf-8')
+        self.assertIn('http_request_query_seconds_count{view="device_data_list"}', body)
+        self.assertIn('# TYPE ingest_records_received_total counter', body)
+
+    def test_queue_lag(self):
+        task = process_device_data
+        task.push_request(enqueued_at=time.time() - 2)
+        try:
+            record_queue_lag(task=task)
+        finally:
+            task.pop_request()
+        lag = TASK_QUEUE_LAG_SECONDS.labels(task.name)
+        self.assertGreaterEqual(lag.sum, 2)
+
+class ProfilingTests(APITestCase):
+    def setUp(self):
+        self.log_file = os.path.join(tempfile.mkdtemp(), 'profiling.log')
+        profiling.logger.handlers.clear()
+        self.addCleanup(profiling.logger.handlers.clear)
+
+    def reports(self):
+        for handler in profiling.logger.handlers:
+            handler.flush()
+        with open(self.log_file) as log:
+            return [json.loads(line) for line in log]
+
+    def test_disabled_by_default(self):
+        response = self.client.get(reverse('device_data_list'))
+        self.assertNotIn('Server-Timing', response)
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            profiling.normalize_sql('SELECT 1 WHERE id IN (%s, %s, %s)'),
+            profiling.normalize_sql('SELECT 1 WHERE id IN (%s, %s)'),
+        )
+
+    def test_request_report(self):
+        with self.settings(PROFILING_ENABLED=True, PROFILING_LOG_FILE=self.log_file, PROFILING_SAMPLE_RATE=1,
+                           PROFILING_N_PLUS_ONE_THRESHOLD=3, PROFILING_SLOW_QUERY_MS=0):
+            response = self.client.get(reverse('device_data_list'))
+        self.assertIn('db;dur=', response['Server-Timing'])
+        report = self.reports()[-1]
+        self.assertEqual(report['path'], reverse('device_data_list'))
+        self.assertGreaterEqual(report['queries'], 1)
+        self.assertEqual(len(report['slow_queries']), report['queries'])
+        self.assertIn('samples', report['profile'])
+
+    def test_n_plus_one(self):
+        recorder = profiling.QueryRecorder(slow_query_ms=1000, n_plus_one_threshold=3)
+        for index in range(3):
+            DeviceData.objects.create(device_id=str(index), location='X', speed=1)
+        with connection.execute_wrapper(recorder):
+            for data in DeviceData.objects.all():
+                LatestDeviceData.objects.filter(device_id=data.device_id).first()
+        report = recorder.report()
+        self.assertEqual(report['queries'], 4)
+        self.assertEqual(len(report['n_plus_one']), 1)
+        self.assertEqual(report['n_plus_one'][0]['count'], 3)
+
+    def test_task_report(self):
+        with self.settings(PROFILING_ENABLED=True, PROFILING_LOG_FILE=self.log_file):
+            profiling.configure_logger()
+            profiling.start_task_profile(task_id='1')
+            process_device_data([{'device_id': '1', 'location': 'X', 'speed': 1.0}])
+            profiling.finish_task_profile(task_id='1', task=process_device_data, state='SUCCESS')
+        report = self.reports()[-1]
+        self.assertEqual(report['task'], process_device_data.name)
+        self.assertGreater(report['queries'], 0)
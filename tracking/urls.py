@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import DeviceDataAPI, DeviceDataListAPI, LatestDeviceDataAPI
+from .views import DeviceDataAPI, DeviceDataBulkAPI, IngestBatchAPI, DeviceDataListAPI, LatestDeviceDataAPI, BulkLatestDeviceDataAPI, DeviceDataExportAPI, DeviceDataRollupAPI
 from rest_framework.schemas import get_schema_view
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
@@ -18,8 +18,13 @@ schema_view = get_schema_view(
 
 urlpatterns = [
     path('data/', DeviceDataAPI.as_view(), name='device_data'),
+    path('data/bulk/', DeviceDataBulkAPI.as_view(), name='device_data_bulk'),
+    path('data/batches/<uuid:batch_id>/', IngestBatchAPI.as_view(), name='ingest_batch'),
     path('data/list/', DeviceDataListAPI.as_view(), name='device_data_list'),
+    path('data/export/', DeviceDataExportAPI.as_view(), name='device_data_export'),
+    path('data/latest/', BulkLatestDeviceDataAPI.as_view(), name='bulk_latest_device_data'),
     path('data/latest/<str:device_id>/', LatestDeviceDataAPI.as_view(), name='latest_device_data'),
+    path('data/rollups/<str:device_id>/', DeviceDataRollupAPI.as_view(), name='device_data_rollups'),
      path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
 ]
\ No newline at end of file
@@ -1,16 +1,28 @@
 from rest_framework.views import APIView
+from django.http import StreamingHttpResponse
+from evreka_case1.streaming import EXPORT_FORMATS, export_response, format_datetime, format_decimal, stream_json_array
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.generics import GenericAPIView
-from rest_framework.pagination import PageNumberPagination
+from django.conf import settings
+from evreka_case1.pagination import KeysetPagination, keyset_iterator
 from .serializers import DeviceDataSerializer
-from .tasks import process_device_data
-from .models import DeviceData
-from .serializers import DeviceDataInputSerializer
+from .dispatch import buffered_device_data, dispatch_device_data
+from .latest import get_latest_device_data, iter_latest_device_data
+from .models import DeviceData, IngestBatch
+from .serializers import device_data_validator, validate_device_data
+from evreka_case1.admission import AdmissionRejected, get_admission_controller
+from evreka_case1.bulk import NDJSONIngest, UploadError, open_upload
+from evreka_case1.ingest import batch_status
+from evreka_case1.metrics import record_validation
 from django.core.exceptions import ValidationError
-from .exceptions import InvalidTimeException
+from .exceptions import BaseTrackingException, InvalidBoundingBoxException, InvalidTimeException
+from evreka_case1.geo import filter_bbox, parse_bbox
 from dateutil.parser import parse
-from datetime import datetime
+from datetime import datetime, timedelta
+from django.utils import timezone
+from evreka_case1.rollups import RESOLUTIONS, choose_resolution
+from .rollups import get_device_data_rollups
 
 class DeviceDataAPI(APIView):
     """
@@ -18,44 +30,128 @@ class DeviceDataAPI(APIView):
     Receive device data and process it asynchronously.
 
     Accepts device data in JSON format (single object or array). The data is validated and passed
-    to a background task for processing.
+    to a background task for processing. Payloads over `INGEST_CHUNK_SIZE` records are split into
+    chunks stored in parallel.
 
     Parameters:
         - data (list or dict): A single device data object or an array of objects.
 
     Responses:
-        202: Data successfully received and queued for processing.
+        202: Data successfully received and queued for processing. With `?track=true` the `batch_id`
+             can be polled on `data/batches/<batch_id>/`, it is `null` otherwise.
         400: Invalid input data.
+        429: A device sends faster than `ADMISSION_DEVICE_RATE`, retry after `Retry-After` seconds.
+        503: Ingest is overloaded (queue backlog or records in flight), retry after `Retry-After` seconds.
     """
     def post(self, request):
         data_list = request.data if isinstance(request.data, list) else [request.data]
-        serializer = DeviceDataInputSerializer(data=data_list, many=True)
-        if serializer.is_valid():
-            # Convert each item in validated_data to a dict
-            validated_data = [dict(item) for item in serializer.validated_data]
-            process_device_data.delay(validated_data)
-            return Response({'message': 'Data received', 'data': validated_data}, status=status.HTTP_202_ACCEPTED)
+        validated_data, errors = device_data_validator.validate_many(data_list)
+        record_validation('http', len(data_list), 0 if errors is None else sum(1 for error in errors if error))
+        if errors is None:
+            track = request.query_params.get('track', '').lower() in ('1', 'true', 'yes')
+            try:
+                with get_admission_controller('http', buffered_device_data).admit(validated_data):
+                    batch_id = dispatch_device_data(validated_data, track=track)
+            except AdmissionRejected as e:
+                return Response(
+                    {'message': str(e)}, status=e.status_code, headers={'Retry-After': e.retry_after_header}
+                )
+            return Response(
+                {'message': 'Data received', 'batch_id': batch_id, 'data': validated_data},
+                status=status.HTTP_202_ACCEPTED,
+            )
         else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+def dispatch_bulk_chunk(records):
+    # The upload isn't read further while waiting, which slows the client down
+    with get_admission_controller('http_bulk', buffered_device_data, bulk=True).admit(
+        records, wait=settings.ADMISSION_BULK_MAX_WAIT, rate_limit=False
+    ):
+        dispatch_device_data(records, bulk=True)
+
+class DeviceDataBulkAPI(APIView):
+    """
+    post:
+    Upload a large amount of device data as newline delimited JSON.
+
+    The body is one JSON object per line, optionally gzip compressed (`Content-Encoding: gzip`).
+    It is parsed incrementally from the request stream, validated and queued in chunks,
+    so memory use does not depend on the size of the upload. Invalid lines are skipped.
+    The chunks go to the bulk ingest queue (`INGEST_BULK_QUEUE`) when one is configured.
+
+    Chunks wait up to `ADMISSION_BULK_MAX_WAIT` seconds for the backlog of the queue they go to and
+    the records in flight to drop below their limits. Device rate limits don't apply to uploads.
+
+    Responses:
+        202: Counts of accepted and rejected records with the line numbers of the first errors.
+        400: Empty or unreadable upload.
+        503: Ingest stayed overloaded, with the counts of the records accepted before. Retry the rest
+             after `Retry-After` seconds.
+    """
+    def post(self, request):
+        stream = request.stream
+        if stream is None:
+            return Response({'error': 'Empty upload.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        ingest = NDJSONIngest(
+            validate_device_data,
+            dispatch_bulk_chunk,
+            chunk_size=settings.BULK_UPLOAD_CHUNK_SIZE,
+            max_errors=settings.BULK_UPLOAD_MAX_ERRORS,
+        )
+        try:
+            result = ingest.run(open_upload(stream, request.headers.get('Content-Encoding')))
+        except UploadError as e:
+            return Response({'error': str(e), **e.result}, status=status.HTTP_400_BAD_REQUEST)
+        except AdmissionRejected as e:
+            return Response(
+                {'message': str(e), **ingest.result}, status=e.status_code, headers={'Retry-After': e.retry_after_header}
+            )
+        finally:
+            record_validation('http_bulk', ingest.accepted + ingest.rejected, ingest.rejected)
+        return Response({'message': 'Data received', **result}, status=status.HTTP_202_ACCEPTED)
+
+class IngestBatchAPI(APIView):
+    """
+    get:
+    Retrieve the progress of a tracked ingest batch.
+
+    Batches are tracked when the data was posted with `?track=true`, and expire `INGEST_BATCH_TTL` seconds after their last update.
+
+    Parameters:
+        - batch_id (uuid): The `batch_id` returned when the data was received.
+
+    Responses:
+        200: The status (`pending`, `completed` or `failed`) with the number of chunks, completed and failed chunks,
+             received and stored records (rejected and duplicate records aren't stored).
+        404: Unknown or expired batch.
+    """
+    def get(self, request, batch_id):
+        batch = IngestBatch.objects.filter(batch_id=batch_id).first()
+        if batch is None:
+            return Response({'message': 'No batch found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(batch_status(batch), status=status.HTTP_200_OK)
 
 class DeviceDataListAPI(GenericAPIView):
     """
     get:
     Retrieve a paginated list of device data.
 
-    Allows optional filtering by `device_id` and/or a date range (`start_date`, `end_date`).
+    Allows optional filtering by `device_id`, a date range (`start_date`, `end_date`) and/or an area (`bbox`).
 
     Parameters:
         - device_id (str): Filter results by device ID.
         - start_date (str): Filter results starting from this date (inclusive).
         - end_date (str): Filter results up to this date (inclusive).
+        - bbox (str): Only records inside `min_lon,min_lat,max_lon,max_lat`.
 
     Responses:
         200: List of device data.
         400: Invalid input parameters.
     """
     serializer_class = DeviceDataSerializer
-    pagination_class = PageNumberPagination
+    pagination_class = KeysetPagination
 
     def get(self, request):
         try:
@@ -66,7 +162,7 @@ class DeviceDataListAPI(GenericAPIView):
                 return self.get_paginated_response(serializer.data)
             serializer = self.get_serializer(queryset, many=True)
             return Response(serializer.data)
-        except InvalidTimeException as e:
+        except BaseTrackingException as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
     def get_queryset(self, request):
@@ -74,6 +170,7 @@ class DeviceDataListAPI(GenericAPIView):
             start_date = request.query_params.get('start_date')
             end_date = request.query_params.get('end_date')
             device_id = request.query_params.get('device_id')
+            bbox = request.query_params.get('bbox')
 
             queryset = DeviceData.objects.all()
 
@@ -96,18 +193,72 @@ class DeviceDataListAPI(GenericAPIView):
                 queryset = queryset.filter(device_id=device_id)
             if start_date and end_date:
                 queryset = queryset.filter(timestamp__range=[start_date, end_date])
+            if bbox:
+                try:
+                    queryset = filter_bbox(queryset, parse_bbox(bbox))
+                except ValueError as e:
+                    raise InvalidBoundingBoxException(str(e))
 
-            return queryset.order_by('-timestamp').only('device_id', 'location', 'speed', 'timestamp')
+            return queryset.order_by('-timestamp', '-id').only('device_id', 'location', 'speed', 'timestamp')
         except ValidationError as e:
 
             raise InvalidTimeException(f'Invalid time format: {e}')
 
+class DeviceDataExportAPI(DeviceDataListAPI):
+    """
+    get:
+    Export the full filtered device data history as a streamed file.
+
+    Takes the same `device_id`, `start_date`, `end_date` and `bbox` filters as the list endpoint.
+    Rows are read in keyset seeked chunks, so memory stays constant regardless of the range.
+
+    Parameters:
+        - output (str): `ndjson` (default) or `csv`.
+        - compress (str): `gzip` to compress the file on the fly.
+
+    Responses:
+        200: The exported file.
+        400: Invalid input parameters.
+    """
+    pagination_class = None
+    fields = ['id', 'device_id', 'timestamp', 'location', 'speed']
+
+    def get(self, request):
+        output = request.query_params.get('output', 'ndjson')
+        if output not in EXPORT_FORMATS:
+            return Response({'error': f'Invalid output format: {output}'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            queryset = self.get_queryset(request).values_list(*self.fields)
+        except BaseTrackingException as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        rows = keyset_iterator(queryset, position=lambda row: (row[2], row[0]), chunk_size=settings.EXPORT_CHUNK_SIZE)
+        items = (
+            {
+                'id': pk,
+                'device_id': device_id,
+                'timestamp': format_datetime(timestamp),
+                'location': location,
+                'speed': format_decimal(speed),
+            }
+            for pk, device_id, timestamp, location, speed in rows
+        )
+        return export_response(
+            items,
+            self.fields,
+            output,
+            compress=request.query_params.get('compress') == 'gzip',
+            filename='device_data',
+        )
+
 class LatestDeviceDataAPI(APIView):
 
     """
     get:
     Retrieve the latest device data for a specific device ID.
 
+    Served from the latest position store and its cache, the history table is not queried.
+
     Parameters:
         - device_id (str): The ID of the device to retrieve the latest data for.
 
@@ -116,9 +267,93 @@ class LatestDeviceDataAPI(APIView):
         404: No data found for the given device ID.
     """
     def get(self, request, device_id):
-        data = DeviceData.objects.filter(device_id=device_id).order_by('-timestamp').first()
+        data = get_latest_device_data(device_id)
         if data:
-            serializer = DeviceDataSerializer(data)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            return Response(data, status=status.HTTP_200_OK)
         else:
-            return Response({'message': 'No data found'}, status=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+            return Response({'message': 'No data found'}, status=status.HTTP_404_NOT_FOUND)
+
+class BulkLatestDeviceDataAPI(APIView):
+    """
+    get:
+    Retrieve the latest device data of many devices at once.
+
+    Parameters:
+        - device_id (str): Device IDs to return, repeated or comma separated. All devices when omitted.
+
+    post:
+    Retrieve the latest device data of the devices listed in the body.
+
+    Accepts `{"device_ids": [...]}` or a plain array of device IDs, for fleets too
+    large to list in a query string.
+
+    Responses:
+        200: A streamed JSON array with the latest data of every device that has data.
+        400: Invalid device ID list.
+    """
+    def get(self, request):
+        device_ids = [
+            device_id
+            for value in request.query_params.getlist('device_id')
+            for device_id in value.split(',')
+            if device_id
+        ]
+        return self.stream(device_ids or None)
+
+    def post(self, request):
+        device_ids = request.data.get('device_ids') if isinstance(request.data, dict) else request.data
+        if not isinstance(device_ids, list) or not all(isinstance(device_id, str) for device_id in device_ids):
+            return Response({'error': 'Expected a list of device IDs.'}, status=status.HTTP_400_BAD_REQUEST)
+        return self.stream(device_ids)
+
+    def stream(self, device_ids):
+        return StreamingHttpResponse(
+            stream_json_array(iter_latest_device_data(device_ids)),
+            content_type='application/json',
+        )
+
+class DeviceDataRollupAPI(APIView):
+    """
+    get:
+    Retrieve the precomputed aggregates of a device over time.
+
+    Returns the sample count, average/min/max speed and first/last position per time bucket,
+    read from the rollup tables instead of the history.
+
+    Parameters:
+        - device_id (str): The ID of the device.
+        - start (str): Start of the range, defaults to one day before `end`.
+        - end (str): End of the range, defaults to now.
+        - resolution (str): `5m`, `1h` or `1d`. Defaults to the finest one that covers the range in at most `ROLLUP_MAX_BUCKETS` buckets.
+
+    Responses:
+        200: The resolution used and the buckets of the range, oldest first.
+        400: Invalid input parameters.
+    """
+    def get(self, request, device_id):
+        try:
+            end = self.parse_time(request.query_params.get('end')) or timezone.now()
+            start = self.parse_time(request.query_params.get('start')) or end - timedelta(days=1)
+        except InvalidTimeException as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if start > end:
+            return Response({'error': 'start must be before end.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        resolution = request.query_params.get('resolution') or choose_resolution(start, end, settings.ROLLUP_MAX_BUCKETS)
+        if resolution not in RESOLUTIONS:
+            return Response({'error': f'Invalid resolution: {resolution}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'device_id': device_id,
+            'resolution': resolution,
+            'results': get_device_data_rollups(device_id, resolution, start, end),
+        }, status=status.HTTP_200_OK)
+
+    def parse_time(self, value):
+        if not value:
+            return None
+        try:
+            value = parse(value)
+        except (ValueError, OverflowError):
+            raise InvalidTimeException(f"Invalid date format: {value}")
+        return timezone.make_aware(value) if timezone.is_naive(value) else value